@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+كاش بيانات المشرفين
+===================
+أسماء المشرفين (AdminProfileCache):
+- تُعرض في صفحات الطلبات، وكانت تُجلب بـ bot.get_chat لكل طلب
+- الاسم يُحفظ عند إضافة المشرف من لوحة التحكم وعند استلامه لأي طلب
+- عند عدم وجوده أو انتهاء صلاحيته يُقرأ من مجموعة admins (بدون أي اتصال بتيليجرام)
+
+قائمة المشرفين (AdminRegistry):
+- كانت مجموعة admins تُقرأ كاملة مع كل إشعار وكل فحص صلاحية
+- الآن تُحفظ في ذاكرة العملية (فحص العضوية O(1)) وتُعاد قراءتها كل فترة
+- الإضافة والحذف من لوحة التحكم يغيران رقم النسخة في المخزن المشترك
+  فتعيد كل العمليات القراءة خلال ثوانٍ
+
+تعمل فوق المخزن المشترك (Redis أو الذاكرة المحلية)
+"""
+
+import time
+import uuid
+import threading
+import logging
+
+from extensions import db, ADMIN_ID
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+ADMIN_NAME_TTL = 24 * 3600   # الاسم يُعاد قراءته من Firestore مرة يومياً
+DEFAULT_ADMIN_NAME = 'مشرف'
+
+ADMIN_REGISTRY_TTL = 300            # إعادة قراءة القائمة كل 5 دقائق كحد أقصى
+REGISTRY_VERSION_CHECK_SECONDS = 5  # فحص رقم النسخة في المخزن المشترك
+REGISTRY_RETRY_SECONDS = 30         # بعد فشل القراءة تُستخدم القائمة السابقة هذه المدة
+
+
+class AdminProfileCache:
+    """
+    الاستخدام:
+        admin_profiles.remember(telegram_id, name)
+        admin_profiles.get_name(telegram_id)  # من الكاش أو من مجموعة admins
+    """
+
+    def __init__(self, backend=None, prefix='admin_name'):
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, telegram_id):
+        return f"{self.prefix}:{telegram_id}"
+
+    def remember(self, telegram_id, name):
+        if not telegram_id or not name:
+            return
+        try:
+            self.backend.set(self._key(telegram_id), name, ex=ADMIN_NAME_TTL)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ اسم المشرف {telegram_id}: {e}")
+
+    def forget(self, telegram_id):
+        if not telegram_id:
+            return
+        try:
+            self.backend.delete(self._key(telegram_id))
+        except Exception as e:
+            logger.error(f"خطأ في حذف اسم المشرف {telegram_id}: {e}")
+
+    def _load(self, telegram_id):
+        """قراءة الاسم من مجموعة admins"""
+        if not db:
+            return None
+        from firebase_utils import query_where
+        docs = query_where(db.collection('admins'), 'telegram_id', '==', str(telegram_id)).limit(1).get()
+        for doc in docs:
+            return doc.to_dict().get('name')
+        return None
+
+    def get_name(self, telegram_id, default=DEFAULT_ADMIN_NAME):
+        """اسم المشرف للعرض (لا يتصل بتيليجرام أبداً)"""
+        if not telegram_id:
+            return default
+        try:
+            name = self.backend.get(self._key(telegram_id))
+            if name:
+                return name
+            name = self._load(telegram_id)
+        except Exception as e:
+            logger.error(f"خطأ في جلب اسم المشرف {telegram_id}: {e}")
+            return default
+        if name:
+            self.remember(telegram_id, name)
+            return name
+        return default
+
+
+admin_profiles = AdminProfileCache()
+
+
+def order_admin_name(order):
+    """
+    اسم المشرف المسؤول عن الطلب:
+    الاسم المحفوظ في الطلب عند الاستلام، أو من الكاش للطلبات القديمة
+    """
+    admin_id = order.get('admin_id') or order.get('claimed_by')
+    if not admin_id:
+        return None
+    return order.get('admin_name') or order.get('claimed_by_name') or admin_profiles.get_name(admin_id)
+
+
+class AdminRegistry:
+    """
+    الاستخدام:
+        admin_registry.is_admin_or_owner(telegram_id)
+        admin_registry.recipients()   # المالك + كل المشرفين
+        admin_registry.invalidate()   # بعد إضافة أو حذف مشرف
+    """
+
+    def __init__(self, backend=None, version_key='admin_registry:version'):
+        self._backend = backend
+        self.version_key = version_key
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._admins = None          # {telegram_id: name}
+        self._version = None
+        self._expires_at = 0
+        self._version_checked_at = 0
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _remote_version(self):
+        try:
+            return self.backend.get(self.version_key)
+        except Exception as e:
+            logger.error(f"خطأ في قراءة نسخة قائمة المشرفين: {e}")
+            return self._version
+
+    def _is_fresh(self, now):
+        if self._admins is None or now >= self._expires_at:
+            return False
+        if now - self._version_checked_at < REGISTRY_VERSION_CHECK_SECONDS:
+            return True
+        self._version_checked_at = now
+        return self._remote_version() == self._version
+
+    def _load(self):
+        admins = {}
+        if db:
+            for doc in db.collection('admins').stream():
+                data = doc.to_dict()
+                telegram_id = str(data.get('telegram_id') or '').strip()
+                if telegram_id.isdigit():
+                    admins[telegram_id] = data.get('name') or ''
+        return admins
+
+    def _snapshot(self):
+        with self._lock:
+            if self._is_fresh(time.time()):
+                return self._admins
+
+        # قراءة واحدة فقط في نفس الوقت، والبقية ينتظرون نتيجتها
+        with self._load_lock:
+            with self._lock:
+                if self._is_fresh(time.time()):
+                    return self._admins
+            version = self._remote_version()
+            try:
+                admins = self._load()
+                ttl = ADMIN_REGISTRY_TTL
+            except Exception as e:
+                logger.error(f"خطأ في جلب قائمة المشرفين: {e}")
+                admins = self._admins if self._admins is not None else {}
+                ttl = REGISTRY_RETRY_SECONDS
+            now = time.time()
+            with self._lock:
+                self._admins = admins
+                self._version = version
+                self._expires_at = now + ttl
+                self._version_checked_at = now
+
+        for telegram_id, name in admins.items():
+            admin_profiles.remember(telegram_id, name)
+        return admins
+
+    def invalidate(self):
+        """إجبار كل العمليات على إعادة قراءة القائمة"""
+        with self._lock:
+            self._expires_at = 0
+        try:
+            self.backend.set(self.version_key, uuid.uuid4().hex)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث نسخة قائمة المشرفين: {e}")
+
+    def admin_ids(self):
+        """معرفات المشرفين (بدون المالك)"""
+        return list(self._snapshot().keys())
+
+    def is_admin(self, telegram_id):
+        return str(telegram_id) in self._snapshot()
+
+    def is_admin_or_owner(self, telegram_id):
+        try:
+            if int(telegram_id) == ADMIN_ID:
+                return True
+        except (TypeError, ValueError):
+            return False
+        return self.is_admin(telegram_id)
+
+    def recipients(self):
+        """المالك أولاً ثم المشرفين (بدون تكرار)"""
+        result = [ADMIN_ID] if ADMIN_ID else []
+        for telegram_id in self.admin_ids():
+            if int(telegram_id) not in result:
+                result.append(int(telegram_id))
+        return result
+
+
+admin_registry = AdminRegistry()
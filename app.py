@@ -6,6 +6,7 @@
 
 import os
 import html
+import atexit
 import logging
 import telebot
 from telebot import types
@@ -16,7 +17,6 @@ import hashlib
 import time
 import uuid
 import requests
-from datetime import datetime
 
 # استيراد FieldFilter للنسخ الجديدة من Firestore
 try:
@@ -28,7 +28,7 @@ except ImportError:
 # === استيراد الملفات المفصولة ===
 from extensions import (
     db, FIREBASE_AVAILABLE, logger,
-    ADMIN_ID, TOKEN, SITE_URL, SECRET_KEY,
+    ADMIN_ID, SITE_URL, SECRET_KEY,
     EDFAPAY_MERCHANT_ID, EDFAPAY_PASSWORD,
     verification_codes, user_states, display_settings,
     bot, BOT_ACTIVE, BOT_USERNAME
@@ -39,17 +39,18 @@ from config import (
     CONTACT_BOT_URL, CONTACT_WHATSAPP
 )
 from firebase_utils import (
-    query_where, get_balance, add_balance, deduct_balance,
+    query_where, get_balance, deduct_balance,
     get_products, get_product_by_id, add_product, update_product, mark_product_sold, delete_product,
     get_categories, add_category, update_category, delete_category, get_category_by_id,
-    get_charge_key, use_charge_key, create_charge_key,
+    create_charge_key, redeem_charge_key,
     get_user_cart, save_user_cart, clear_user_cart, get_all_carts,
     get_all_products_for_store, get_sold_products, get_all_users, get_all_charge_keys,
     get_active_orders, get_products_by_category, count_products_in_category,
-    save_pending_payment, get_pending_payment, update_pending_payment, add_purchase_history,
+    save_pending_payment, get_pending_payment, update_pending_payment, complete_pending_payment,
+    add_purchase_history,
     get_header_settings, get_collection_data, get_collection_list,
     add_balance_log, get_balance_logs, get_all_balance_logs,
-    get_user_purchases, get_all_purchases
+    get_user_purchases, get_all_purchases, clear_cache
 )
 from payment import (
     calculate_hash, create_payment_payload,
@@ -64,8 +65,7 @@ from notifications import (
     notify_withdrawal_request, notify_new_purchase, notify_new_order,
     notify_new_user, notify_product_sold,
     notify_invoice_created, notify_payment_pending,
-    notify_payment_success, notify_payment_failed, notify_recharge_request,
-    send_order_email
+    notify_payment_success, notify_payment_failed, notify_recharge_request
 )
 
 # استيراد أدوات التشفير
@@ -85,6 +85,7 @@ from routes.web_routes import web_bp
 from routes.auth_routes import auth_bp
 from routes.payment_routes import payment_bp, set_merchant_invoices
 from routes.profile import profile_bp
+from routes.media_routes import media_bp
 
 # استيراد معالجات البوت
 from telegram import bot_handlers
@@ -118,43 +119,68 @@ app.config.update(SESSION_CONFIG)
 # --- Rate Limiting (تحديد المحاولات) ---
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from store_backend import get_limiter_storage_uri
+from scheduler import start_scheduler, stop_scheduler
+from services.charge_key_service import start_charge_keys_generation, MAX_KEYS_PER_BATCH
+from services.outbox import add_outbox_entry, telegram_payload, order_email_payload, dispatch_async
+from services.order_history import get_order_history
+from circuit_breaker import CircuitOpenError
+from deliverability_store import deliverability
+from idempotency_store import idempotent
+from admin_cache import order_admin_name
+from services.photo_service import refresh_user_photo, public_photo_url, session_photo_url
+from services.image_proxy import img_url, img_srcset
+from catalog_version import get_catalog_version
+from compression import compress_response, serve_precompressed_static
 
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
     default_limits=RATE_LIMIT_DEFAULT,
-    storage_uri="memory://",
+    storage_uri=get_limiter_storage_uri(),
 )
 
 # --- إعدادات الشريط أعلى الهيدر (حقن للقوالب) ---
 _header_settings_cache = None
 _header_settings_cache_at = 0.0
+_header_settings_cache_version = None
 _HEADER_SETTINGS_CACHE_TTL_SECONDS = 30
 
 
 @app.context_processor
 def inject_header_settings():
     """حقن إعدادات الشريط أعلى الهيدر لكل القوالب."""
-    global _header_settings_cache, _header_settings_cache_at
+    global _header_settings_cache, _header_settings_cache_at, _header_settings_cache_version
 
     try:
         now = time.time()
-        if _header_settings_cache is not None and (now - _header_settings_cache_at) < _HEADER_SETTINGS_CACHE_TTL_SECONDS:
+        version = get_catalog_version()  # تعديل الإعدادات يغير نسخة الكتالوج
+        if (_header_settings_cache is not None and _header_settings_cache_version == version
+                and (now - _header_settings_cache_at) < _HEADER_SETTINGS_CACHE_TTL_SECONDS):
             return {'header_settings': _header_settings_cache}
 
         settings = get_header_settings() if callable(get_header_settings) else {'enabled': False, 'text': '', 'link_url': ''}
         _header_settings_cache = settings
         _header_settings_cache_at = now
+        _header_settings_cache_version = version
         return {'header_settings': settings}
     except Exception:
         return {'header_settings': {'enabled': False, 'text': '', 'link_url': ''}}
 
 
+# روابط الصور المصغرة في القوالب: img_url(src, width) و img_srcset(src)
+app.jinja_env.globals.update(img_url=img_url, img_srcset=img_srcset)
+
+
 @app.context_processor
 def inject_csrf():
     """حقن CSRF token لجميع القوالب"""
     return inject_security_context()
 
+# --- ضغط الردود (gzip/brotli) ---
+# يُسجل قبل باقي after_request حتى يعمل بعدها (Flask ينفذها بترتيب عكسي)
+app.after_request(compress_response)
+
 # --- Security Headers ---
 @app.after_request
 def add_security_headers(response):
@@ -319,12 +345,6 @@ active_orders = {}
 # العمليات المعلقة (المبالغ المحجوزة) - مؤقتة
 transactions = {}
 
-# أكواد دخول لوحة التحكم المؤقتة
-admin_login_codes = {}
-
-# محاولات الدخول الفاشلة (للحماية من brute force)
-failed_login_attempts = {}
-
 # طلبات الدفع المعلقة (مؤقتة - تُحمل من Firebase)
 pending_payments = {}
 
@@ -378,11 +398,14 @@ app.register_blueprint(auth_bp)
 # تسجيل Profile Blueprint
 app.register_blueprint(profile_bp)
 
+# تسجيل Media Blueprint (صور الحسابات)
+app.register_blueprint(media_bp)
+
 # تسجيل Payment Blueprint
 set_merchant_invoices(merchant_invoices)
 app.register_blueprint(payment_bp)
 
-print("✅ تم تسجيل جميع Blueprints (السلة، المحفظة، لوحة التحكم، API، Web, Auth, Profile, Payment)")
+print("✅ تم تسجيل جميع Blueprints (السلة، المحفظة، لوحة التحكم، API، Web, Auth, Profile, Media, Payment)")
 
 # دالة تحميل جميع البيانات من Firebase عند بدء التطبيق
 def load_all_data_from_firebase():
@@ -432,40 +455,16 @@ def get_categories_list():
     return DEFAULT_CATEGORIES_FALLBACK
 
 def get_user_profile_photo(user_id):
-    """جلب صورة البروفايل من تيليجرام"""
-    try:
-        photos = bot.get_user_profile_photos(int(user_id), limit=1)
-        if photos.total_count > 0:
-            file_id = photos.photos[0][0].file_id
-            file_info = bot.get_file(file_id)
-            photo_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
-            return photo_url
-        return None
-    except Exception as e:
-        print(f"⚠️ خطأ في جلب صورة البروفايل: {e}")
-        return None
+    """رابط صورة البروفايل (تُجلب من تيليجرام وتُعرض من مسار /avatar)"""
+    fields = refresh_user_photo(user_id)
+    return fields['profile_photo'] if fields else None
 
 
 
 # دالة للتحقق من صحة الكود
 def verify_code(user_id, code):
-    user_id = str(user_id)
-    
-    if user_id not in verification_codes:
-        return None
-    
-    code_data = verification_codes[user_id]
-    
-    # ✅ التحقق من صلاحية الكود (2 دقيقة فقط بدل 10)
-    if time.time() - code_data['created_at'] > 120:  # 2 * 60 ثانية
-        del verification_codes[user_id]
-        return None
-    
-    # التحقق من تطابق الكود
-    if code_data['code'] != code:
-        return None
-    
-    return code_data
+    # ✅ الكود ينتهي تلقائياً بعد دقيقتين ويُحتسب كل تحقق كمحاولة
+    return verification_codes.verify(str(user_id), code)
 
 # --- مسارات الموقع (Flask) ---
 
@@ -480,47 +479,32 @@ def get_user_orders():
     
     user_id = str(user_id)
     
-    # جلب جميع الطلبات الخاصة بالمستخدم من Firebase
+    # صفحة من طلبات المستخدم (من الأحدث للأقدم) - ?cursor=...&limit=...
     user_orders = []
+    next_cursor = None
     
     try:
-        orders_ref = query_where(db.collection('orders'), 'buyer_id', '==', user_id)
-        for doc in orders_ref.stream():
-            order = doc.to_dict()
-            order_id = doc.id
-            
-            # إضافة اسم المشرف إذا تم استلام الطلب
-            admin_name = None
-            if order.get('admin_id'):
-                try:
-                    admin_info = bot.get_chat(order['admin_id'])
-                    admin_name = admin_info.first_name
-                except:
-                    admin_name = "مشرف"
-            
+        orders, next_cursor = get_order_history(
+            user_id,
+            limit=request.args.get('limit'),
+            cursor=request.args.get('cursor') or None
+        )
+        for order in orders:
             user_orders.append({
-                'order_id': order_id,
+                'order_id': order['id'],
                 'item_name': order.get('item_name', 'منتج'),
                 'price': order.get('price', 0),
                 'game_id': order.get('buyer_details', ''),  # تفاصيل المشتري
                 'game_name': '',
                 'status': order.get('status', 'completed'),
                 'delivery_type': order.get('delivery_type', 'instant'),
-                'admin_name': admin_name
+                'admin_name': order_admin_name(order)  # اسم المشرف إذا تم استلام الطلب (بدون تيليجرام)
             })
     except Exception as e:
         print(f"❌ خطأ في جلب الطلبات: {e}")
         # fallback للذاكرة
         for order_id, order in active_orders.items():
             if str(order.get('buyer_id')) == user_id:
-                admin_name = None
-                if order.get('admin_id'):
-                    try:
-                        admin_info = bot.get_chat(order['admin_id'])
-                        admin_name = admin_info.first_name
-                    except:
-                        admin_name = "مشرف"
-                
                 user_orders.append({
                     'order_id': order_id,
                     'item_name': order.get('item_name', 'منتج'),
@@ -529,21 +513,18 @@ def get_user_orders():
                     'game_name': order.get('game_name', ''),
                     'status': order.get('status', 'completed'),
                     'delivery_type': order.get('delivery_type', 'instant'),
-                    'admin_name': admin_name
+                    'admin_name': order_admin_name(order)
                 })
+        # ترتيب الطلبات من الأحدث للأقدم
+        user_orders.reverse()
     
-    # ترتيب الطلبات من الأحدث للأقدم
-    user_orders.reverse()
-    
-    return {'orders': user_orders}
+    return {'orders': user_orders, 'next_cursor': next_cursor}
 
 # ✅ API endpoint لإرسال كود التحقق للمستخدم
 @app.route('/api/send_code', methods=['POST'])
 @limiter.limit("3 per minute")  # 🔒 منع الإساءة
 def api_send_code():
     """إرسال كود التحقق للمستخدم عبر Telegram Bot"""
-    global verification_codes
-    
     try:
         data = request.get_json()
         user_id = data.get('user_id', '').strip()
@@ -564,16 +545,9 @@ def api_send_code():
         except Exception as e:
             return jsonify({'success': False, 'message': f'لم نتمكن من العثور على هذا الآيدي في Telegram'}), 404
         
-        # توليد كود عشوائي 6 أرقام
-        code = str(random.randint(100000, 999999))
-        
-        # حفظ الكود في الذاكرة مع الـ timestamp
+        # توليد كود عشوائي 6 أرقام وحفظه
         # ✅ الكود صالح لـ 2 دقيقة
-        verification_codes[user_id] = {
-            'code': code,
-            'name': user_name,
-            'created_at': time.time()
-        }
+        code = verification_codes.issue(user_id, name=user_name)
         
         # ✅ إعادة تعيين المحاولات الفاشلة عند طلب كود جديد
         from security_utils import reset_failed_attempts
@@ -657,15 +631,8 @@ def send_code_by_phone():
         user_data = user_doc.to_dict()
         user_name = user_data.get('name', user_data.get('first_name', 'مستخدم'))
         
-        # توليد كود عشوائي 6 أرقام
-        code = str(random.randint(100000, 999999))
-        
-        # حفظ الكود في الذاكرة
-        verification_codes[user_id] = {
-            'code': code,
-            'name': user_name,
-            'created_at': time.time()
-        }
+        # توليد كود عشوائي 6 أرقام وحفظه
+        code = verification_codes.issue(user_id, name=user_name)
         
         # إعادة تعيين المحاولات الفاشلة
         from security_utils import reset_failed_attempts
@@ -723,9 +690,8 @@ def verify_login():
     
     # ✅ فحص انتهاء صلاحية الكود بسبب محاولات خاطئة
     if is_code_expired_due_to_wrong_attempts(user_id):
-        # حذف الكود من الذاكرة لمنع أي محاولات إضافية
-        if user_id in verification_codes:
-            del verification_codes[user_id]
+        # حذف الكود لمنع أي محاولات إضافية
+        verification_codes.discard(user_id)
         log_security_event('CODE_EXPIRED_TOO_MANY_ATTEMPTS', user_id, 'تم محاولة 3 مرات')
         return {
             'success': False, 
@@ -744,9 +710,8 @@ def verify_login():
         error_msg = f'❌ الكود غير صحيح\n\n🔄 محاولات متبقية: {remaining}/3'
         
         if action == 'code_expired':
-            # حذف الكود من الذاكرة عند المحاولة الثالثة الفاشلة
-            if user_id in verification_codes:
-                del verification_codes[user_id]
+            # حذف الكود عند المحاولة الثالثة الفاشلة
+            verification_codes.discard(user_id)
             log_security_event('CODE_WRONG_ATTEMPT', user_id, f'محاولة 3/3')
             return {
                 'success': False, 
@@ -757,7 +722,11 @@ def verify_login():
         log_security_event('CODE_WRONG_ATTEMPT', user_id, f'محاولة {3-remaining}/3')
         return {'success': False, 'message': error_msg}, 401
     
-    # ✅ كود صحيح - إعادة تعيين المحاولات
+    # ✅ كود صحيح - حذف الكود (استخدام لمرة واحدة حتى مع الطلبات المتزامنة)
+    if not verification_codes.consume(user_id):
+        return {'success': False, 'message': '❌ تم استخدام هذا الكود مسبقاً'}, 401
+    
+    # إعادة تعيين المحاولات
     reset_failed_attempts(user_id)
     
     # 🔐 التحقق من تفعيل المصادقة الثنائية (2FA)
@@ -771,8 +740,6 @@ def verify_login():
                 session['pending_2fa_user_id'] = user_id
                 session['pending_2fa_user_name'] = code_data['name']
                 session['pending_2fa_time'] = time.time()
-                # حذف الكود بعد الاستخدام
-                del verification_codes[user_id]
                 return {
                     'success': True,
                     'requires_2fa': True,
@@ -790,31 +757,23 @@ def verify_login():
     session['user_name'] = code_data['name']
     session['login_time'] = time.time()  # وقت تسجيل الدخول
 
-    # حذف الكود بعد الاستخدام
-    if user_id in verification_codes:
-        del verification_codes[user_id]
-
     # جلب الرصيد
     balance = get_balance(user_id)
 
-    # جلب صورة الحساب من تيليجرام أو Firebase
+    # جلب صورة الحساب (من Firebase، أو من تيليجرام أول مرة)
     profile_photo_url = None
     try:
-        # أولاً: محاولة جلب من Firebase
         user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists:
-            profile_photo_url = user_doc.to_dict().get('profile_photo')
-        
-        # ثانياً: إذا لم توجد، جلب من تيليجرام مباشرة
-        if not profile_photo_url:
-            photos = bot.get_user_profile_photos(int(user_id), limit=1)
-            if photos.total_count > 0:
-                file_id = photos.photos[0][0].file_id
-                file_info = bot.get_file(file_id)
-                token = bot.token
-                profile_photo_url = f"https://api.telegram.org/file/bot{token}/{file_info.file_path}"
-                # حفظ في Firebase للاستخدام لاحقاً
-                db.collection('users').document(user_id).update({'profile_photo': profile_photo_url})
+        user_data = user_doc.to_dict() if user_doc.exists else {}
+        if user_data.get('profile_photo_unique_id'):
+            profile_photo_url = public_photo_url(user_id, user_data)
+        else:
+            # صورة جديدة أو رابط قديم يحتوي التوكن: تحميلها للكاش المحلي وحفظ معرفها
+            photo_fields = refresh_user_photo(user_id)
+            if photo_fields:
+                profile_photo_url = photo_fields['profile_photo']
+                if user_doc.exists:
+                    db.collection('users').document(user_id).update(photo_fields)
     except Exception as e:
         print(f"⚠️ خطأ في جلب صورة الحساب: {e}")
     
@@ -891,7 +850,7 @@ def verify_2fa_login():
         
         # جلب الرصيد والصورة
         balance = get_balance(user_id)
-        profile_photo_url = user_data.get('profile_photo')
+        profile_photo_url = public_photo_url(user_id, user_data)
         
         if profile_photo_url:
             session['profile_photo'] = profile_photo_url
@@ -919,6 +878,10 @@ def check_session_validity():
             session.clear()
             print("⏰ انتهت صلاحية الجلسة")
 
+# --- ملفات static المضغوطة مسبقاً ---
+# تُسجل بعد فحوصات الأمان (before_request تُنفذ بترتيب التسجيل) حتى لا تتجاوزها
+app.before_request(serve_precompressed_static)
+
 @app.route('/robots.txt')
 def robots_txt():
     """ملف robots.txt للمحركات البحث"""
@@ -941,7 +904,7 @@ def index():
     # ✅ جلب معلومات المستخدم (إن وجدت)
     user_id = session.get('user_id')
     user_name = session.get('user_name', 'ضيف')
-    profile_photo = session.get('profile_photo', '')
+    profile_photo = session_photo_url(session)
     is_logged_in = bool(user_id)
     
     # 1. جلب الرصيد
@@ -953,7 +916,7 @@ def index():
                 user_data = user_doc.to_dict()
                 balance = user_data.get('balance', 0.0)
                 if not profile_photo:
-                    profile_photo = user_data.get('profile_photo', '')
+                    profile_photo = public_photo_url(user_id, user_data)
         except:
             balance = get_balance(user_id)
     
@@ -1033,44 +996,25 @@ def charge_balance_api():
     if not key_code:
         return jsonify({'success': False, 'message': 'الرجاء إدخال كود الشحن'})
     
-    # البحث عن الكود في Firebase مباشرة
-    key_data = get_charge_key(key_code)
+    # Transaction واحدة: التحقق من الكود + تعليمه مستخدماً + الرصيد + السجلات
+    try:
+        result = redeem_charge_key(key_code, user_id, method='key')
+    except Exception as e:
+        print(f"❌ خطأ في شحن الكود: {e}")
+        return jsonify({'success': False, 'message': 'حدث خطأ، حاول لاحقاً'})
     
-    # التحقق من وجود الكود
-    if not key_data:
+    if result['result'] == 'not_found':
         return jsonify({'success': False, 'message': 'كود الشحن غير صحيح أو غير موجود'})
     
-    # التحقق من أن الكود لم يستخدم
-    if key_data.get('used', False):
+    if result['result'] == 'used':
         return jsonify({'success': False, 'message': 'هذا الكود تم استخدامه مسبقاً'})
     
-    # شحن الرصيد
-    amount = key_data.get('amount', 0)
-    new_balance = add_balance(user_id, amount)
+    amount = result['amount']
+    new_balance = result['new_balance']
+    print(f"✅ تم شحن الكود: {amount} ريال للمستخدم {user_id}")
     
-    # تحديث الكود كمستخدم
-    use_charge_key(key_code, user_id)
-    
-    # حفظ سجل الشحنة
-    if db:
-        try:
-            from datetime import datetime
-            import time as time_module
-            db.collection('charge_history').add({
-                'user_id': user_id,
-                'amount': amount,
-                'key_code': key_code,
-                'method': 'key',
-                'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'type': 'charge'
-            })
-            print(f"✅ تم تسجيل شحنة الكود في charge_history: {amount} ريال للمستخدم {user_id}")
-            
-            # إشعار المالك بالشحن
-            notify_new_charge(user_id, amount, method='key')
-        except Exception as e:
-            print(f"خطأ في حفظ سجل الشحن: {e}")
+    # إشعار المالك بالشحن (بعد نجاح الـ commit)
+    notify_new_charge(user_id, amount, method='key')
     
     return jsonify({
         'success': True, 
@@ -1106,6 +1050,7 @@ def sell_item():
 
 @app.route('/buy', methods=['POST'])
 @limiter.limit("10 per minute")  # 🔒 Rate Limiting: منع الشراء الآلي
+@idempotent('buy')  # 🔁 الضغط المزدوج يأخذ نفس الرد بدون شراء ثانٍ
 def buy_item():
     try:
         data = request.json
@@ -1149,18 +1094,32 @@ def buy_item():
 
         price = float(item.get('price', 0))
 
-        # 3. التحقق الفعلي من إمكانية إرسال رسالة للمشتري (قبل إتمام الشراء)
-        # نرسل رسالة حقيقية لأن chat_action لا تفشل حتى لو المستخدم حظر البوت
-        try:
-            test_msg = bot.send_message(
-                int(buyer_id),
-                "🛒",  # رسالة قصيرة جداً
-                disable_notification=True  # بدون صوت إشعار
-            )
-            bot.delete_message(int(buyer_id), test_msg.message_id)
-            print(f"✅ تم التحقق من إمكانية إرسال الرسائل للمشتري {buyer_id}")
-        except Exception as e:
-            print(f"❌ فشل التحقق من المشتري {buyer_id}: {e}")
+        # 3. التحقق من إمكانية إرسال رسالة للمشتري (قبل إتمام الشراء)
+        # الحالة محفوظة من آخر إرسال ناجح أو حظر أو تحديث my_chat_member
+        # والرسالة التجريبية (إرسال + حذف) فقط عندما تكون الحالة غير معروفة أو منتهية
+        deliverable = deliverability.get(buyer_id)
+        probe_error = None
+        if deliverable is None:
+            # نرسل رسالة حقيقية لأن chat_action لا تفشل حتى لو المستخدم حظر البوت
+            try:
+                test_msg = bot.send_message(
+                    int(buyer_id),
+                    "🛒",  # رسالة قصيرة جداً
+                    disable_notification=True  # بدون صوت إشعار
+                )
+                bot.delete_message(int(buyer_id), test_msg.message_id)
+                deliverable = True
+                print(f"✅ تم التحقق من إمكانية إرسال الرسائل للمشتري {buyer_id}")
+            except CircuitOpenError:
+                # ⚡ تيليجرام متوقف حالياً: نكمل الشراء والبيانات تُرسل عند عودته
+                deliverable = True
+                print(f"⚡ تخطي التحقق من المشتري {buyer_id} - تيليجرام غير متاح مؤقتاً")
+            except Exception as e:
+                deliverable = False
+                probe_error = e
+
+        if not deliverable:
+            print(f"❌ لا يمكن مراسلة المشتري {buyer_id}: {probe_error or 'محظور (من الحالة المحفوظة)'}")
             # إنشاء رسالة الخطأ مع رابط البوت
             bot_link = f"@{BOT_USERNAME}" if BOT_USERNAME else "البوت"
             error_msg = f'⚠️ لا يمكن إرسال البيانات لك!\n\nتأكد أنك:\n1. لم تحظر البوت {bot_link}\n2. لم تحذف المحادثة معه\n\nأو اذهب للبوت واضغط /start ثم حاول مرة أخرى'
@@ -1221,87 +1180,51 @@ def buy_item():
             'created_at': firestore.SERVER_TIMESTAMP
         })
 
-        # تنفيذ التغييرات
-        try:
-            batch.commit()
-            print(f"✅ تم حفظ الطلب في Firebase: {order_id} (نوع: {delivery_type})")
-        except Exception as batch_error:
-            print(f"❌ فشل حفظ الطلب في Firebase: {batch_error}")
-            return {'status': 'error', 'message': 'فشل حفظ الطلب! حاول مرة أخرى'}
-        
-        # التحقق من حفظ الطلب (للتسليم اليدوي فقط)
-        if delivery_type == 'manual':
-            try:
-                verify_order = db.collection('orders').document(order_id).get()
-                if verify_order.exists:
-                    print(f"✅ تم التحقق من وجود الطلب: {order_id}")
-                else:
-                    print(f"⚠️ الطلب غير موجود بعد الحفظ: {order_id}")
-            except Exception as verify_error:
-                print(f"⚠️ فشل التحقق من الطلب: {verify_error}")
-
-        # 5. إرسال المنتج للمشتري أو إشعار الأدمن
-        # فك تشفير البيانات السرية قبل الإرسال
+        # 5. آثار ما بعد الشراء (رسائل المشتري والمشرفين والإيميل) تُكتب في الصادر
+        # ضمن نفس الـ batch، وتُرسل في الخلفية بعد الحفظ
+        # فك تشفير البيانات السرية لبناء الرسالة (تُحفظ الرسالة مشفرة في الصادر)
         raw_hidden = item.get('hidden_data', '')
         hidden_info = decrypt_data(raw_hidden) if raw_hidden else 'لا توجد بيانات'
-        message_sent = False
-        
+        outbox_ids = []
+
         if delivery_type == 'instant':
-            # تسليم فوري - إرسال البيانات مباشرة للمشتري
-            try:
-                bot.send_message(
-                    int(buyer_id),
-                    f"✅ تم الشراء بنجاح!\n\n"
-                    f"📦 المنتج: {item.get('item_name')}\n"
-                    f"💰 السعر: {price} ريال\n"
-                    f"🆔 رقم الطلب: #{order_id}\n\n"
-                    f"🔐 بيانات الاشتراك:\n{hidden_info}\n\n"
-                    f"⚠️ احفظ هذه البيانات في مكان آمن!"
-                )
-                message_sent = True
-                print(f"✅ تم إرسال بيانات المنتج للمشتري {buyer_id}")
-                
-                # إشعار للمالك
-                bot.send_message(
-                    ADMIN_ID,
-                    f"🔔 عملية بيع جديدة!\n"
-                    f"📦 المنتج: {item.get('item_name')}\n"
-                    f"👤 المشتري: {buyer_name} ({buyer_id})\n"
-                    f"💰 السعر: {price} ريال\n"
-                    f"✅ تم إرسال البيانات للمشتري"
-                )
-            except Exception as e:
-                print(f"⚠️ فشل إرسال الرسالة للمشتري {buyer_id}: {e}")
-                # إشعار المالك بالفشل
-                try:
-                    bot.send_message(
-                        ADMIN_ID,
-                        f"⚠️ تنبيه: فشل إرسال بيانات المنتج!\n"
-                        f"📦 المنتج: {item.get('item_name')}\n"
-                        f"👤 المشتري: {buyer_name} ({buyer_id})\n"
-                        f"🔐 البيانات: {hidden_info}\n"
-                        f"❌ السبب: {str(e)}"
-                    )
-                except:
-                    pass
+            # تسليم فوري - البيانات للمشتري، وإذا رفض تيليجرام الإرسال تصل للمالك بدلاً منه
+            outbox_ids.append(add_outbox_entry(batch, 'telegram_message', telegram_payload(
+                buyer_id,
+                f"✅ تم الشراء بنجاح!\n\n"
+                f"📦 المنتج: {item.get('item_name')}\n"
+                f"💰 السعر: {price} ريال\n"
+                f"🆔 رقم الطلب: #{order_id}\n\n"
+                f"🔐 بيانات الاشتراك:\n{hidden_info}\n\n"
+                f"⚠️ احفظ هذه البيانات في مكان آمن!",
+                fallback=(ADMIN_ID,
+                          f"⚠️ تنبيه: فشل إرسال بيانات المنتج!\n"
+                          f"📦 المنتج: {item.get('item_name')}\n"
+                          f"👤 المشتري: {buyer_name} ({buyer_id})\n"
+                          f"🔐 البيانات: {hidden_info}")
+            ), entry_id=f"{order_id}-buyer"))
+
+            # إشعار للمالك
+            outbox_ids.append(add_outbox_entry(batch, 'telegram_message', telegram_payload(
+                ADMIN_ID,
+                f"🔔 عملية بيع جديدة!\n"
+                f"📦 المنتج: {item.get('item_name')}\n"
+                f"👤 المشتري: {buyer_name} ({buyer_id})\n"
+                f"💰 السعر: {price} ريال"
+            ), entry_id=f"{order_id}-owner"))
         else:
-            # تسليم يدوي - إشعار المشتري بانتظار التنفيذ وإرسال للأدمنز
-            try:
-                bot.send_message(
-                    int(buyer_id),
-                    f"⏳ تم استلام طلبك!\n\n"
-                    f"📦 المنتج: {item.get('item_name')}\n"
-                    f"💰 السعر: {price} ريال\n"
-                    f"🆔 رقم الطلب: #{order_id}\n\n"
-                    f"👨‍💼 طلبك بانتظار التنفيذ من قبل الإدارة\n"
-                    f"📲 سيتم إرسال البيانات لك فور تنفيذ الطلب"
-                )
-                message_sent = True
-                print(f"✅ تم إشعار المشتري {buyer_id} بانتظار التنفيذ")
-            except Exception as e:
-                print(f"⚠️ فشل إرسال رسالة الانتظار للمشتري {buyer_id}: {e}")
-            
-            # إرسال إشعار لجميع الأدمنز مع زر التنفيذ
+            # تسليم يدوي - إشعار المشتري بانتظار التنفيذ
+            outbox_ids.append(add_outbox_entry(batch, 'telegram_message', telegram_payload(
+                buyer_id,
+                f"⏳ تم استلام طلبك!\n\n"
+                f"📦 المنتج: {item.get('item_name')}\n"
+                f"💰 السعر: {price} ريال\n"
+                f"🆔 رقم الطلب: #{order_id}\n\n"
+                f"👨‍💼 طلبك بانتظار التنفيذ من قبل الإدارة\n"
+                f"📲 سيتم إرسال البيانات لك فور تنفيذ الطلب"
+            ), entry_id=f"{order_id}-buyer"))
+
+            # إشعار المالك مع زر التنفيذ
             claim_markup = telebot.types.InlineKeyboardMarkup()
             claim_markup.add(telebot.types.InlineKeyboardButton(
                 "📋 استلام الطلب", 
@@ -1323,20 +1246,13 @@ def buy_item():
                 f"{hidden_buyer_details}\n\n"
                 f"👇 اضغط لاستلام وعرض التفاصيل"
             )
-            
-            # إرسال للمالك الرئيسي
-            try:
-                bot.send_message(ADMIN_ID, admin_message, reply_markup=claim_markup)
-            except:
-                pass
-            
+            outbox_ids.append(add_outbox_entry(batch, 'telegram_message', telegram_payload(
+                ADMIN_ID, admin_message, reply_markup=claim_markup
+            ), entry_id=f"{order_id}-owner"))
 
-
-        # إرجاع البيانات للموقع
+        # إرسال بيانات الطلب بالإيميل (إذا مربوط ومفعّل)
         # ⚠️ إصلاح أمني: لا نرسل hidden_data في الـ response
         # البيانات تُرسل فقط عبر Telegram والإيميل للأمان
-
-        # إرسال بيانات الطلب بالإيميل (إذا مربوط ومفعّل)
         buyer_email = user_data.get('email', '')
         if buyer_email and user_data.get('email_verified', False):
             email_item = {
@@ -1347,15 +1263,29 @@ def buy_item():
             }
             if delivery_type == 'instant' and raw_hidden:
                 email_item['hidden_data'] = hidden_info
-            send_order_email(buyer_email, [email_item], price, new_balance)
+            outbox_ids.append(add_outbox_entry(
+                batch, 'order_email', order_email_payload(buyer_email, [email_item], price, new_balance),
+                entry_id=f"{order_id}-email"
+            ))
+
+        # تنفيذ التغييرات (الطلب وآثاره معاً)
+        try:
+            batch.commit()
+            print(f"✅ تم حفظ الطلب في Firebase: {order_id} (نوع: {delivery_type})")
+        except Exception as batch_error:
+            print(f"❌ فشل حفظ الطلب في Firebase: {batch_error}")
+            return {'status': 'error', 'message': 'فشل حفظ الطلب! حاول مرة أخرى'}
+
+        clear_cache('products')  # المنتج أصبح مباعاً (نسخة كتالوج جديدة)
+        dispatch_async(outbox_ids)
 
         return {
             'status': 'success',
             'order_id': order_id,
-            'message_sent': message_sent,
+            'message_queued': True,
             'new_balance': new_balance,
             'delivery_type': delivery_type,
-            'message': 'تم الشراء بنجاح! تم إرسال البيانات لك عبر Telegram' if delivery_type == 'instant' else 'تم استلام طلبك وسيتم تنفيذه قريباً'
+            'message': 'تم الشراء بنجاح! ستصلك البيانات عبر Telegram خلال لحظات' if delivery_type == 'instant' else 'تم استلام طلبك وسيتم تنفيذه قريباً'
         }
 
     except Exception as e:
@@ -1421,18 +1351,22 @@ def process_edfapay_callback(req, source):
         amount = data.get('order_amount', '') or data.get('amount', '') or data.get('trans_amount', '')
         received_hash = data.get('hash', '')
         
+        # قراءة الطلب مرة واحدة (الذاكرة ثم Firebase) - الحالة النهائية تُحسم داخل الـ Transaction
+        payment_data = None
+        if order_id:
+            payment_data = pending_payments.get(order_id)
+            if not payment_data:
+                try:
+                    doc = db.collection('pending_payments').document(order_id).get()
+                    if doc.exists:
+                        payment_data = doc.to_dict()
+                except Exception as e:
+                    print(f"⚠️ خطأ في البحث في Firebase: {e}")
+        
         # التحقق من أن الطلب من EdfaPay وليس مزيف
         if order_id and EDFAPAY_PASSWORD:
             # 1️⃣ التحقق من وجود الطلب في النظام أولاً
-            payment_exists = order_id in pending_payments
-            if not payment_exists:
-                try:
-                    doc = db.collection('pending_payments').document(order_id).get()
-                    payment_exists = doc.exists
-                except:
-                    pass
-            
-            if not payment_exists:
+            if not payment_data:
                 print(f"🚫 محاولة webhook مزيفة! order_id غير موجود: {order_id}")
                 # إرسال تنبيه أمني للمالك
                 try:
@@ -1456,14 +1390,7 @@ _قد تكون محاولة اختراق!_
                 return jsonify({'status': 'error', 'message': 'Invalid order'}), 403
             
             # 2️⃣ التحقق من أن المبلغ المرسل يطابق المبلغ الأصلي
-            original_payment = pending_payments.get(order_id)
-            if not original_payment:
-                try:
-                    doc = db.collection('pending_payments').document(order_id).get()
-                    if doc.exists:
-                        original_payment = doc.to_dict()
-                except:
-                    pass
+            original_payment = payment_data
             
             if original_payment and amount:
                 original_amount = float(original_payment.get('amount', 0))
@@ -1572,103 +1499,59 @@ _محاولة اختراق واضحة!_
         if status_upper in SUCCESS_STATUSES:
             print(f"✅ EdfaPay: عملية ناجحة - {status}")
             
-            # البحث عن الطلب في الذاكرة
-            payment_data = pending_payments.get(order_id)
-            
-            # البحث في Firebase إذا لم يوجد في الذاكرة
-            if not payment_data:
-                try:
-                    doc = db.collection('pending_payments').document(order_id).get()
-                    if doc.exists:
-                        payment_data = doc.to_dict()
-                        print(f"📥 تم جلب الطلب من Firebase")
-                except Exception as e:
-                    print(f"⚠️ خطأ في البحث في Firebase: {e}")
-            
             # التحقق من أن الطلب لم يُعالج مسبقاً (حماية من Replay Attack)
             if payment_data and payment_data.get('status') == 'completed':
                 print(f"⚠️ محاولة إعادة استخدام webhook! الطلب {order_id} تم معالجته مسبقاً")
                 return jsonify({'status': 'ok', 'message': 'Already processed'}), 200
             
-            if payment_data and payment_data.get('status') != 'completed':
-                user_id = str(payment_data.get('user_id', ''))
-                pay_amount = float(payment_data.get('amount', amount or 0))
-                is_merchant_invoice = payment_data.get('is_merchant_invoice', False)
-                invoice_id = payment_data.get('invoice_id', '')
-                
-                if not user_id:
-                    print(f"❌ لا يوجد user_id في الطلب")
-                    return jsonify({'status': 'error', 'message': 'Missing user_id'}), 400
-                
-                # ✅ إضافة الرصيد
-                add_balance(user_id, pay_amount)
+            # ✅ Transaction واحدة: التحقق من الحالة + الرصيد + السجلات + status=completed
+            # (طلبان متزامنان لنفس الطلب: واحد فقط يضيف الرصيد)
+            try:
+                result = complete_pending_payment(order_id, trans_id=trans_id, gateway_status=status, payment_data=data)
+            except Exception as e:
+                print(f"❌ خطأ في إكمال الدفعة {order_id}: {e}")
+                return jsonify({'status': 'error', 'message': 'Processing failed'}), 500
+            
+            if result['result'] == 'already_processed':
+                print(f"⚠️ محاولة إعادة استخدام webhook! الطلب {order_id} تم معالجته مسبقاً")
+                if order_id in pending_payments:
+                    pending_payments[order_id]['status'] = 'completed'
+                return jsonify({'status': 'ok', 'message': 'Already processed'}), 200
+            
+            if result['result'] == 'missing_user':
+                print(f"❌ لا يوجد user_id في الطلب")
+                return jsonify({'status': 'error', 'message': 'Missing user_id'}), 400
+            
+            if result['result'] == 'completed':
+                user_id = result['user_id']
+                pay_amount = result['amount']
+                new_balance = result['new_balance']
+                is_merchant_invoice = result['is_merchant_invoice']
+                invoice_id = result['invoice_id']
                 print(f"✅ تم إضافة {pay_amount} ريال للمستخدم {user_id}")
                 
-                # ✅ إشعار المالك بالشحن
+                # الإشعارات بعد نجاح الـ commit فقط
                 notify_new_charge(user_id, pay_amount, method='edfapay')
                 
-                # ✅ تسجيل في سجل الشحنات للسحب
-                try:
-                    db.collection('charge_history').add({
-                        'user_id': user_id,
-                        'amount': pay_amount,
-                        'method': 'edfapay',
-                        'order_id': order_id,
-                        'timestamp': time.time(),
-                        'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
-                        'type': 'payment'
-                    })
-                    print(f"✅ تم تسجيل الشحنة في charge_history")
-                except Exception as e:
-                    print(f"⚠️ خطأ في تسجيل charge_history: {e}")
-                
                 # تحديث في الذاكرة
                 if order_id in pending_payments:
                     pending_payments[order_id]['status'] = 'completed'
                 
-                # تحديث في Firebase
-                try:
-                    db.collection('pending_payments').document(order_id).update({
-                        'status': 'completed',
-                        'completed_at': firestore.SERVER_TIMESTAMP,
-                        'trans_id': trans_id,
-                        'edfapay_status': status,
-                        'payment_data': data
-                    })
-                except Exception as e:
-                    print(f"⚠️ خطأ في تحديث Firebase: {e}")
-                
                 # ===== إشعارات مختلفة حسب نوع الدفع =====
                 
                 if is_merchant_invoice and invoice_id:
-                    # 🔹 فاتورة تاجر - إشعار التاجر
-                    try:
-                        # تحديث حالة الفاتورة
-                        if invoice_id in merchant_invoices:
-                            merchant_invoices[invoice_id]['status'] = 'completed'
-                        
-                        db.collection('merchant_invoices').document(invoice_id).update({
-                            'status': 'completed',
-                            'completed_at': firestore.SERVER_TIMESTAMP
-                        })
-                    except:
-                        pass
+                    # 🔹 فاتورة تاجر (حالتها تحدّثت داخل الـ Transaction)
+                    if invoice_id in merchant_invoices:
+                        merchant_invoices[invoice_id]['status'] = 'completed'
                     
                     # إشعار التاجر
                     try:
-                        new_balance = get_balance(user_id)
-                        # جلب رقم العميل للمالك فقط
+                        # رقم العميل للمالك فقط
                         customer_phone = ''
-                        if invoice_id:
-                            if invoice_id in merchant_invoices:
-                                customer_phone = merchant_invoices[invoice_id].get('customer_phone', '')
-                            if not customer_phone:
-                                try:
-                                    inv_doc = db.collection('merchant_invoices').document(invoice_id).get()
-                                    if inv_doc.exists:
-                                        customer_phone = inv_doc.to_dict().get('customer_phone', '')
-                                except:
-                                    pass
+                        if invoice_id in merchant_invoices:
+                            customer_phone = merchant_invoices[invoice_id].get('customer_phone', '')
+                        if not customer_phone:
+                            customer_phone = result['invoice'].get('customer_phone', '')
                         if not customer_phone:
                             customer_phone = 'غير محدد'
                         
@@ -1704,7 +1587,6 @@ _محاولة اختراق واضحة!_
                 else:
                     # 🔹 شحن عادي - إشعار المستخدم
                     try:
-                        new_balance = get_balance(user_id)
                         bot.send_message(
                             int(user_id),
                             f"✅ *تم شحن رصيدك بنجاح!*\n\n"
@@ -1732,10 +1614,6 @@ _محاولة اختراق واضحة!_
                 
                 return jsonify({'status': 'success', 'message': 'Payment processed'})
             
-            elif payment_data and payment_data.get('status') == 'completed':
-                print(f"⚠️ الطلب {order_id} تم معالجته مسبقاً")
-                return jsonify({'status': 'success', 'message': 'Already processed'})
-            
             else:
                 print(f"❌ الطلب {order_id} غير موجود")
                 return jsonify({'status': 'error', 'message': 'Order not found'}), 404
@@ -1744,17 +1622,7 @@ _محاولة اختراق واضحة!_
         elif status_upper in FAILED_STATUSES:
             print(f"❌ EdfaPay: عملية مرفوضة - {status}")
             
-            # البحث عن بيانات الطلب لإرسال إشعار للعميل
-            payment_data = pending_payments.get(order_id)
-            if not payment_data:
-                try:
-                    doc = db.collection('pending_payments').document(order_id).get()
-                    if doc.exists:
-                        payment_data = doc.to_dict()
-                except:
-                    pass
-            
-            # تحديث حالة الطلب
+            # تحديث حالة الطلب (بيانات الطلب مقروءة مسبقاً لإشعار العميل)
             try:
                 db.collection('pending_payments').document(order_id).update({
                     'status': 'failed',
@@ -2036,33 +1904,21 @@ def api_generate_keys():
         amount = float(data.get('amount'))
         count = int(data.get('count', 1))
         
-        if amount <= 0 or count <= 0 or count > 100:
+        if amount <= 0 or count <= 0 or count > MAX_KEYS_PER_BATCH:
             return {'status': 'error', 'message': 'أرقام غير صحيحة'}
         
-        generated_keys = []
-        batch = db.batch() # استخدام الدفعات للحفظ السريع
+        # أكواد آمنة + إنشاء فقط + دفعات متوازية (انظر services/charge_key_service.py)
+        # التوليد في الخلفية: اللوحة تتابع الحالة من status_url ثم تحمّل الملف
+        batch_id = start_charge_keys_generation(amount, count, created_by='admin_panel')
         
-        for _ in range(count):
-            # إنشاء كود عشوائي
-            key_code = f"KEY-{random.randint(10000, 99999)}-{random.randint(1000, 9999)}"
-            
-            key_data = {
-                'amount': amount,
-                'used': False,
-                'used_by': None,
-                'created_at': firestore.SERVER_TIMESTAMP
-            }
-            
-            # تجهيز الحفظ في Firebase
-            doc_ref = db.collection('charge_keys').document(key_code)
-            batch.set(doc_ref, key_data)
-            
-            generated_keys.append(key_code)
-            
-        # تنفيذ الحفظ في Firebase دفعة واحدة
-        batch.commit()
-        
-        return {'status': 'success', 'keys': generated_keys}
+        return {
+            'status': 'success',
+            'batch_id': batch_id,
+            'count': count,
+            'state': 'generating',
+            'status_url': f"/api/charge_keys/batch/{batch_id}",
+            'download_url': f"/api/charge_keys/batch/{batch_id}/export?format=csv"
+        }
 
     except Exception as e:
         print(f"Error generating keys: {e}")
@@ -2705,6 +2561,10 @@ def api_set_display_settings():
 print("🚀 بدء تشغيل التطبيق...")
 load_all_data_from_firebase()
 
+# المهام المجدولة (تذكيرات المحاسبة...) - عملية واحدة فقط تنفذها عبر عقد في Firestore
+atexit.register(stop_scheduler)
+start_scheduler()
+
 if __name__ == "__main__":
     # هذا السطر يجعل البوت يعمل على المنفذ الصحيح في ريندر أو 10000 في جهازك
     port = int(os.environ.get("PORT", 10000))
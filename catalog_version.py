@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+رقم نسخة الكتالوج
+=================
+رقم واحد يتغير مع أي تعديل على ما يظهر في واجهة المتجر
+(إضافة/تعديل/حذف منتج أو قسم، بيع منتج، إعدادات العرض).
+
+يُستخدم في:
+- ETag لصفحات وواجهات الكتالوج (304 بدون أي قراءة من Firestore)
+- صلاحية كاش المنتجات والأقسام في ذاكرة كل عملية
+  (تعديل من عملية يُسقط كاش كل العمليات الأخرى)
+
+يُحفظ في المخزن المشترك (Redis أو الذاكرة المحلية)
+"""
+
+import time
+import uuid
+import logging
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def _new_version():
+    return f"{int(time.time() * 1000):x}-{uuid.uuid4().hex[:8]}"
+
+
+def get_catalog_version():
+    """رقم النسخة الحالي (يُنشأ عند أول استخدام)"""
+    backend = get_backend()
+    try:
+        version = backend.get(CATALOG_VERSION_KEY)
+        if version:
+            return version
+        backend.set(CATALOG_VERSION_KEY, _new_version(), nx=True)
+        return backend.get(CATALOG_VERSION_KEY) or '0'
+    except Exception as e:
+        logger.error(f"خطأ في قراءة نسخة الكتالوج: {e}")
+        return _new_version()  # نسخة فريدة: لا 304 ولا كاش حتى يعود المخزن
+
+
+def bump_catalog_version():
+    """تغيير رقم النسخة بعد أي تعديل على الكتالوج"""
+    version = _new_version()
+    try:
+        get_backend().set(CATALOG_VERSION_KEY, version)
+    except Exception as e:
+        logger.error(f"خطأ في تحديث نسخة الكتالوج: {e}")
+    return version
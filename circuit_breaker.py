@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+قواطع الدائرة (Circuit Breakers)
+================================
+حماية المتجر من بطء أو توقف الخدمات الخارجية (Telegram, EdfaPay, Authentica, SMTP):
+
+- closed: الطلبات تمر عادياً، وتُحسب نسبة الأخطاء والبطء في نافذة زمنية متحركة
+- open: عند تجاوز النسبة تُرفض الطلبات فوراً (بدون انتظار المهلة) لفترة محددة
+- half_open: بعد انتهاء الفترة تمر محاولة تجريبية، نجاحها يعيد القاطع للوضع الطبيعي
+
+الحالة محلية لكل عملية (worker) - الهدف قرار سريع بدون أي اتصال إضافي
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# الإعدادات الافتراضية
+DEFAULT_WINDOW_SECONDS = 60       # طول النافذة المتحركة
+DEFAULT_MIN_CALLS = 5             # أقل عدد طلبات في النافذة قبل الحكم على الخدمة
+DEFAULT_FAILURE_RATE = 0.5        # نسبة الأخطاء التي تفتح القاطع
+DEFAULT_SLOW_CALL_MS = 5000       # الطلب الأبطأ من هذا يُعتبر بطيئاً
+DEFAULT_SLOW_RATE = 0.8           # نسبة الطلبات البطيئة التي تفتح القاطع
+DEFAULT_OPEN_SECONDS = 30         # مدة الرفض الفوري قبل المحاولة التجريبية
+DEFAULT_HALF_OPEN_CALLS = 1       # عدد المحاولات التجريبية المسموحة معاً
+
+# إعدادات كل خدمة
+BREAKER_SETTINGS = {
+    'telegram': {'slow_call_ms': 5000},
+    'edfapay': {'slow_call_ms': 8000, 'open_seconds': 60},
+    'authentica': {'slow_call_ms': 5000},
+    'smtp': {'slow_call_ms': 10000, 'min_calls': 3, 'open_seconds': 120},
+}
+
+
+class CircuitOpenError(Exception):
+    """الخدمة متوقفة مؤقتاً (القاطع مفتوح) - لم يتم إرسال الطلب"""
+
+    def __init__(self, name, retry_after=0):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"الخدمة {name} غير متاحة مؤقتاً (إعادة المحاولة بعد {int(retry_after)} ثانية)")
+
+
+class CircuitBreaker:
+    """
+    الاستخدام:
+        breaker = get_breaker('smtp')
+
+        with breaker.guard():
+            send_email()
+
+        # أو يدوياً
+        if breaker.allow():
+            ...
+            breaker.record_success(elapsed_ms)
+    """
+
+    def __init__(self, name, window_seconds=DEFAULT_WINDOW_SECONDS, min_calls=DEFAULT_MIN_CALLS,
+                 failure_rate=DEFAULT_FAILURE_RATE, slow_call_ms=DEFAULT_SLOW_CALL_MS,
+                 slow_rate=DEFAULT_SLOW_RATE, open_seconds=DEFAULT_OPEN_SECONDS,
+                 half_open_calls=DEFAULT_HALF_OPEN_CALLS):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_ms = slow_call_ms
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._calls = deque()  # (timestamp, failed, slow)
+        self._state = CLOSED
+        self._opened_at = 0
+        self._half_open_in_flight = 0
+        self._rejected = 0
+        self._last_error = None
+        self._last_state_change = time.time()
+
+    # --- الحالة ---
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+        logger.warning(f"⚡ قاطع {self.name}: {self._state} → {state}")
+        self._state = state
+        self._last_state_change = time.time()
+        if state == OPEN:
+            self._opened_at = time.time()
+        if state != HALF_OPEN:
+            self._half_open_in_flight = 0
+        if state == CLOSED:
+            self._calls.clear()
+
+    def _prune(self, now):
+        cutoff = now - self.window_seconds
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.time() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    # --- القرار ---
+
+    def allow(self):
+        """هل يُسمح بإرسال الطلب الآن؟ (يحجز محاولة تجريبية في وضع half_open)"""
+        with self._lock:
+            if self._state == OPEN:
+                if time.time() - self._opened_at < self.open_seconds:
+                    self._rejected += 1
+                    return False
+                self._set_state(HALF_OPEN)
+
+            if self._state == HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_calls:
+                    self._rejected += 1
+                    return False
+                self._half_open_in_flight += 1
+            return True
+
+    def retry_after(self):
+        """الثواني المتبقية قبل المحاولة التجريبية"""
+        with self._lock:
+            if self._state != OPEN:
+                return 0
+            return max(0, self.open_seconds - (time.time() - self._opened_at))
+
+    def _record(self, failed, elapsed_ms, error=None):
+        now = time.time()
+        slow = elapsed_ms >= self.slow_call_ms
+        with self._lock:
+            if error is not None:
+                self._last_error = (str(error) or type(error).__name__)[:200]
+
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+                self._set_state(OPEN if failed or slow else CLOSED)
+                return
+
+            self._calls.append((now, failed, slow))
+            self._prune(now)
+            total = len(self._calls)
+            if self._state != CLOSED or total < self.min_calls:
+                return
+
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_rate:
+                self._set_state(OPEN)
+
+    def record_success(self, elapsed_ms=0):
+        self._record(False, elapsed_ms)
+
+    def record_failure(self, elapsed_ms=0, error=None):
+        self._record(True, elapsed_ms, error)
+
+    # --- الاستخدام ---
+
+    @contextmanager
+    def guard(self):
+        """
+        تنفيذ كتلة عبر القاطع
+        ترمي CircuitOpenError فوراً إذا كان القاطع مفتوحاً، وتسجل نتيجة الكتلة وزمنها
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+        started = time.perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            self.record_failure((time.perf_counter() - started) * 1000, e)
+            raise
+        self.record_success((time.perf_counter() - started) * 1000)
+
+    def call(self, func, *args, **kwargs):
+        with self.guard():
+            return func(*args, **kwargs)
+
+    def reset(self):
+        """إعادة القاطع للوضع الطبيعي (من لوحة التحكم)"""
+        with self._lock:
+            self._set_state(CLOSED)
+            self._rejected = 0
+
+    def status(self):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            total = len(self._calls)
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            state = self._state
+            if state == OPEN and now - self._opened_at >= self.open_seconds:
+                state = HALF_OPEN
+            return {
+                'state': state,
+                'window_calls': total,
+                'failure_rate': round(failures / total, 2) if total else 0,
+                'slow_rate': round(slow_calls / total, 2) if total else 0,
+                'rejected': self._rejected,
+                'retry_after': round(max(0, self.open_seconds - (now - self._opened_at)), 1) if state == OPEN else 0,
+                'last_error': self._last_error,
+                'since': int(self._last_state_change)
+            }
+
+
+# ==================== السجل ====================
+
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """القاطع الخاص بخدمة (يُنشأ عند أول استخدام بإعدادات BREAKER_SETTINGS)"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, **BREAKER_SETTINGS.get(name, {}))
+                _breakers[name] = breaker
+    return breaker
+
+
+def get_breakers_status():
+    """حالة كل القواطع (للوحة التحكم)"""
+    for name in BREAKER_SETTINGS:
+        get_breaker(name)
+    return {name: breaker.status() for name, breaker in list(_breakers.items())}
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ضغط الردود (gzip / brotli)
+==========================
+- compress_response: يُسجل في app.after_request ويضغط ردود HTML و JSON والنصوص
+  حسب Accept-Encoding (brotli إذا كانت المكتبة متاحة، وإلا gzip)
+  - الردود الأصغر من COMPRESS_MIN_SIZE تُرسل كما هي
+  - الردود المتدفقة (stream) تُضغط أثناء الإرسال بدون تجميعها في الذاكرة
+  - الصور والملفات المضغوطة أصلاً والملفات المرسلة مباشرة (send_file) لا تُضغط
+- serve_precompressed_static: ملفات static تُضغط مرة واحدة وقت البناء
+  (python compression.py) وتُرسل نسخة .br أو .gz الجاهزة إذا قبلها المتصفح
+"""
+
+import os
+import sys
+import gzip
+import zlib
+import mimetypes
+
+from flask import request, current_app, send_from_directory
+
+# Brotli (اختياري)
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+COMPRESS_MIN_SIZE = 1024   # بايت
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5         # للردود الديناميكية (الجودة 11 للملفات المضغوطة مسبقاً فقط)
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml',
+    'application/manifest+json', 'image/svg+xml'
+}
+
+# امتدادات ملفات static التي تُضغط مسبقاً
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.xml', '.html', '.ttf')
+
+# ترتيب التفضيل: الامتداد في static لكل ترميز
+PRECOMPRESSED_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _accepted(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def choose_encoding():
+    """أفضل ترميز يقبله المتصفح (أو None)"""
+    if BROTLI_AVAILABLE and _accepted('br'):
+        return 'br'
+    if _accepted('gzip'):
+        return 'gzip'
+    return None
+
+
+# ==================== الضغط أثناء الإرسال ====================
+
+class _Compressor:
+    """واجهة موحدة لـ gzip و brotli (compress ثم finish)"""
+
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._impl = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress = self._impl.process
+            self._finish = self._impl.finish
+        else:
+            # wbits=31: ترويسة gzip
+            self._impl = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._compress = self._impl.compress
+            self._finish = self._impl.flush
+
+    def compress(self, data):
+        return self._compress(data)
+
+    def finish(self):
+        return self._finish()
+
+
+def _compress_stream(chunks, encoding):
+    compressor = _Compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def _weaken_etag(response):
+    """النسخة المضغوطة ليست نفس البايتات: ETag قوي يصبح ضعيفاً (If-None-Match يقارن بضعف)"""
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """ضغط الرد إذا كان نصياً وكبيراً بما يكفي والمتصفح يقبل الضغط"""
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    if response.status_code == 304:
+        # نفس ETag الذي كان سيُرسل مع الرد المضغوط
+        if choose_encoding():
+            _weaken_etag(response)
+        return response
+    if (response.status_code < 200 or response.status_code in (204, 206)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or request.method == 'HEAD'):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(_compress_bytes(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+    return response
+
+
+# ==================== ملفات static المضغوطة مسبقاً ====================
+
+def serve_precompressed_static():
+    """
+    before_request: إرسال نسخة .br أو .gz الجاهزة لملف static
+    (فقط إذا كانت أحدث من الملف الأصلي)
+    """
+    if request.endpoint != 'static' or request.method not in ('GET', 'HEAD'):
+        return None
+    if 'Range' in request.headers:
+        return None
+
+    static_folder = current_app.static_folder
+    filename = (request.view_args or {}).get('filename', '')
+    if not filename or not filename.endswith(PRECOMPRESS_EXTENSIONS):
+        return None
+
+    original = os.path.join(static_folder, filename)
+    try:
+        original_mtime = os.path.getmtime(original)
+    except OSError:
+        return None
+
+    for encoding, suffix in PRECOMPRESSED_SUFFIXES:
+        if not _accepted(encoding):
+            continue
+        compressed = original + suffix
+        try:
+            if os.path.getmtime(compressed) < original_mtime:
+                continue
+        except OSError:
+            continue
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+    return None
+
+
+def precompress_static(directory):
+    """ضغط ملفات static مسبقاً (gzip دائماً، brotli إذا كانت المكتبة متاحة)"""
+    count = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < COMPRESS_MIN_SIZE:
+                continue
+
+            outputs = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if BROTLI_AVAILABLE:
+                outputs.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in outputs:
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                count += 1
+    return count
+
+
+if __name__ == '__main__':
+    # وقت البناء: python compression.py [مجلد static]
+    static_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    written = precompress_static(static_dir)
+    print(f"✅ تم ضغط ملفات static مسبقاً: {written} ملف" + ("" if BROTLI_AVAILABLE else " (gzip فقط - brotli غير مثبت)"))
@@ -37,7 +37,9 @@ SESSION_CONFIG = {
 }
 
 RATE_LIMIT_DEFAULT = ["200 per day", "50 per hour"]
-RATE_LIMIT_STORAGE = "memory://"
+# مخزن الحالة المشترك (redis://... لمشاركة الحدود بين العمليات، أو memory:// محلياً)
+STATE_STORE_URL = os.environ.get("STATE_STORE_URL", os.environ.get("REDIS_URL", "memory://"))
+RATE_LIMIT_STORAGE = STATE_STORE_URL
 
 CART_EXPIRY_HOURS = 1
 
@@ -64,3 +66,27 @@ AUTHENTICA_API_KEY = os.environ.get("AUTHENTICA_API_KEY", "")
 AUTHENTICA_API_URL = "https://api.authentica.sa/api/v2"
 AUTHENTICA_DEFAULT_METHOD = os.environ.get("AUTHENTICA_METHOD", "sms")
 AUTHENTICA_TEMPLATE_ID = os.environ.get("AUTHENTICA_TEMPLATE_ID", "1")
+
+# ==================== المهام المجدولة ====================
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() != "false"
+SCHEDULER_TICK_SECONDS = int(os.environ.get("SCHEDULER_TICK_SECONDS", "60"))
+# أوقات التذكير يختارها المستخدم بتوقيت السعودية
+REMINDER_UTC_OFFSET_HOURS = int(os.environ.get("REMINDER_UTC_OFFSET_HOURS", "3"))
+REMINDER_BATCH_SIZE = 100      # أقصى عدد تذكيرات في كل دورة
+REMINDER_SEND_PER_SECOND = 20  # أقل من حد تيليجرام (30 رسالة/ثانية)
+REMINDER_MAX_ATTEMPTS = 6      # بعدها يُلغى التذكير الذي يفشل إرساله
+REMINDER_MAX_BACKOFF_HOURS = 24  # أقصى تأجيل بين المحاولات (1، 2، 4، 8، 16، 24 ساعة)
+LEDGER_RETENTION_DAYS = 60          # فواتير المحاسبة تُحذف بعد 60 يوم
+LEDGER_CLEANUP_INTERVAL = 6 * 3600  # تنظيف الفواتير القديمة كل 6 ساعات
+
+# ==================== كاش الوسائط ====================
+# مجلد الصور المعالجة (صور الحسابات...) - يُفضل قرص دائم في الإنتاج
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".media_cache"))
+AVATAR_CACHE_MAX_MB = int(os.environ.get("AVATAR_CACHE_MAX_MB", "50"))
+IMAGE_CACHE_MAX_MB = int(os.environ.get("IMAGE_CACHE_MAX_MB", "200"))
+
+# ==================== كاش صفحات المتجر ====================
+# رقم الإصدار يدخل في ETag حتى لا تبقى صفحات النسخة القديمة بعد النشر
+RELEASE_ID = os.environ.get("RELEASE_ID") or os.environ.get("RENDER_GIT_COMMIT", "")
+CATALOG_S_MAXAGE = int(os.environ.get("CATALOG_S_MAXAGE", "60"))  # مدة كاش الـ CDN للصفحات العامة (ثانية)
+PAGE_CACHE_MAX_MB = int(os.environ.get("PAGE_CACHE_MAX_MB", "16"))  # حد كاش الصفحات المرسومة في الذاكرة
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+مخزن حالات المحادثة
+===================
+حالة كل محادثة في البوت (انتظار مبلغ، انتظار كود...) مع:
+- انتهاء تلقائي لكل محادثة (TTL)
+- تخزين مضغوط (JSON بدون مسافات)
+- مخزن مشترك (Redis أو الذاكرة المحلية) ليعمل مع أكثر من عملية
+  (كل قراءة من المخزن المشترك: حالة غيرتها عملية أخرى تظهر فوراً)
+"""
+
+import json
+import logging
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStateStore:
+    """
+    حالات المحادثات - تُستخدم مثل القاموس:
+        user_states[user_id] = {'state': '...', 'created_at': time.time()}
+        if user_id in user_states: ...
+        del user_states[user_id]
+    """
+
+    def __init__(self, scope, ttl, backend=None, prefix='cs'):
+        self.scope = scope
+        self.ttl = ttl
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, chat_id):
+        return f"{self.prefix}:{self.scope}:{chat_id}"
+
+    @staticmethod
+    def _encode(state):
+        return json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            return json.loads(raw)
+        except (TypeError, ValueError):
+            return None
+
+    # --- العمليات الأساسية ---
+
+    def set(self, chat_id, state, ttl=None):
+        """حفظ حالة المحادثة"""
+        chat_id = str(chat_id)
+        state = dict(state)
+        if 'created_at' in state:
+            state['created_at'] = int(state['created_at'])
+        self.backend.set(self._key(chat_id), self._encode(state), ex=int(ttl or self.ttl))
+
+    def get(self, chat_id, default=None):
+        """جلب حالة المحادثة"""
+        state = self._decode(self.backend.get(self._key(str(chat_id))))
+        return state if state is not None else default
+
+    def clear(self, chat_id):
+        """حذف حالة المحادثة"""
+        return self.backend.delete(self._key(str(chat_id))) > 0
+
+    def pop(self, chat_id, default=None):
+        """جلب الحالة وحذفها"""
+        state = self.get(chat_id)
+        self.clear(chat_id)
+        return state if state is not None else default
+
+    # --- واجهة القاموس (للتوافق مع الكود القديم) ---
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        state = self.get(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def __setitem__(self, chat_id, state):
+        self.set(chat_id, state)
+
+    def __delitem__(self, chat_id):
+        self.clear(chat_id)
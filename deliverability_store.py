@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+حالة إمكانية مراسلة المستخدمين عبر البوت
+========================================
+بدل إرسال رسالة تجريبية وحذفها قبل كل عملية شراء، نتذكر آخر حالة معروفة لكل مستخدم:
+- رسالة وصلت له (sendMessage، sendPhoto...) ← يمكن مراسلته
+- خطأ 403 (حظر البوت) أو "chat not found" ← لا يمكن مراسلته
+- تحديثات my_chat_member (حظر / إلغاء حظر / بدء البوت)
+
+كل حالة لها مدة صلاحية (TTL)، وبعد انتهائها تُعتبر غير معروفة ويُعاد الفحص عند الحاجة
+تعمل فوق المخزن المشترك (Redis أو الذاكرة المحلية) فتعمل مع أكثر من عملية
+"""
+
+import logging
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+DELIVERABLE = 'ok'
+BLOCKED = 'blocked'
+
+DELIVERABLE_TTL = 3 * 24 * 3600   # الإرسال الناجح يبقى موثوقاً 3 أيام
+BLOCKED_TTL = 3600                # الحظر يُعاد فحصه بعد ساعة (إلغاء الحظر يصل فوراً عبر my_chat_member)
+
+# طلبات تُوصل رسالة فعلاً للمستخدم (نجاح sendChatAction مثلاً لا يثبت وصول الرسائل)
+DELIVERY_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendVideo', 'sendAudio',
+    'sendVoice', 'sendAnimation', 'sendSticker', 'sendMediaGroup',
+    'sendLocation', 'sendContact', 'sendInvoice'
+}
+
+# حالات my_chat_member
+_MEMBER_STATUSES = {'member', 'administrator', 'creator'}
+_LEFT_STATUSES = {'kicked', 'left'}
+
+
+class DeliverabilityStore:
+    """
+    الاستخدام:
+        deliverability.mark_deliverable(user_id)
+        deliverability.get(user_id)  # True / False / None (غير معروف أو منتهي)
+    """
+
+    def __init__(self, backend=None, prefix='dlv'):
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, chat_id):
+        return f"{self.prefix}:{chat_id}"
+
+    def get(self, chat_id):
+        """
+        Returns:
+            bool | None: True يمكن مراسلته، False محظور، None غير معروف
+        """
+        try:
+            status = self.backend.get(self._key(chat_id))
+        except Exception as e:
+            logger.error(f"خطأ في قراءة حالة المراسلة لـ {chat_id}: {e}")
+            return None
+        if status == DELIVERABLE:
+            return True
+        if status == BLOCKED:
+            return False
+        return None
+
+    def _set(self, chat_id, status, ttl):
+        try:
+            self.backend.set(self._key(chat_id), status, ex=ttl)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ حالة المراسلة لـ {chat_id}: {e}")
+
+    def mark_deliverable(self, chat_id):
+        self._set(chat_id, DELIVERABLE, DELIVERABLE_TTL)
+
+    def mark_blocked(self, chat_id):
+        self._set(chat_id, BLOCKED, BLOCKED_TTL)
+
+    # --- التعلم من تيليجرام ---
+
+    def learn_from_response(self, api_method, params, response):
+        """
+        تحديث الحالة من رد أي طلب send* للبوت (يُستدعى من عميل HTTP)
+        المجموعات والقنوات (معرف سالب) تُتجاهل
+        """
+        if not api_method.startswith('send') or not params:
+            return
+        chat_id = str(params.get('chat_id', ''))
+        if not chat_id.isdigit():
+            return
+
+        if response.status_code == 200:
+            if api_method in DELIVERY_METHODS:
+                self.mark_deliverable(chat_id)
+        elif response.status_code == 403:
+            self.mark_blocked(chat_id)
+        elif response.status_code == 400:
+            try:
+                description = response.json().get('description', '')
+            except ValueError:
+                description = ''
+            if 'chat not found' in description.lower():
+                self.mark_blocked(chat_id)
+
+    def learn_from_chat_member(self, update):
+        """تحديث الحالة من my_chat_member (المستخدم حظر البوت أو بدأه من جديد)"""
+        try:
+            if update.chat.type != 'private':
+                return
+            status = update.new_chat_member.status
+        except AttributeError:
+            return
+        if status in _MEMBER_STATUSES:
+            self.mark_deliverable(update.chat.id)
+        elif status in _LEFT_STATUSES:
+            self.mark_blocked(update.chat.id)
+
+
+deliverability = DeliverabilityStore()
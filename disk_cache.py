@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+كاش الملفات على القرص (LRU محدود الحجم)
+=======================================
+للصور المعالجة (صور الحسابات، الصور المصغرة...) حتى لا تُجلب أو تُعالج في كل طلب:
+
+- كل قيمة ملف مستقل اسمه hash المفتاح (الكتابة ذرية عبر ملف مؤقت ثم rename)
+- القراءة تحدث وقت آخر استخدام للملف (mtime)
+- عند تجاوز الحجم الأقصى تُحذف الملفات الأقدم استخداماً حتى 90% من الحد
+
+المجلد يمكن أن تشترك فيه عدة عمليات (كل عملية تحسب الحجم من القرص عند أول استخدام)
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVICT_TARGET_RATIO = 0.9
+
+
+class DiskLRUCache:
+    """
+    الاستخدام:
+        cache = DiskLRUCache('/tmp/media/avatars', max_bytes=50 * 1024 * 1024)
+        cache.set('key', data)
+        cache.get('key')  # bytes أو None
+    """
+
+    def __init__(self, directory, max_bytes, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._size = None  # يُحسب عند أول كتابة
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name[:2], name + self.suffix)
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _current_size(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._files())
+        return self._size
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        with self._lock:
+            # الحجم يُحسب من القرص قبل الكتابة (وإلا يُحسب الملف الجديد مرتين)
+            self._current_size()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"خطأ في الكتابة لكاش القرص {self.directory}: {e}")
+            return False
+
+        with self._lock:
+            self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+        return True
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size = max(0, self._size - size)
+
+    def _evict(self):
+        """حذف الأقدم استخداماً (يُستدعى مع القفل)"""
+        files = sorted(self._files(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        removed = 0
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._size = total
+        if removed:
+            logger.info(f"🧹 كاش القرص {self.directory}: حذف {removed} ملف")
+
+    def stats(self):
+        with self._lock:
+            return {'directory': self.directory, 'bytes': self._current_size(), 'max_bytes': self.max_bytes}
@@ -11,6 +11,8 @@ import logging
 import firebase_admin
 from firebase_admin import credentials, firestore
 import telebot
+from verification_store import VerificationCodeStore
+from conversation_store import ConversationStateStore
 
 # إعداد التسجيل
 logging.basicConfig(level=logging.ERROR)
@@ -79,8 +81,9 @@ EDFAPAY_PASSWORD = os.getenv('EDFAPAY_PASSWORD', '')
 
 # --- البيانات المؤقتة (لا تُخزن في Firebase) ---
 # هذه البيانات مؤقتة فقط ولا تحتاج حفظ دائم
-verification_codes = {}      # أكواد التحقق المؤقتة
-user_states = {}            # حالات المستخدمين (للبوت)
+verification_codes = VerificationCodeStore('login', ttl=120, max_attempts=3)  # أكواد التحقق المؤقتة (دقيقتان)
+user_states = ConversationStateStore('bot', ttl=900)  # حالات المستخدمين (للبوت) - تُحذف تلقائياً بعد 15 دقيقة
+bot_drafts = ConversationStateStore('drafts', ttl=3600)  # مسودات المعالجات متعددة الخطوات (إضافة منتج، المحاسبة) - ساعة
 display_settings = {'categories_columns': 3}  # إعدادات العرض
 
 # ملاحظة: تم إزالة users_wallets, marketplace_items, categories_list, user_carts
@@ -107,6 +110,9 @@ def init_bot():
         try:
             bot = telebot.TeleBot(TOKEN)
             telebot.apihelper.RETRY_ON_ERROR = True
+            # كل طلبات البوت عبر Session مشتركة مع مهلات قصيرة
+            from http_client import install_telebot_session
+            install_telebot_session()
             BOT_ACTIVE = True
             try:
                 bot_info = bot.get_me()
@@ -10,6 +10,7 @@ import os
 import json
 import time
 import uuid
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,7 @@ except ImportError:
 
 # استيراد من extensions لتجنب circular imports
 from extensions import db, FIREBASE_AVAILABLE
+from catalog_version import get_catalog_version, bump_catalog_version
 
 # محاولة استيراد FieldFilter للنسخ الجديدة
 USE_FIELD_FILTER = False
@@ -47,33 +49,45 @@ CACHE_DURATION = {
     'header_settings': 300  # 5 دقائق
 }
 
+# مفاتيح الكتالوج: صالحة فقط مع نفس رقم نسخة الكتالوج (تعديل من أي عملية يُسقطها)
+CATALOG_CACHE_KEYS = ('categories', 'products', 'header_settings')
+
 def get_cached(key):
     """جلب بيانات من الكاش إذا كانت صالحة"""
     if key in _cache:
         cache_entry = _cache[key]
         if cache_entry['data'] is not None and time.time() < cache_entry['expires']:
+            if key in CATALOG_CACHE_KEYS and cache_entry.get('version') != get_catalog_version():
+                return None
             return cache_entry['data']
     return None
 
-def set_cached(key, data):
-    """حفظ بيانات في الكاش"""
+def set_cached(key, data, version=None):
+    """
+    حفظ بيانات في الكاش
+    version: نسخة الكتالوج التي قُرئت عندها البيانات (تُقرأ قبل الجلب من Firestore)
+    """
     if key in _cache:
         duration = CACHE_DURATION.get(key, 60)
         _cache[key] = {
             'data': data,
-            'expires': time.time() + duration
+            'expires': time.time() + duration,
+            'version': version if version is not None else get_catalog_version()
         }
 
 def clear_cache(key=None):
-    """مسح الكاش - كله أو مفتاح محدد"""
+    """مسح الكاش - كله أو مفتاح محدد (مسح مفاتيح الكتالوج يغير رقم نسخته)"""
     global _cache
     if key:
         if key in _cache:
             _cache[key] = {'data': None, 'expires': 0}
             logger.info(f"🗑️ تم مسح كاش: {key}")
+        if key in CATALOG_CACHE_KEYS:
+            bump_catalog_version()
     else:
         for k in _cache:
             _cache[k] = {'data': None, 'expires': 0}
+        bump_catalog_version()
         logger.info("🗑️ تم مسح جميع الكاش")
 
 def get_cache_status():
@@ -222,6 +236,7 @@ def get_products(sold=False, use_cache=True):
         
         if not db:
             return []
+        version = get_catalog_version()
         products_ref = query_where(db.collection('products'), 'sold', '==', sold)
         products = []
         for doc in products_ref.stream():
@@ -231,7 +246,7 @@ def get_products(sold=False, use_cache=True):
         
         # حفظ في الكاش
         if not sold:
-            set_cached('products', products)
+            set_cached('products', products, version)
         
         return products
     except Exception as e:
@@ -312,6 +327,7 @@ def get_categories(use_cache=True):
         
         if not db:
             return []
+        version = get_catalog_version()
         categories = []
         for doc in db.collection('categories').order_by('order').stream():
             data = doc.to_dict()
@@ -319,7 +335,7 @@ def get_categories(use_cache=True):
             categories.append(data)
         
         # حفظ في الكاش
-        set_cached('categories', categories)
+        set_cached('categories', categories, version)
         
         return categories
     except Exception as e:
@@ -363,6 +379,7 @@ def set_header_settings(enabled=False, text='', link_url=''):
             'link_url': str(link_url or '').strip(),
             'updated_at': firestore.SERVER_TIMESTAMP if firestore else None
         }, merge=True)
+        clear_cache('header_settings')
         return True
     except Exception as e:
         print(f"❌ خطأ في تحديث إعدادات الهيدر: {e}")
@@ -432,6 +449,90 @@ def create_charge_key(key_code, amount):
         print(f"❌ خطأ في إنشاء مفتاح الشحن: {e}")
         return False
 
+def _credit_balance_in_transaction(transaction, uid, user_snapshot, amount, description, order_id, charge_entry):
+    """
+    كتابات إضافة الرصيد داخل Transaction (بعد قراءة مستند المستخدم):
+    زيادة الرصيد (Increment) + سجل balance_logs + سجل charge_history
+    
+    Returns:
+        tuple: (الرصيد القديم, الرصيد الجديد)
+    """
+    old_balance = float((user_snapshot.to_dict() or {}).get('balance', 0.0)) if user_snapshot.exists else 0.0
+    new_balance = old_balance + float(amount)
+    
+    transaction.set(db.collection('users').document(uid), {
+        'balance': firestore.Increment(float(amount)),
+        'telegram_id': uid,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+        'last_charge_at': firestore.SERVER_TIMESTAMP  # تحديث وقت آخر شحن للسحب
+    }, merge=True)
+    transaction.set(db.collection('balance_logs').document(), {
+        'user_id': uid,
+        'amount': float(amount),
+        'operation_type': 'credit',
+        'description': description,
+        'order_id': order_id,
+        'old_balance': old_balance,
+        'new_balance': new_balance,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    transaction.set(db.collection('charge_history').document(), {
+        'user_id': uid,
+        'amount': float(amount),
+        'order_id': order_id,
+        **charge_entry
+    })
+    return old_balance, new_balance
+
+def redeem_charge_key(key_code, user_id, method='key', user_name=None):
+    """
+    استخدام مفتاح شحن في Transaction واحدة:
+    التحقق من used == False + تعليمه مستخدماً + إضافة الرصيد + balance_logs + charge_history
+    (محاولتان متزامنتان لنفس المفتاح: واحدة فقط تنجح)
+    
+    Returns:
+        dict: {'result': 'redeemed' | 'not_found' | 'used', 'amount', 'new_balance', 'used_by'}
+    """
+    if not db or not key_code:
+        return {'result': 'not_found'}
+    
+    uid = str(user_id)
+    key_ref = db.collection('charge_keys').document(key_code)
+    
+    @firestore.transactional
+    def do_redeem(transaction):
+        key_doc = key_ref.get(transaction=transaction)
+        if not key_doc.exists:
+            return {'result': 'not_found'}
+        
+        key_data = key_doc.to_dict()
+        if key_data.get('used', False):
+            return {'result': 'used', 'used_by': key_data.get('used_by_name') or key_data.get('used_by', '')}
+        
+        amount = float(key_data.get('amount', 0))
+        user_snapshot = db.collection('users').document(uid).get(transaction=transaction)
+        
+        transaction.update(key_ref, {
+            'used': True,
+            'used_by': uid,
+            'used_by_name': user_name or '',
+            'used_at': firestore.SERVER_TIMESTAMP
+        })
+        _, new_balance = _credit_balance_in_transaction(
+            transaction, uid, user_snapshot, amount,
+            description='شحن بكود', order_id='',
+            charge_entry={
+                'key_code': key_code,
+                'method': method,
+                'date': time.strftime('%Y-%m-%d %H:%M'),
+                'timestamp': time.time(),
+                'type': 'charge'
+            }
+        )
+        return {'result': 'redeemed', 'amount': amount, 'new_balance': new_balance}
+    
+    return do_redeem(db.transaction())
+
 # === دوال الطلبات المعلقة (الدفع) ===
 def save_pending_payment(order_id, data):
     """حفظ طلب دفع معلق"""
@@ -469,6 +570,79 @@ def update_pending_payment(order_id, data):
         print(f"❌ خطأ في تحديث الطلب المعلق: {e}")
         return False
 
+def complete_pending_payment(order_id, trans_id='', gateway_status='', payment_data=None):
+    """
+    إكمال دفعة ناجحة في Transaction واحدة (آمنة ضد تكرار الـ webhook):
+    التحقق من الحالة + إضافة الرصيد + balance_logs + charge_history + status=completed
+    (+ تحديث فاتورة التاجر إن وجدت)
+    
+    Returns:
+        dict: {'result': 'completed' | 'already_processed' | 'not_found' | 'missing_user', ...}
+              مع user_id, amount, new_balance, invoice_id, is_merchant_invoice, invoice عند النجاح
+    """
+    if not db:
+        return {'result': 'not_found'}
+    
+    payment_ref = db.collection('pending_payments').document(order_id)
+    
+    @firestore.transactional
+    def do_complete(transaction):
+        payment_doc = payment_ref.get(transaction=transaction)
+        if not payment_doc.exists:
+            return {'result': 'not_found'}
+        
+        payment = payment_doc.to_dict()
+        if payment.get('status') == 'completed':
+            return {'result': 'already_processed'}
+        
+        uid = str(payment.get('user_id', ''))
+        if not uid:
+            return {'result': 'missing_user'}
+        
+        amount = float(payment.get('amount', 0))
+        invoice_id = payment.get('invoice_id', '')
+        is_merchant_invoice = payment.get('is_merchant_invoice', False)
+        
+        # كل القراءات قبل الكتابات
+        user_snapshot = db.collection('users').document(uid).get(transaction=transaction)
+        invoice_ref = db.collection('merchant_invoices').document(invoice_id) if is_merchant_invoice and invoice_id else None
+        invoice_doc = invoice_ref.get(transaction=transaction) if invoice_ref else None
+        
+        _, new_balance = _credit_balance_in_transaction(
+            transaction, uid, user_snapshot, amount,
+            description='شحن رصيد', order_id=order_id,
+            charge_entry={
+                'method': 'edfapay',
+                'timestamp': time.time(),
+                'date': time.strftime('%Y-%m-%d %H:%M'),
+                'type': 'payment'
+            }
+        )
+        transaction.update(payment_ref, {
+            'status': 'completed',
+            'completed_at': firestore.SERVER_TIMESTAMP,
+            'trans_id': trans_id,
+            'edfapay_status': gateway_status,
+            'payment_data': payment_data or {}
+        })
+        if invoice_doc is not None and invoice_doc.exists:
+            transaction.update(invoice_ref, {
+                'status': 'completed',
+                'completed_at': firestore.SERVER_TIMESTAMP
+            })
+        
+        return {
+            'result': 'completed',
+            'user_id': uid,
+            'amount': amount,
+            'new_balance': new_balance,
+            'invoice_id': invoice_id,
+            'is_merchant_invoice': is_merchant_invoice,
+            'invoice': invoice_doc.to_dict() if invoice_doc is not None and invoice_doc.exists else {}
+        }
+    
+    return do_complete(db.transaction())
+
 # === دوال السلة ===
 def get_user_cart(user_id):
     """جلب سلة المستخدم"""
@@ -622,20 +796,14 @@ def add_purchase_history(buyer_id, seller_id, product_data, order_id=''):
         print(f"❌ خطأ في إضافة سجل الشراء: {e}")
         return False
 
-def get_user_purchases(user_id, limit=50):
-    """جلب مشتريات المستخدم"""
+def get_user_purchases(user_id, limit=50, cursor=None):
+    """جلب مشتريات المستخدم (من سجل الطلبات المفهرس، من الأحدث)"""
+    from services.order_history import get_order_history
     try:
         if not db:
             return []
-        purchases = []
-        purchases_ref = query_where(db.collection('purchases'), 'buyer_id', '==', str(user_id))
-        for doc in purchases_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
-            purchases.append(data)
-        # ترتيب من الأحدث
-        purchases.sort(key=lambda x: x.get('created_at', 0) if x.get('created_at') else 0, reverse=True)
-        return purchases[:limit]
+        purchases, _ = get_order_history(user_id, limit=limit, cursor=cursor)
+        return purchases
     except Exception as e:
         print(f"❌ خطأ في جلب المشتريات: {e}")
         return []
@@ -951,12 +1119,236 @@ def get_all_categories_sales():
 
 # ===================== نظام المحاسبة الشخصية (دفتر الديون) =====================
 
-def cleanup_old_ledger_transactions(owner_id, days=60):
+# ملخصات الدفتر: مستند لكل مالك + مستند لكل شريك يتم تحديثها مع كل إضافة/تسديد/حذف
+# ledger_summaries/{owner_id}                        -> total_debt, total_paid, partners_count, transactions_count
+# ledger_summaries/{owner_id}/partners/{partner_key} -> partner_name, pending, paid, count
+LEDGER_SUMMARY_COLLECTION = 'ledger_summaries'
+FIRESTORE_BATCH_LIMIT = 500
+# عمليات الدفتر في كل Transaction جماعية: العملية + ملخص الشريك + ملخص المالك تحت حد 500 كتابة
+LEDGER_CHUNK_SIZE = 150
+
+
+def ledger_reminder_bucket(reminder_date):
+    """
+    رقم ساعة التذكير (ساعات منذ 1970 بتوقيت UTC) لفهرسة التذكيرات
+    reminder_date بصيغة "YYYY-MM-DD HH:00" بالتوقيت المحلي (REMINDER_UTC_OFFSET_HOURS)
+    
+    Returns:
+        int أو None إذا لم يوجد تذكير أو كانت الصيغة غير صحيحة
+    """
+    if not reminder_date:
+        return None
+    try:
+        import datetime
+        from config import REMINDER_UTC_OFFSET_HOURS
+        local_tz = datetime.timezone(datetime.timedelta(hours=REMINDER_UTC_OFFSET_HOURS))
+        local_dt = datetime.datetime.strptime(reminder_date.strip(), "%Y-%m-%d %H:%M").replace(tzinfo=local_tz)
+        return int(local_dt.timestamp() // 3600)
+    except (ValueError, AttributeError):
+        return None
+
+
+def _ledger_partner_key(partner_name):
+    """معرف مستند الشريك (الاسم قد يحتوي / أو أحرف لا تصلح كمعرف)"""
+    return hashlib.md5(str(partner_name).encode('utf-8')).hexdigest()
+
+
+def _ledger_summary_refs(owner_id, partner_name=None):
+    """مراجع مستند ملخص المالك ومستند الشريك"""
+    owner_ref = db.collection(LEDGER_SUMMARY_COLLECTION).document(str(owner_id))
+    if partner_name is None:
+        return owner_ref, None
+    return owner_ref, owner_ref.collection('partners').document(_ledger_partner_key(partner_name))
+
+
+def _ledger_partner_query(owner_id, partner_name, status=None):
+    """استعلام عمليات شريك (فهرس مركب: owner_id + partner_name + status)"""
+    query = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id))
+    query = query_where(query, 'partner_name', '==', partner_name)
+    if status:
+        query = query_where(query, 'status', '==', status)
+    return query
+
+
+def rebuild_ledger_summary(owner_id):
+    """
+    إعادة بناء ملخصات دفتر مالك من العمليات نفسها
+    تُستخدم مرة واحدة للبيانات القديمة (قبل وجود الملخصات) أو للإصلاح
+
+    Returns:
+        dict: ملخص المالك بعد البناء
+    """
+    owner_ref, _ = _ledger_summary_refs(owner_id)
+
+    partners = {}
+    totals = {'total_debt': 0.0, 'total_paid': 0.0, 'transactions_count': 0}
+    for doc in query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream():
+        data = doc.to_dict()
+        name = data.get('partner_name', 'غير معروف')
+        amount = float(data.get('amount', 0))
+        partner = partners.setdefault(name, {'partner_name': name, 'pending': 0.0, 'paid': 0.0, 'count': 0})
+        partner['count'] += 1
+        totals['transactions_count'] += 1
+        if data.get('status', 'pending') == 'pending':
+            partner['pending'] += amount
+            totals['total_debt'] += amount
+        else:
+            partner['paid'] += amount
+            totals['total_paid'] += amount
+
+    # حذف ملخصات الشركاء القديمة ثم كتابة الجديدة
+    writes = [('delete', doc.reference, None) for doc in owner_ref.collection('partners').stream()]
+    for name, partner in partners.items():
+        _, partner_ref = _ledger_summary_refs(owner_id, name)
+        writes.append(('set', partner_ref, {**partner, 'updated_at': firestore.SERVER_TIMESTAMP}))
+
+    summary = {
+        'owner_id': str(owner_id),
+        **totals,
+        'partners_count': len(partners),
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    writes.append(('set', owner_ref, summary))
+
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for op, ref, data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            if op == 'delete':
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+        batch.commit()
+
+    print(f"🔄 تم بناء ملخص الدفتر للمستخدم {owner_id}: {len(partners)} شريك")
+    return summary
+
+
+def _ensure_ledger_summary(owner_id):
+    """جلب ملخص المالك، وبناؤه من العمليات إذا لم يكن موجوداً"""
+    owner_ref, _ = _ledger_summary_refs(owner_id)
+    doc = owner_ref.get()
+    if doc.exists:
+        return doc.to_dict()
+    return rebuild_ledger_summary(owner_id)
+
+
+def _read_ledger_summaries(deltas, transaction=None):
+    """
+    قراءة مستندات الملخصات التي ستتغير (قبل أي كتابة في الـ Transaction)
+
+    Args:
+        deltas: {owner_id: {partner_name: {'pending': x, 'paid': y, 'count': n}}}
+
+    Returns:
+        list: [(owner_ref, [(partner_ref, partner_doc, delta)])] - الملاك بدون ملخص يُتجاهلون
+            (سيُبنى ملخصهم من العمليات المتبقية عند أول قراءة)
+    """
+    summaries = []
+    for owner_id, partner_deltas in deltas.items():
+        owner_ref, _ = _ledger_summary_refs(owner_id)
+        if not owner_ref.get(transaction=transaction).exists:
+            continue
+        partners = []
+        for name, delta in partner_deltas.items():
+            _, partner_ref = _ledger_summary_refs(owner_id, name)
+            partners.append((partner_ref, partner_ref.get(transaction=transaction), delta))
+        summaries.append((owner_ref, partners))
+    return summaries
+
+
+def _write_ledger_deltas(writer, summaries):
+    """كتابات تغييرات الملخصات في batch أو transaction (من نتيجة _read_ledger_summaries)"""
+    for owner_ref, partners in summaries:
+        owner_update = {'total_debt': 0.0, 'total_paid': 0.0, 'transactions_count': 0, 'partners_count': 0}
+        for partner_ref, partner_doc, delta in partners:
+            current = partner_doc.to_dict() if partner_doc.exists else {}
+
+            owner_update['total_debt'] += delta.get('pending', 0)
+            owner_update['total_paid'] += delta.get('paid', 0)
+            owner_update['transactions_count'] += delta.get('count', 0)
+
+            if partner_doc.exists and int(current.get('count', 0)) + delta.get('count', 0) <= 0:
+                # لم يبق للشريك أي عملية
+                writer.delete(partner_ref)
+                owner_update['partners_count'] -= 1
+            elif partner_doc.exists:
+                writer.update(partner_ref, {
+                    'pending': firestore.Increment(delta.get('pending', 0)),
+                    'paid': firestore.Increment(delta.get('paid', 0)),
+                    'count': firestore.Increment(delta.get('count', 0)),
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+
+        writer.set(owner_ref, {
+            **{field: firestore.Increment(value) for field, value in owner_update.items()},
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
+
+def _ledger_delete_change(data):
+    """تغيير الحذف لـ _change_ledger_entries (إنقاص الملخص بمبلغ العملية)"""
+    amount = float(data.get('amount', 0))
+    bucket = 'pending' if data.get('status', 'pending') == 'pending' else 'paid'
+    return 'delete', None, {bucket: -amount, 'count': -1}
+
+
+def _change_ledger_entries(refs, change):
+    """
+    تعديل مجموعة عمليات دفتر مع ملخصاتها في Transaction واحدة
+    (فشل في المنتصف لا يترك عمليات معدلة بدون تحديث ملخصها أو العكس)
+
+    Args:
+        refs: مراجع العمليات (حتى LEDGER_CHUNK_SIZE)
+        change: دالة (data) -> ('update', fields, delta) أو ('delete', None, delta) أو None للتجاهل
+            delta: {'pending': x, 'paid': y, 'count': n} لملخص الشريك
+
+    Returns:
+        list: بيانات العمليات التي تم تعديلها
+    """
+    @firestore.transactional
+    def do_change(transaction):
+        plans = []
+        deltas = {}  # {owner_id: {partner_name: delta}}
+        for snapshot in transaction.get_all(refs):
+            if not snapshot.exists:
+                continue
+            data = snapshot.to_dict()
+            plan = change(data)
+            if not plan:
+                continue
+            op, fields, delta = plan
+            plans.append((snapshot.reference, op, fields, data))
+            partner_delta = deltas.setdefault(data.get('owner_id'), {}).setdefault(
+                data.get('partner_name', 'غير معروف'), {'pending': 0.0, 'paid': 0.0, 'count': 0})
+            for field, value in delta.items():
+                partner_delta[field] += value
+
+        summaries = _read_ledger_summaries(deltas, transaction)
+        for ref, op, fields, _ in plans:
+            if op == 'delete':
+                transaction.delete(ref)
+            else:
+                transaction.update(ref, fields)
+        _write_ledger_deltas(transaction, summaries)
+        return [data for _, _, _, data in plans]
+
+    return do_change(db.transaction())
+
+
+def _ledger_partner_from_summary(data):
+    """تحويل مستند ملخص الشريك للشكل المستخدم في القوائم"""
+    pending = round(float(data.get('pending', 0)), 2)
+    paid = round(float(data.get('paid', 0)), 2)
+    return {'total': pending + paid, 'pending': pending, 'paid': paid, 'count': int(data.get('count', 0))}
+
+
+def cleanup_old_ledger_transactions(owner_id=None, days=60):
     """
     حذف الفواتير القديمة (أكثر من 60 يوم)
+    يقرأ فقط الفواتير المنتهية (created_at < تاريخ القطع) ويحذفها على دفعات
     
     Args:
-        owner_id: معرف المستخدم
+        owner_id: معرف المستخدم (None = كل المستخدمين - للمهمة المجدولة)
         days: عدد الأيام (افتراضي 60)
     
     Returns:
@@ -969,29 +1361,27 @@ def cleanup_old_ledger_transactions(owner_id, days=60):
         import datetime
         cutoff_date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
         
-        deleted_count = 0
-        docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream()
+        query = db.collection('ledger')
+        if owner_id is not None:
+            query = query_where(query, 'owner_id', '==', str(owner_id))
+        query = query_where(query, 'created_at', '<', cutoff_date).limit(LEDGER_CHUNK_SIZE)
         
-        for doc in docs:
-            data = doc.to_dict()
-            created_at = data.get('created_at')
+        # الحذف وتحديث الملخصات في Transaction واحدة لكل دفعة
+        deleted_count = 0
+        owners = set()
+        while True:
+            refs = [doc.reference for doc in query.stream()]
+            if not refs:
+                break
             
-            if created_at:
-                # تحويل التاريخ
-                if hasattr(created_at, 'timestamp'):
-                    doc_date = datetime.datetime.fromtimestamp(created_at.timestamp(), datetime.timezone.utc)
-                elif isinstance(created_at, (int, float)):
-                    doc_date = datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc)
-                else:
-                    continue
-                
-                # حذف إذا قديمة
-                if doc_date < cutoff_date:
-                    db.collection('ledger').document(doc.id).delete()
-                    deleted_count += 1
+            deleted = _change_ledger_entries(refs, _ledger_delete_change)
+            deleted_count += len(deleted)
+            owners.update(data.get('owner_id') for data in deleted)
+            if len(refs) < LEDGER_CHUNK_SIZE:
+                break
         
         if deleted_count > 0:
-            print(f"🗑️ تم حذف {deleted_count} فاتورة قديمة (أكثر من {days} يوم) للمستخدم {owner_id}")
+            print(f"🗑️ تم حذف {deleted_count} فاتورة قديمة (أكثر من {days} يوم) لـ {len(owners)} مستخدم")
         
         return deleted_count
     except Exception as e:
@@ -1029,86 +1419,146 @@ def add_ledger_transaction(owner_id, data):
             'created_at': firestore.SERVER_TIMESTAMP
         }
         
-        doc_ref = db.collection('ledger').add(transaction_data)
+        # فهرس التذكير: يُحذف الحقل بعد الإرسال أو التسديد
+        reminder_bucket = ledger_reminder_bucket(transaction_data['reminder_date'])
+        if reminder_bucket is not None:
+            transaction_data['reminder_bucket'] = reminder_bucket
+        
+        _ensure_ledger_summary(owner_id)
+        owner_ref, partner_ref = _ledger_summary_refs(owner_id, transaction_data['partner_name'])
+        tx_ref = db.collection('ledger').document()
+        amount = transaction_data['amount']
+        
+        # العملية والملخصات في Transaction واحدة
+        @firestore.transactional
+        def do_add(transaction):
+            partner_doc = partner_ref.get(transaction=transaction)
+            is_new_partner = not partner_doc.exists
+            
+            transaction.set(tx_ref, transaction_data)
+            transaction.set(partner_ref, {
+                'partner_name': transaction_data['partner_name'],
+                'pending': firestore.Increment(amount),
+                'paid': firestore.Increment(0),
+                'count': firestore.Increment(1),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            transaction.set(owner_ref, {
+                'owner_id': str(owner_id),
+                'total_debt': firestore.Increment(amount),
+                'transactions_count': firestore.Increment(1),
+                'partners_count': firestore.Increment(1 if is_new_partner else 0),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+        
+        do_add(db.transaction())
         print(f"✅ تم إضافة عملية محاسبة: {transaction_data['partner_name']} - {transaction_data['amount']}")
-        return doc_ref[1].id
+        return tx_ref.id
     except Exception as e:
         print(f"❌ خطأ في إضافة عملية المحاسبة: {e}")
         return None
 
 
-def get_user_ledger_stats(owner_id):
+def get_ledger_summary(owner_id):
+    """
+    ملخص دفتر المستخدم من مستند واحد (بدون قراءة العمليات)
+    
+    Returns:
+        dict: {total_debt, total_paid, partners_count, transactions_count}
+    """
+    empty = {'total_debt': 0, 'total_paid': 0, 'partners_count': 0, 'transactions_count': 0}
+    try:
+        if not db:
+            return empty
+        
+        summary = _ensure_ledger_summary(owner_id)
+        return {
+            'total_debt': max(0, round(float(summary.get('total_debt', 0)), 2)),
+            'total_paid': round(float(summary.get('total_paid', 0)), 2),
+            'partners_count': int(summary.get('partners_count', 0)),
+            'transactions_count': int(summary.get('transactions_count', 0))
+        }
+    except Exception as e:
+        print(f"❌ خطأ في جلب ملخص المحاسبة: {e}")
+        return empty
+
+
+def get_partner_summary(owner_id, partner_name):
+    """ملخص شريك واحد (قراءة مستند واحد) - None إذا لم يوجد"""
+    try:
+        if not db:
+            return None
+        
+        _, partner_ref = _ledger_summary_refs(owner_id, partner_name)
+        doc = partner_ref.get()
+        if not doc.exists:
+            return None
+        return _ledger_partner_from_summary(doc.to_dict())
+    except Exception as e:
+        print(f"❌ خطأ في جلب ملخص الشريك: {e}")
+        return None
+
+
+def get_user_ledger_stats(owner_id, include_transactions=False):
     """
     جلب ملخص وإحصائيات حسابات المستخدم
     
     Args:
         owner_id: معرف المستخدم
+        include_transactions: جلب قائمة العمليات أيضاً (قراءة كاملة للدفتر)
     
     Returns:
-        dict: {total_debt, partners_count, transactions, partners_summary}
+        dict: {total_debt, partners_count, transactions_count, transactions, partners_summary}
     """
     try:
         if not db:
-            return {'total_debt': 0, 'partners_count': 0, 'transactions': [], 'partners_summary': {}}
+            return {'total_debt': 0, 'partners_count': 0, 'transactions_count': 0, 'transactions': [], 'partners_summary': {}}
         
-        docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream()
+        stats = get_ledger_summary(owner_id)
         
-        total_debt = 0
+        owner_ref, _ = _ledger_summary_refs(owner_id)
         partners = {}
-        transactions = []
-        
-        for doc in docs:
+        for doc in owner_ref.collection('partners').stream():
             data = doc.to_dict()
-            data['id'] = doc.id
-            transactions.append(data)
-            
-            partner = data.get('partner_name', 'غير معروف')
-            amount = float(data.get('amount', 0))
-            status = data.get('status', 'pending')
-            
-            if partner not in partners:
-                partners[partner] = {'total': 0, 'pending': 0, 'paid': 0, 'count': 0}
-            
-            partners[partner]['total'] += amount
-            partners[partner]['count'] += 1
-            
-            if status == 'pending':
-                partners[partner]['pending'] += amount
-                total_debt += amount
-            else:
-                partners[partner]['paid'] += amount
+            partners[data.get('partner_name', 'غير معروف')] = _ledger_partner_from_summary(data)
         
-        # ترتيب العمليات من الأحدث للأقدم
-        transactions.sort(key=lambda x: x.get('created_at', 0) if x.get('created_at') else 0, reverse=True)
+        transactions = []
+        if include_transactions:
+            docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id))\
+                .order_by('created_at', direction=firestore.Query.DESCENDING).stream()
+            for doc in docs:
+                data = doc.to_dict()
+                data['id'] = doc.id
+                transactions.append(data)
         
         return {
-            'total_debt': total_debt,
+            'total_debt': stats['total_debt'],
             'partners_count': len(partners),
+            'transactions_count': stats['transactions_count'],
             'transactions': transactions,
             'partners_summary': partners
         }
     except Exception as e:
         print(f"❌ خطأ في جلب إحصائيات المحاسبة: {e}")
-        return {'total_debt': 0, 'partners_count': 0, 'transactions': [], 'partners_summary': {}}
+        return {'total_debt': 0, 'partners_count': 0, 'transactions_count': 0, 'transactions': [], 'partners_summary': {}}
 
 
-def get_partner_transactions(owner_id, partner_name):
-    """جلب عمليات شريك معين"""
+def get_partner_transactions(owner_id, partner_name, limit=None):
+    """جلب عمليات شريك معين (من الأحدث)"""
     try:
         if not db:
             return []
         
-        docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream()
+        query = _ledger_partner_query(owner_id, partner_name)\
+            .order_by('created_at', direction=firestore.Query.DESCENDING)
+        if limit:
+            query = query.limit(limit)
         
         transactions = []
-        for doc in docs:
+        for doc in query.stream():
             data = doc.to_dict()
-            if data.get('partner_name') == partner_name:
-                data['id'] = doc.id
-                transactions.append(data)
-        
-        # ترتيب من الأحدث
-        transactions.sort(key=lambda x: x.get('created_at', 0) if x.get('created_at') else 0, reverse=True)
+            data['id'] = doc.id
+            transactions.append(data)
         return transactions
     except Exception as e:
         print(f"❌ خطأ في جلب عمليات الشريك: {e}")
@@ -1126,24 +1576,30 @@ def settle_partner_debt(owner_id, partner_name):
         if not db:
             return 0, 0
         
-        docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream()
+        _ensure_ledger_summary(owner_id)
+        refs = [doc.reference for doc in _ledger_partner_query(owner_id, partner_name, status='pending').stream()]
         
-        batch = db.batch()
+        def settle(data):
+            if data.get('status') != 'pending':
+                return None  # سُددت في طلب آخر بعد الاستعلام
+            amount = float(data.get('amount', 0))
+            fields = {
+                'status': 'paid',
+                'paid_at': firestore.SERVER_TIMESTAMP,
+                'reminder_bucket': firestore.DELETE_FIELD
+            }
+            return 'update', fields, {'pending': -amount, 'paid': amount, 'count': 0}
+        
+        # كل دفعة Transaction مستقلة مع ملخصها: توقف في المنتصف يترك دفعات مكتملة فقط،
+        # وإعادة التسديد تكمل من العمليات التي ما زالت pending
         count = 0
         total_amount = 0
-        
-        for doc in docs:
-            data = doc.to_dict()
-            if data.get('partner_name') == partner_name and data.get('status') == 'pending':
-                batch.update(doc.reference, {
-                    'status': 'paid',
-                    'paid_at': firestore.SERVER_TIMESTAMP
-                })
-                count += 1
-                total_amount += float(data.get('amount', 0))
+        for start in range(0, len(refs), LEDGER_CHUNK_SIZE):
+            settled = _change_ledger_entries(refs[start:start + LEDGER_CHUNK_SIZE], settle)
+            count += len(settled)
+            total_amount += sum(float(data.get('amount', 0)) for data in settled)
         
         if count > 0:
-            batch.commit()
             print(f"✅ تم تسديد {count} عمليات لـ {partner_name} بمبلغ {total_amount}")
         
         return count, total_amount
@@ -1158,20 +1614,42 @@ def settle_single_transaction(owner_id, transaction_id):
         if not db:
             return False
         
+        _ensure_ledger_summary(owner_id)
         doc_ref = db.collection('ledger').document(transaction_id)
-        doc = doc_ref.get()
         
-        if not doc.exists:
-            return False
-        
-        data = doc.to_dict()
-        if data.get('owner_id') != str(owner_id):
-            return False  # ليس صاحب العملية
+        @firestore.transactional
+        def do_settle(transaction):
+            doc = doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return False
+            
+            data = doc.to_dict()
+            if data.get('owner_id') != str(owner_id):
+                return False  # ليس صاحب العملية
+            if data.get('status') != 'pending':
+                return True  # مسددة مسبقاً
+            
+            amount = float(data.get('amount', 0))
+            owner_ref, partner_ref = _ledger_summary_refs(owner_id, data.get('partner_name', ''))
+            transaction.update(doc_ref, {
+                'status': 'paid',
+                'paid_at': firestore.SERVER_TIMESTAMP,
+                'reminder_bucket': firestore.DELETE_FIELD
+            })
+            transaction.set(partner_ref, {
+                'pending': firestore.Increment(-amount),
+                'paid': firestore.Increment(amount),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            transaction.set(owner_ref, {
+                'total_debt': firestore.Increment(-amount),
+                'total_paid': firestore.Increment(amount),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            return True
         
-        doc_ref.update({
-            'status': 'paid',
-            'paid_at': firestore.SERVER_TIMESTAMP
-        })
+        if not do_settle(db.transaction()):
+            return False
         print(f"✅ تم تسديد عملية {transaction_id}")
         return True
     except Exception as e:
@@ -1185,17 +1663,44 @@ def delete_ledger_transaction(owner_id, transaction_id):
         if not db:
             return False
         
+        _ensure_ledger_summary(owner_id)
         doc_ref = db.collection('ledger').document(transaction_id)
-        doc = doc_ref.get()
         
-        if not doc.exists:
-            return False
+        @firestore.transactional
+        def do_delete(transaction):
+            doc = doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return False
+            
+            data = doc.to_dict()
+            if data.get('owner_id') != str(owner_id):
+                return False
+            
+            amount = float(data.get('amount', 0))
+            is_pending = data.get('status', 'pending') == 'pending'
+            owner_ref, partner_ref = _ledger_summary_refs(owner_id, data.get('partner_name', ''))
+            partner_doc = partner_ref.get(transaction=transaction)
+            last_one = not partner_doc.exists or int(partner_doc.to_dict().get('count', 0)) <= 1
+            
+            transaction.delete(doc_ref)
+            if last_one:
+                transaction.delete(partner_ref)
+            else:
+                transaction.update(partner_ref, {
+                    'pending' if is_pending else 'paid': firestore.Increment(-amount),
+                    'count': firestore.Increment(-1),
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+            transaction.set(owner_ref, {
+                'total_debt' if is_pending else 'total_paid': firestore.Increment(-amount),
+                'transactions_count': firestore.Increment(-1),
+                'partners_count': firestore.Increment(-1 if last_one and partner_doc.exists else 0),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            return True
         
-        data = doc.to_dict()
-        if data.get('owner_id') != str(owner_id):
+        if not do_delete(db.transaction()):
             return False
-        
-        doc_ref.delete()
         print(f"✅ تم حذف عملية {transaction_id}")
         return True
     except Exception as e:
@@ -1218,14 +1723,13 @@ def delete_partner_all_transactions(owner_id, partner_name):
         if not db:
             return 0
         
-        docs = query_where(db.collection('ledger'), 'owner_id', '==', str(owner_id)).stream()
+        _ensure_ledger_summary(owner_id)
+        refs = [doc.reference for doc in _ledger_partner_query(owner_id, partner_name).stream()]
         
+        # الحذف وتحديث الملخص في Transaction واحدة لكل دفعة
         deleted_count = 0
-        for doc in docs:
-            data = doc.to_dict()
-            if data.get('partner_name') == partner_name:
-                doc.reference.delete()
-                deleted_count += 1
+        for start in range(0, len(refs), LEDGER_CHUNK_SIZE):
+            deleted_count += len(_change_ledger_entries(refs[start:start + LEDGER_CHUNK_SIZE], _ledger_delete_change))
         
         print(f"✅ تم حذف {deleted_count} عملية للشريك {partner_name}")
         return deleted_count
@@ -1234,31 +1738,30 @@ def delete_partner_all_transactions(owner_id, partner_name):
         return 0
 
 
-def get_pending_reminders():
+def get_pending_reminders(limit=100):
     """
     جلب التذكيرات المستحقة (للـ scheduler)
-    يُستخدم مع cron job أو APScheduler
+    تقرأ فقط العمليات التي حان رقم ساعتها (reminder_bucket) بدل كل العمليات المعلقة
+    
+    Args:
+        limit: أقصى عدد في الدفعة
     
     Returns:
-        list: قائمة العمليات التي حان وقت تذكيرها
+        list: قائمة العمليات التي حان وقت تذكيرها (الأقدم أولاً)
     """
     try:
         if not db:
             return []
         
-        import datetime
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:00")
-        
-        # جلب العمليات المعلقة التي لها تذكير
-        docs = query_where(db.collection('ledger'), 'status', '==', 'pending').stream()
+        now_bucket = int(time.time() // 3600)
+        docs = query_where(db.collection('ledger'), 'reminder_bucket', '<=', now_bucket)\
+            .order_by('reminder_bucket').limit(limit).stream()
         
         reminders = []
         for doc in docs:
             data = doc.to_dict()
-            reminder = data.get('reminder_date')
-            if reminder and reminder <= now:
-                data['id'] = doc.id
-                reminders.append(data)
+            data['id'] = doc.id
+            reminders.append(data)
         
         return reminders
     except Exception as e:
@@ -1266,6 +1769,92 @@ def get_pending_reminders():
         return []
 
 
+def mark_reminders_sent(transaction_ids):
+    """إزالة التذكيرات من الفهرس بعد إرسالها (حتى لا تُرسل مرة أخرى)"""
+    try:
+        if not db or not transaction_ids:
+            return 0
+        
+        for start in range(0, len(transaction_ids), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for tx_id in transaction_ids[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.update(db.collection('ledger').document(tx_id), {
+                    'reminder_bucket': firestore.DELETE_FIELD,
+                    'reminder_sent_at': firestore.SERVER_TIMESTAMP
+                })
+            batch.commit()
+        return len(transaction_ids)
+    except Exception as e:
+        print(f"❌ خطأ في تحديث التذكيرات: {e}")
+        return 0
+
+
+def mark_reminders_failed(transaction_ids, reason=''):
+    """إزالة تذكيرات لا يمكن إرسالها من الفهرس (المستخدم حظر البوت، المحادثة غير موجودة...)"""
+    try:
+        if not db or not transaction_ids:
+            return 0
+        
+        for start in range(0, len(transaction_ids), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for tx_id in transaction_ids[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.update(db.collection('ledger').document(tx_id), {
+                    'reminder_bucket': firestore.DELETE_FIELD,
+                    'reminder_failed_at': firestore.SERVER_TIMESTAMP,
+                    'reminder_error': str(reason)[:200]
+                })
+            batch.commit()
+        return len(transaction_ids)
+    except Exception as e:
+        print(f"❌ خطأ في تحديث التذكيرات الفاشلة: {e}")
+        return 0
+
+
+def defer_reminders(transactions, reason='', max_attempts=6, max_backoff_hours=24):
+    """
+    تأجيل تذكيرات فشل إرسالها لخطأ مؤقت: عداد محاولات + تقديم reminder_bucket
+    بتأجيل متزايد (1، 2، 4... ساعات) حتى تذهب لآخر الطابور ولا تملأ كل دفعة
+    بعد max_attempts محاولات تُلغى (mark_reminders_failed)
+    
+    Args:
+        transactions: العمليات كما رجعت من get_pending_reminders
+    
+    Returns:
+        int: عدد العمليات التي تم تأجيلها أو إلغاؤها
+    """
+    try:
+        if not db or not transactions:
+            return 0
+        
+        now_bucket = int(time.time() // 3600)
+        exhausted = []
+        batch = db.batch()
+        pending_writes = 0
+        for tx in transactions:
+            attempts = int(tx.get('reminder_attempts', 0)) + 1
+            if attempts >= max_attempts:
+                exhausted.append(tx['id'])
+                continue
+            batch.update(db.collection('ledger').document(tx['id']), {
+                'reminder_attempts': attempts,
+                'reminder_bucket': now_bucket + min(2 ** (attempts - 1), max_backoff_hours),
+                'reminder_error': str(reason)[:200]
+            })
+            pending_writes += 1
+            if pending_writes == FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = db.batch()
+                pending_writes = 0
+        if pending_writes:
+            batch.commit()
+        
+        mark_reminders_failed(exhausted, reason)
+        return len(transactions)
+    except Exception as e:
+        print(f"❌ خطأ في تأجيل التذكيرات: {e}")
+        return 0
+
+
 def get_ledger_transaction_by_id(owner_id, transaction_id_partial):
     """جلب عملية بمعرفها (كامل أو جزئي)"""
     try:
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+كاش HTTP لصفحات الكتالوج (ETag + Cache-Control)
+===============================================
+صفحات وواجهات الكتالوج لا تتغير إلا مع تغير رقم نسخة الكتالوج (catalog_version)،
+فالـ ETag يُحسب قبل تنفيذ المسار من:
+رقم النسخة + الرابط + رقم الإصدار + بيانات الجلسة التي تظهر في الصفحة
+
+- If-None-Match مطابق: 304 فوراً (بدون قراءة Firestore ولا رسم القالب)
+- الزائر: public مع s-maxage للـ CDN (والمتصفح يتحقق في كل مرة)
+- المسجل: private, no-cache (الرصيد وعدد السلة يُحدثان من /api/user_bits)
+"""
+
+import time
+import hashlib
+from functools import wraps
+
+from flask import request, session, make_response
+
+from catalog_version import get_catalog_version
+from config import RELEASE_ID, CATALOG_S_MAXAGE
+
+# بدون رقم إصدار من البيئة: وقت تشغيل العملية (صفحات النسخة القديمة لا تُستخدم بعد النشر)
+_release = RELEASE_ID or f"{int(time.time() * 1000):x}"
+
+# بيانات الجلسة التي تظهر في قوالب الكتالوج
+SESSION_ETAG_FIELDS = ('user_id', 'user_name', 'profile_photo', 'is_admin')
+
+
+def catalog_etag():
+    """ETag الطلب الحالي (نفس الرابط ونفس الجلسة ونفس النسخة = نفس المحتوى)"""
+    parts = [get_catalog_version(), _release, request.full_path]
+    parts.extend(str(session.get(field) or '') for field in SESSION_ETAG_FIELDS)
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def catalog_cache_control(is_public, s_maxage=CATALOG_S_MAXAGE):
+    if is_public:
+        return f'public, max-age=0, must-revalidate, s-maxage={s_maxage}'
+    return 'private, no-cache'
+
+
+def catalog_cached(s_maxage=CATALOG_S_MAXAGE):
+    """
+    Decorator لمسارات الكتالوج (GET): ETag قوي + 304 + Cache-Control
+    الردود غير 200 تمر كما هي بدون كاش
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = catalog_etag()
+            is_public = not session.get('user_id')
+
+            if request.if_none_match.contains_weak(etag):  # الرد المضغوط يحمل ETag ضعيفاً
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = catalog_cache_control(is_public, s_maxage)
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+عميل HTTP المشترك
+=================
+كل الاتصالات الخارجية (EdfaPay، Authentica، Telegram) تمر من هنا:
+- Session واحدة مع مجمع اتصالات لكل host (بدون TCP+TLS جديد لكل طلب)
+- إعادة محاولة تلقائية مع backoff (أخطاء الاتصال دائماً، وأخطاء القراءة/5xx للطلبات الآمنة فقط)
+- مهلات قصيرة (اتصال/قراءة) بدل 30 ثانية
+- إحصائيات زمن الاستجابة لكل host
+- قاطع دائرة لكل خدمة: عند توقفها تُرفض الطلبات فوراً بدل انتظار المهلة
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from circuit_breaker import get_breaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# ==================== الإعدادات ====================
+
+# (مهلة الاتصال، مهلة القراءة) بالثواني
+DEFAULT_TIMEOUT = (3.05, 10)
+EDFAPAY_TIMEOUT = (3.05, 15)
+AUTHENTICA_TIMEOUT = (3.05, 10)
+TELEGRAM_TIMEOUT = (3.05, 15)
+
+POOL_CONNECTIONS = 10  # عدد الـ hosts المحتفظ بمجمعاتها
+POOL_MAXSIZE = 20      # اتصالات مفتوحة لكل host (≥ عدد الـ threads)
+
+# الطلبات الآمنة فقط يُعاد إرسالها بعد وصولها للخادم (POST قد ينفذ مرتين)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+LATENCY_SAMPLES = 200  # عدد القياسات المحفوظة لكل host (لحساب p95)
+
+
+def _build_retry():
+    """
+    سياسة إعادة المحاولة:
+    - فشل الاتصال (الطلب لم يصل): حتى مرتين لكل الطلبات
+    - فشل القراءة أو 502/503/504: للطلبات الآمنة فقط
+    """
+    return Retry(
+        total=3,
+        connect=2,
+        read=1,
+        status=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=IDEMPOTENT_METHODS,
+        raise_on_status=False,
+        respect_retry_after_header=True
+    )
+
+
+# ==================== الإحصائيات ====================
+
+class HostMetrics:
+    """عدد الطلبات والأخطاء وزمن الاستجابة لكل host"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, elapsed_ms, status_code=None, error=None):
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = {
+                    'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'last_status': None, 'last_error': None,
+                    'samples': deque(maxlen=LATENCY_SAMPLES)
+                }
+                self._hosts[host] = stats
+            stats['requests'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['samples'].append(elapsed_ms)
+            stats['last_status'] = status_code
+            if error is not None or (status_code and status_code >= 500):
+                stats['errors'] += 1
+                stats['last_error'] = str(error or status_code)[:200]
+
+    def snapshot(self):
+        """ملخص الإحصائيات (للوحة التحكم)"""
+        with self._lock:
+            result = {}
+            for host, stats in self._hosts.items():
+                samples = sorted(stats['samples'])
+                p95 = samples[int(len(samples) * 0.95) - 1] if samples else 0
+                result[host] = {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'avg_ms': round(stats['total_ms'] / stats['requests'], 1) if stats['requests'] else 0,
+                    'p95_ms': round(p95, 1),
+                    'max_ms': round(stats['max_ms'], 1),
+                    'last_status': stats['last_status'],
+                    'last_error': stats['last_error']
+                }
+            return result
+
+
+metrics = HostMetrics()
+
+
+class ServiceUnavailable(CircuitOpenError, requests.exceptions.ConnectionError):
+    """
+    القاطع مفتوح - الطلب لم يُرسل
+    ترث من ConnectionError حتى تلتقطها معالجات requests الموجودة كخطأ اتصال عادي
+    """
+
+
+# ==================== الـ Session ====================
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Session مشتركة (تُنشأ مرة واحدة لكل عملية)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_CONNECTIONS,
+                    pool_maxsize=POOL_MAXSIZE,
+                    max_retries=_build_retry()
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, timeout=None, breaker=None, **kwargs):
+    """
+    إرسال طلب عبر الـ Session المشتركة مع تسجيل زمن الاستجابة
+
+    نفس واجهة requests.request (ترجع Response وترمي نفس الاستثناءات)
+
+    Args:
+        breaker: اسم قاطع الدائرة للخدمة ('edfapay', 'authentica', 'telegram')
+                 أخطاء الاتصال والمهلة وردود 5xx تُحسب فشلاً، وردود 4xx نجاحاً (الخدمة تعمل)
+    """
+    host = urlparse(url).netloc
+    circuit = get_breaker(breaker) if breaker else None
+    if circuit and not circuit.allow():
+        metrics.record(host, 0, error='CircuitOpen')
+        raise ServiceUnavailable(breaker, circuit.retry_after())
+
+    started = time.perf_counter()
+    try:
+        response = get_session().request(method, url, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+    except requests.exceptions.RequestException as e:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.record(host, elapsed_ms, error=type(e).__name__)
+        if circuit:
+            circuit.record_failure(elapsed_ms, type(e).__name__)
+        raise
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    metrics.record(host, elapsed_ms, status_code=response.status_code)
+    if circuit:
+        if response.status_code >= 500:
+            circuit.record_failure(elapsed_ms, f"HTTP {response.status_code}")
+        else:
+            circuit.record_success(elapsed_ms)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get_http_metrics():
+    """إحصائيات الاتصالات الخارجية لكل host"""
+    return metrics.snapshot()
+
+
+# ==================== تيليجرام ====================
+
+def _telegram_request_sender(method, url, **kwargs):
+    """
+    مرسل طلبات pyTelegramBotAPI (CUSTOM_REQUEST_SENDER)
+    كل رد على send* يُحدّث حالة إمكانية مراسلة المستخدم (بدون طلبات إضافية)
+    """
+    response = request(method, url, breaker='telegram', **kwargs)
+    try:
+        from deliverability_store import deliverability
+        deliverability.learn_from_response(url.rsplit('/', 1)[-1], kwargs.get('params'), response)
+    except Exception as e:
+        logger.error(f"خطأ في تحديث حالة المراسلة: {e}")
+    return response
+
+
+def install_telebot_session():
+    """
+    توجيه كل طلبات البوت (send_message, get_file...) عبر الـ Session المشتركة
+    مع مهلات أقصر من الافتراضي (15/30 ثانية)
+    """
+    try:
+        from telebot import apihelper
+    except ImportError:
+        return False
+    apihelper.CUSTOM_REQUEST_SENDER = _telegram_request_sender
+    apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT = TELEGRAM_TIMEOUT
+    return True
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+مفاتيح عدم التكرار (Idempotency Keys)
+=====================================
+الضغط المزدوج أو إعادة الإرسال من الجوال لا يعيد تنفيذ عملية الشراء أو الدفع:
+
+- الواجهة ترسل Idempotency-Key فريد لكل عملية (ونفس المفتاح عند إعادة المحاولة)
+- أول طلب يحجز المفتاح وينفذ العملية ثم يحفظ الرد لفترة قصيرة
+- الطلب المكرر يأخذ الرد المحفوظ مباشرة من المخزن (بدون Firestore)
+- الطلب المكرر أثناء تنفيذ الأول ينتظر نتيجته بدل التنفيذ مرة ثانية
+
+المفتاح مرتبط بالمستخدم وبمحتوى الطلب، وتعمل فوق المخزن المشترك (Redis أو الذاكرة المحلية)
+"""
+
+import json
+import time
+import hashlib
+import logging
+from functools import wraps
+
+from flask import request, session, jsonify, make_response
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 100
+
+PENDING_TTL = 60          # مدة حجز المفتاح أثناء التنفيذ (تُحرر تلقائياً إذا توقفت العملية)
+RESULT_TTL = 10 * 60      # مدة حفظ الرد
+WAIT_SECONDS = 20         # أقصى انتظار للطلب المكرر أثناء تنفيذ الأول
+WAIT_INTERVAL = 0.1
+
+_PENDING = 'pending'
+
+
+class IdempotencyStore:
+    """الردود المحفوظة لكل (نطاق، مستخدم، مفتاح)"""
+
+    def __init__(self, backend=None, prefix='idem'):
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, scope, user_id, key):
+        return f"{self.prefix}:{scope}:{user_id}:{key}"
+
+    def begin(self, scope, user_id, key, fingerprint):
+        """
+        حجز المفتاح أو جلب نتيجته
+
+        Returns:
+            tuple: ('new', None) نفذ العملية
+                   ('done', record) رد محفوظ
+                   ('mismatch', None) نفس المفتاح بمحتوى مختلف
+                   ('busy', None) ما زال الطلب الأول قيد التنفيذ بعد انتهاء الانتظار
+        """
+        store_key = self._key(scope, user_id, key)
+        pending = json.dumps({'state': _PENDING, 'fp': fingerprint})
+        if self.backend.set(store_key, pending, ex=PENDING_TTL, nx=True):
+            return 'new', None
+
+        deadline = time.time() + WAIT_SECONDS
+        while True:
+            raw = self.backend.get(store_key)
+            if raw is None:
+                # انتهى الحجز بدون نتيجة (فشل الطلب الأول): نحاول الحجز من جديد
+                if self.backend.set(store_key, pending, ex=PENDING_TTL, nx=True):
+                    return 'new', None
+                # طلب آخر حجزه قبلنا: ننتظر نتيجته مثل الحالة العادية
+                if time.time() >= deadline:
+                    return 'busy', None
+                time.sleep(WAIT_INTERVAL)
+                continue
+
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                record = {}
+            if record.get('fp') != fingerprint:
+                return 'mismatch', None
+            if record.get('state') != _PENDING:
+                return 'done', record
+            if time.time() >= deadline:
+                return 'busy', None
+            time.sleep(WAIT_INTERVAL)
+
+    def complete(self, scope, user_id, key, fingerprint, body, status, mimetype):
+        """حفظ الرد النهائي"""
+        record = {'state': 'done', 'fp': fingerprint, 'body': body, 'status': status, 'mimetype': mimetype}
+        self.backend.set(self._key(scope, user_id, key), json.dumps(record, ensure_ascii=False), ex=RESULT_TTL)
+
+    def release(self, scope, user_id, key):
+        """تحرير المفتاح بدون نتيجة (خطأ في الخادم) ليُعاد التنفيذ عند إعادة المحاولة"""
+        self.backend.delete(self._key(scope, user_id, key))
+
+
+idempotency_store = IdempotencyStore()
+
+
+def idempotent(scope):
+    """
+    Decorator لمسار POST: يطبق Idempotency-Key إذا أرسلته الواجهة
+    (بدون المفتاح يعمل المسار كما هو)
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.headers.get(IDEMPOTENCY_HEADER) or '').strip()
+            user_id = session.get('user_id')
+            if not key or not user_id:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'status': 'error', 'success': False, 'message': 'مفتاح الطلب غير صالح'}), 400
+
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()[:32]
+            try:
+                state, record = idempotency_store.begin(scope, user_id, key, fingerprint)
+            except Exception as e:
+                # المخزن غير متاح: لا نمنع العملية
+                logger.error(f"خطأ في مخزن مفاتيح عدم التكرار: {e}")
+                return view(*args, **kwargs)
+
+            if state == 'done':
+                response = make_response(record.get('body', ''), record.get('status', 200))
+                response.mimetype = record.get('mimetype') or 'application/json'
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if state == 'mismatch':
+                return jsonify({'status': 'error', 'success': False, 'message': 'تم استخدام مفتاح الطلب لعملية أخرى'}), 422
+            if state == 'busy':
+                return jsonify({'status': 'error', 'success': False, 'message': 'طلبك السابق ما زال قيد التنفيذ'}), 409
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency_store.release(scope, user_id, key)
+                raise
+
+            try:
+                if response.status_code < 500 and not response.is_streamed:
+                    idempotency_store.complete(
+                        scope, user_id, key, fingerprint,
+                        response.get_data(as_text=True), response.status_code, response.mimetype
+                    )
+                else:
+                    idempotency_store.release(scope, user_id, key)
+            except Exception as e:
+                logger.error(f"خطأ في حفظ رد الطلب: {e}")
+            return response
+        return wrapper
+    return decorator
@@ -18,6 +18,8 @@ import arabic_reshaper
 from bidi.algorithm import get_display
 from fpdf import FPDF
 
+from circuit_breaker import get_breaker
+
 logger = logging.getLogger(__name__)
 
 # مسار الخطوط العربية
@@ -325,19 +327,20 @@ def send_withdrawal_invoice_email(to_email: str, withdrawal_data: dict):
             msg.attach(pdf_attachment)
 
             # إرسال الإيميل
-            try:
-                with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=15) as server:
-                    server.login(SMTP_EMAIL, SMTP_PASSWORD)
-                    server.send_message(msg)
-                    logger.info(f"✅ تم إرسال فاتورة السحب إلى: {to_email}")
-            except Exception:
-                with smtplib.SMTP(SMTP_SERVER, 587, timeout=15) as server:
-                    server.ehlo()
-                    server.starttls()
-                    server.ehlo()
-                    server.login(SMTP_EMAIL, SMTP_PASSWORD)
-                    server.send_message(msg)
-                    logger.info(f"✅ تم إرسال فاتورة السحب (TLS) إلى: {to_email}")
+            with get_breaker('smtp').guard():
+                try:
+                    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=15) as server:
+                        server.login(SMTP_EMAIL, SMTP_PASSWORD)
+                        server.send_message(msg)
+                        logger.info(f"✅ تم إرسال فاتورة السحب إلى: {to_email}")
+                except Exception:
+                    with smtplib.SMTP(SMTP_SERVER, 587, timeout=15) as server:
+                        server.ehlo()
+                        server.starttls()
+                        server.ehlo()
+                        server.login(SMTP_EMAIL, SMTP_PASSWORD)
+                        server.send_message(msg)
+                        logger.info(f"✅ تم إرسال فاتورة السحب (TLS) إلى: {to_email}")
 
         except Exception as e:
             logger.error(f"⚠️ فشل إرسال فاتورة السحب إلى {to_email}: {e}")
@@ -4,9 +4,13 @@
 يُستخدم لإرسال إشعارات تلقائية بجميع العمليات المهمة
 """
 
+import time
 import logging
 import threading
-from extensions import bot, BOT_ACTIVE, ADMIN_ID, db
+from concurrent.futures import ThreadPoolExecutor
+from extensions import bot, BOT_ACTIVE, ADMIN_ID
+from circuit_breaker import get_breaker
+from admin_cache import admin_registry
 
 # استيراد معرف قناة التفاعلات
 try:
@@ -14,17 +18,68 @@ try:
 except ImportError:
     ACTIVITY_CHANNEL_ID = ""
 
-try:
-    from google.cloud.firestore_v1.base_query import FieldFilter
-    USE_FIELD_FILTER = True
-except ImportError:
-    USE_FIELD_FILTER = False
-
 logger = logging.getLogger(__name__)
 
 
 # ==================== إرسال الإشعارات بالتوازي ====================
 
+FANOUT_WORKERS = 8          # رسائل متزامنة لعدة مستلمين
+FANOUT_PER_SECOND = 20      # أقل من حد تيليجرام العام (30 رسالة/ثانية)
+
+_fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='notify')
+
+
+class _SendRateLimiter:
+    """توزيع الرسائل على فترات ثابتة (مشترك بين كل الإرسال المتوازي في العملية)"""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_send_limiter = _SendRateLimiter(FANOUT_PER_SECOND)
+
+
+def fan_out(recipients, send, wait=True):
+    """
+    تنفيذ send(chat_id) لكل مستلم بالتوازي مع الالتزام بحد الإرسال
+
+    Args:
+        recipients: قائمة chat_ids
+        send: دالة الإرسال لمستلم واحد
+        wait: انتظار انتهاء الإرسال
+
+    Returns:
+        dict: {chat_id: None أو الخطأ} إذا wait=True
+    """
+    def send_one(chat_id):
+        _send_limiter.wait()
+        send(chat_id)
+
+    futures = {chat_id: _fanout_executor.submit(send_one, chat_id) for chat_id in recipients}
+    if not wait:
+        return {}
+
+    results = {}
+    for chat_id, future in futures.items():
+        try:
+            future.result()
+            results[chat_id] = None
+        except Exception as e:
+            logger.error(f"خطأ في إرسال رسالة لـ {chat_id}: {e}")
+            results[chat_id] = e
+    return results
+
+
 def send_message_async(chat_id, message, parse_mode='HTML'):
     """إرسال رسالة في thread منفصل (لا ينتظر)"""
     def send():
@@ -54,15 +109,8 @@ def notify_multiple_async(recipients, message, parse_mode='HTML'):
         message: نص الرسالة
         parse_mode: تنسيق الرسالة
     """
-    def send_all():
-        for chat_id in recipients:
-            try:
-                if BOT_ACTIVE and bot:
-                    bot.send_message(chat_id, message, parse_mode=parse_mode)
-            except Exception as e:
-                logger.error(f"خطأ في إرسال رسالة لـ {chat_id}: {e}")
-    
-    threading.Thread(target=send_all, daemon=True).start()
+    if BOT_ACTIVE and bot:
+        fan_out(recipients, lambda chat_id: bot.send_message(chat_id, message, parse_mode=parse_mode), wait=False)
 
 
 def notify_owner(message, parse_mode='HTML'):
@@ -98,28 +146,19 @@ def notify_all_admins(message, parse_mode='HTML'):
     Returns:
         int: عدد المشرفين الذين تم إشعارهم
     """
-    notified = 0
+    if not (BOT_ACTIVE and bot):
+        return 0
     
     try:
-        # إشعار المالك أولاً
-        if notify_owner(message, parse_mode):
-            notified += 1
-        
-        # إشعار بقية المشرفين
-        if db and BOT_ACTIVE and bot:
-            admins = db.collection('admins').stream()
-            for admin_doc in admins:
-                admin_data = admin_doc.to_dict()
-                try:
-                    bot.send_message(int(admin_data['telegram_id']), message, parse_mode=parse_mode)
-                    notified += 1
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_data.get('telegram_id')}: {e}")
-        
-        return notified
+        # المالك والمشرفين من القائمة المحفوظة، والإرسال بالتوازي
+        results = fan_out(
+            admin_registry.recipients(),
+            lambda chat_id: bot.send_message(chat_id, message, parse_mode=parse_mode)
+        )
+        return sum(1 for error in results.values() if error is None)
     except Exception as e:
         logger.error(f"Error notifying admins: {e}")
-    return notified
+    return 0
 
 
 def is_admin_or_owner(telegram_id):
@@ -133,20 +172,8 @@ def is_admin_or_owner(telegram_id):
         bool: True إذا كان مشرف أو مالك
     """
     try:
-        # المالك الرئيسي
-        if int(telegram_id) == ADMIN_ID:
-            return True
-        
-        # التحقق من جدول المشرفين
-        if db:
-            if USE_FIELD_FILTER:
-                admins = db.collection('admins').where(filter=FieldFilter('telegram_id', '==', str(telegram_id))).get()
-            else:
-                admins = db.collection('admins').where('telegram_id', '==', str(telegram_id)).get()
-            return len(list(admins)) > 0
-        
-        return False
-    except:
+        return admin_registry.is_admin_or_owner(telegram_id)
+    except Exception:
         return False
 
 
@@ -465,7 +492,7 @@ def send_activity_notification(activity_type, user_id, username=None, details=No
 
 # ==================== إرسال بيانات الطلب بالإيميل ====================
 
-def send_order_email(to_email, order_items, total_price, new_balance=None):
+def send_order_email(to_email, order_items, total_price, new_balance=None, wait=False):
     """
     إرسال بيانات الطلب عبر الإيميل للمشتري
     
@@ -474,8 +501,9 @@ def send_order_email(to_email, order_items, total_price, new_balance=None):
         order_items: قائمة المنتجات [{'name', 'price', 'order_id', 'hidden_data'(مفكوك), 'delivery_type'}]
         total_price: إجمالي السعر
         new_balance: الرصيد المتبقي (اختياري)
+        wait: الإرسال في نفس الـ thread مع رمي الخطأ عند الفشل (لإعادة المحاولة من الـ outbox)
     """
-    def _send():
+    def _send(raise_errors=False):
         try:
             import smtplib
             from email.mime.text import MIMEText
@@ -562,21 +590,28 @@ def send_order_email(to_email, order_items, total_price, new_balance=None):
             msg.attach(MIMEText("تم الشراء بنجاح! افتح الرسالة لعرض التفاصيل.", 'plain', 'utf-8'))
             msg.attach(MIMEText(html, 'html', 'utf-8'))
 
-            try:
-                with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=15) as server:
-                    server.login(SMTP_EMAIL, SMTP_PASSWORD)
-                    server.send_message(msg)
-                    logger.info(f"✅ تم إرسال إيميل الطلب إلى: {to_email}")
-            except Exception:
-                with smtplib.SMTP(SMTP_SERVER, 587, timeout=15) as server:
-                    server.ehlo()
-                    server.starttls()
-                    server.ehlo()
-                    server.login(SMTP_EMAIL, SMTP_PASSWORD)
-                    server.send_message(msg)
-                    logger.info(f"✅ تم إرسال إيميل الطلب (TLS) إلى: {to_email}")
+            with get_breaker('smtp').guard():
+                try:
+                    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=15) as server:
+                        server.login(SMTP_EMAIL, SMTP_PASSWORD)
+                        server.send_message(msg)
+                        logger.info(f"✅ تم إرسال إيميل الطلب إلى: {to_email}")
+                except Exception:
+                    with smtplib.SMTP(SMTP_SERVER, 587, timeout=15) as server:
+                        server.ehlo()
+                        server.starttls()
+                        server.ehlo()
+                        server.login(SMTP_EMAIL, SMTP_PASSWORD)
+                        server.send_message(msg)
+                        logger.info(f"✅ تم إرسال إيميل الطلب (TLS) إلى: {to_email}")
         except Exception as e:
             logger.error(f"⚠️ فشل إرسال إيميل الطلب إلى {to_email}: {e}")
+            if raise_errors:
+                raise
+
+    if wait:
+        _send(raise_errors=True)
+        return
 
     # إرسال في thread منفصل حتى لا يبطئ الاستجابة
     threading.Thread(target=_send, daemon=True).start()
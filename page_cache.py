@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+كاش الصفحات المرسومة (HTML)
+===========================
+الصفحة الرئيسية وصفحات الأقسام متطابقة لكل الزوار، فبدل قراءة الأقسام والمنتجات
+والمبيعات ورسم القالب في كل طلب:
+
+- الصفحة تُرسم مرة واحدة لكل (المسار + الرابط + نسخة الكتالوج) وتُحفظ في الذاكرة
+- تعديل الكتالوج يغير رقم النسخة، فالصفحات القديمة لا تُستخدم وتخرج بالـ LRU
+- الحجم محدود (PAGE_CACHE_MAX_MB) وتُحذف الأقدم استخداماً عند التجاوز
+- طلبات نفس الصفحة المتزامنة تنتظر رسماً واحداً (single-flight)
+
+بيانات المستخدم (الاسم، الصورة، الرصيد) لا تدخل في الصفحة المحفوظة،
+وتُحمل في المتصفح من /api/user_bits
+"""
+
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+
+from catalog_version import get_catalog_version
+from config import PAGE_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache:
+    """
+    الاستخدام:
+        html = page_cache.get_or_render(('web.index', 'guest', '/'), lambda: render_template(...))
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()  # key -> html
+        self._size = 0
+        self._lock = threading.Lock()
+        # أقفال موزعة حسب المفتاح: نفس الصفحة لا تُرسم مرتين في نفس الوقت
+        self._render_locks = [threading.Lock() for _ in range(32)]
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            html = self._pages.get(key)
+            if html is not None:
+                self._pages.move_to_end(key)
+            return html
+
+    def _set(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._size -= len(old.encode('utf-8'))
+            self._pages[key] = html
+            self._size += size
+            while self._size > self.max_bytes and self._pages:
+                _, evicted = self._pages.popitem(last=False)
+                self._size -= len(evicted.encode('utf-8'))
+
+    def get_or_render(self, key, render):
+        """
+        الصفحة من الكاش أو رسمها (مرة واحدة لكل مفتاح ونسخة كتالوج)
+
+        Args:
+            key: tuple يميز الصفحة (المسار، النوع، الرابط...)
+            render: دالة بدون معاملات ترجع HTML
+        """
+        full_key = (get_catalog_version(),) + tuple(key)
+        html = self._get(full_key)
+        if html is not None:
+            self.hits += 1
+            return html
+
+        lock = self._render_locks[zlib.crc32(repr(full_key).encode('utf-8')) % len(self._render_locks)]
+        with lock:
+            html = self._get(full_key)
+            if html is not None:
+                self.hits += 1
+                return html
+            self.misses += 1
+            html = render()
+            self._set(full_key, html)
+            return html
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pages': len(self._pages),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+page_cache = PageCache(PAGE_CACHE_MAX_MB * 1024 * 1024)
@@ -10,6 +10,7 @@ import hashlib
 import time
 import requests
 
+import http_client
 from config import EDFAPAY_MERCHANT_ID, EDFAPAY_PASSWORD, EDFAPAY_API_URL, SITE_URL
 
 # === دوال مساعدة ===
@@ -69,7 +70,7 @@ def create_edfapay_invoice(user_id, amount, user_name='Customer'):
         print(f"📤 EdfaPay Request: {payload}")
         
         # إرسال الطلب
-        response = requests.post(EDFAPAY_API_URL, data=payload, timeout=30)
+        response = http_client.post(EDFAPAY_API_URL, data=payload, timeout=http_client.EDFAPAY_TIMEOUT, breaker='edfapay')
         print(f"📤 EdfaPay Response Status: {response.status_code}")
         print(f"📤 EdfaPay Response: {response.text[:500]}")
         
@@ -90,6 +91,8 @@ def create_edfapay_invoice(user_id, amount, user_name='Customer'):
                 'error': str(error_msg)
             }
             
+    except http_client.ServiceUnavailable:
+        return {'success': False, 'error': 'بوابة الدفع غير متاحة مؤقتاً، حاول بعد قليل'}
     except requests.exceptions.Timeout:
         return {'success': False, 'error': 'انتهت مهلة الاتصال'}
     except requests.exceptions.RequestException as e:
@@ -117,7 +120,7 @@ def create_wallet_payment(user_id, amount):
         
         print(f"📤 Wallet Pay Request: {payload}")
         
-        response = requests.post(EDFAPAY_API_URL, data=payload, timeout=30)
+        response = http_client.post(EDFAPAY_API_URL, data=payload, timeout=http_client.EDFAPAY_TIMEOUT, breaker='edfapay')
         print(f"📥 EdfaPay Raw Response: {response.text}")
         
         try:
@@ -140,6 +143,9 @@ def create_wallet_payment(user_id, amount):
             print(f"❌ EdfaPay Error: {error_msg}")
             return {'success': False, 'error': error_msg}
             
+    except http_client.ServiceUnavailable:
+        print(f"⚡ Wallet Pay: بوابة الدفع متوقفة مؤقتاً (القاطع مفتوح)")
+        return {'success': False, 'error': 'بوابة الدفع غير متاحة مؤقتاً، حاول بعد قليل'}
     except requests.exceptions.Timeout:
         print(f"❌ Wallet Pay Timeout")
         return {'success': False, 'error': 'انتهى وقت الاتصال - حاول مرة أخرى'}
@@ -161,14 +167,15 @@ def register_callback_url():
     try:
         callback_url = f"{SITE_URL}/payment/edfapay_webhook"
         
-        response = requests.post(
+        response = http_client.post(
             "https://api.edfapay.com/payment/merchants/callback-url",
             json={
                 "action": "post",
                 "id": EDFAPAY_MERCHANT_ID,
                 "url": callback_url
             },
-            timeout=30
+            timeout=http_client.EDFAPAY_TIMEOUT,
+            breaker='edfapay'
         )
         
         print(f"📡 تسجيل Callback URL: {response.status_code}")
@@ -190,13 +197,14 @@ def check_callback_url():
         return None
     
     try:
-        response = requests.post(
+        response = http_client.post(
             "https://api.edfapay.com/payment/merchants/callback-url",
             json={
                 "action": "get",
                 "id": EDFAPAY_MERCHANT_ID
             },
-            timeout=30
+            timeout=http_client.EDFAPAY_TIMEOUT,
+            breaker='edfapay'
         )
         
         if response.status_code == 200:
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+مخزن حدود المحاولات
+===================
+نافذة منزلقة (sliding window) موحدة لتتبع المحاولات الفاشلة والحظر المؤقت
+تعمل فوق المخزن المشترك (Redis أو الذاكرة المحلية) مع انتهاء تلقائي للمفاتيح
+"""
+
+import time
+import uuid
+import logging
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+# ==================== النطاقات المستخدمة ====================
+SCOPE_USER_LOGIN = 'login'                # دخول المستخدمين (auth_routes)
+SCOPE_ADMIN_LOGIN = 'admin_login'         # كلمة مرور لوحة التحكم
+SCOPE_ADMIN_CODE_REQUEST = 'admin_code'   # طلبات إرسال كود لوحة التحكم
+SCOPE_CODE_ATTEMPTS = 'code_attempts'     # محاولات إدخال كود التحقق
+SCOPE_IP_LOGIN = 'ip_login'               # دوال utils العامة
+
+
+class SlidingWindowStore:
+    """تتبع المحاولات داخل نافذة زمنية منزلقة + حظر مؤقت"""
+
+    def __init__(self, backend=None, prefix='rl'):
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _hits_key(self, scope, key):
+        return f"{self.prefix}:{scope}:{key}:hits"
+
+    def _lock_key(self, scope, key):
+        return f"{self.prefix}:{scope}:{key}:lock"
+
+    def hit(self, scope, key, window):
+        """
+        تسجيل محاولة جديدة
+
+        Returns:
+            int: عدد المحاولات داخل النافذة (بعد التسجيل)
+        """
+        now = time.time()
+        hits_key = self._hits_key(scope, key)
+        member = f"{now:.6f}:{uuid.uuid4().hex[:8]}"
+
+        pipe = self.backend.pipeline()
+        pipe.zremrangebyscore(hits_key, 0, now - window)
+        pipe.zadd(hits_key, {member: now})
+        pipe.zcard(hits_key)
+        pipe.expire(hits_key, int(window) + 1)
+        return int(pipe.execute()[2])
+
+    def count(self, scope, key, window):
+        """عدد المحاولات داخل النافذة"""
+        now = time.time()
+        hits_key = self._hits_key(scope, key)
+        pipe = self.backend.pipeline()
+        pipe.zremrangebyscore(hits_key, 0, now - window)
+        pipe.zcard(hits_key)
+        return int(pipe.execute()[1])
+
+    def retry_after(self, scope, key, window):
+        """الثواني المتبقية حتى تخرج أقدم محاولة من النافذة"""
+        oldest = self.backend.zrange(self._hits_key(scope, key), 0, 0, withscores=True)
+        if not oldest:
+            return 0
+        return max(0, int(window - (time.time() - float(oldest[0][1]))))
+
+    def lock(self, scope, key, seconds):
+        """حظر المفتاح لمدة محددة"""
+        self.backend.set(self._lock_key(scope, key), int(time.time() + seconds), ex=int(seconds))
+
+    def lock_remaining(self, scope, key):
+        """الثواني المتبقية من الحظر (0 = غير محظور)"""
+        locked_until = self.backend.get(self._lock_key(scope, key))
+        if not locked_until:
+            return 0
+        return max(0, int(float(locked_until) - time.time()))
+
+    def reset(self, scope, key):
+        """مسح المحاولات والحظر"""
+        self.backend.delete(self._hits_key(scope, key), self._lock_key(scope, key))
+
+    def record_failure(self, scope, key, max_attempts, window, lockout=None):
+        """
+        تسجيل محاولة فاشلة مع حظر تلقائي عند تجاوز الحد
+
+        Returns:
+            int: المحاولات المتبقية (0 = تم الحظر)
+        """
+        attempts = self.hit(scope, key, window)
+        if attempts >= max_attempts:
+            if lockout:
+                self.lock(scope, key, lockout)
+            return 0
+        return max_attempts - attempts
+
+
+# النسخة المشتركة المستخدمة في التطبيق
+rate_limit_store = SlidingWindowStore()
+
+
+def get_client_ip(request):
+    """الحصول على IP العميل (أول عنوان في X-Forwarded-For)"""
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+    if client_ip:
+        client_ip = client_ip.split(',')[0].strip()
+    return client_ip or 'unknown'
@@ -4,17 +4,29 @@
 يحتوي على جميع صفحات وAPI الأدمن
 """
 
-from flask import Blueprint, render_template, request, jsonify, session, redirect
+from flask import Blueprint, render_template, request, jsonify, session, redirect, Response, stream_with_context
 from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 import time
-import random
 import uuid
 import os
 import logging
 from notifications import notify_owner, notify_all_admins, is_admin_or_owner
 from encryption_utils import encrypt_data, decrypt_data
 from invoice_generator import send_withdrawal_invoice_email
+from verification_store import VerificationCodeStore
+from admin_cache import admin_profiles, admin_registry
+from firebase_utils import clear_cache
+from http_cache import catalog_cached
+from page_cache import page_cache
+from services.charge_key_service import (
+    start_charge_keys_generation, get_key_batch, list_batch_keys, iter_batch_export,
+    MAX_KEYS_PER_BATCH, INLINE_KEYS_LIMIT
+)
+from rate_limit_store import (
+    rate_limit_store, get_client_ip,
+    SCOPE_ADMIN_LOGIN, SCOPE_ADMIN_CODE_REQUEST
+)
 
 # 🔒 استيراد نظام Security Logging
 try:
@@ -38,8 +50,15 @@ BOT_ACTIVE = False
 display_settings = {'categories_columns': 3}
 
 # متغيرات للتحكم في الدخول
-admin_login_codes = {}
-failed_login_attempts = {}
+# كود دخول المالك (مفتاح واحد 'owner' - صالح 3 دقائق و5 محاولات)
+admin_login_codes = VerificationCodeStore('admin', ttl=180, max_attempts=5)
+ADMIN_CODE_KEY = 'owner'
+
+# حدود محاولات الدخول (تُحفظ في المخزن الموحد rate_limit_store)
+ADMIN_MAX_ATTEMPTS = 5
+ADMIN_LOCKOUT_SECONDS = 900  # 15 دقيقة
+ADMIN_CODE_REQUESTS_LIMIT = 3
+ADMIN_CODE_REQUESTS_WINDOW = 600  # 10 دقائق
 
 # ===================== دوال مساعدة =====================
 
@@ -96,6 +115,7 @@ def update_category(cat_id, update_data):
     try:
         if db:
             db.collection('categories').document(cat_id).update(update_data)
+            clear_cache('categories')
             return True
     except Exception as e:
         logger.error(f"Error updating category: {e}")
@@ -106,6 +126,7 @@ def delete_category(cat_id):
     try:
         if db:
             db.collection('categories').document(cat_id).delete()
+            clear_cache('categories')
             return True
     except Exception as e:
         logger.error(f"Error deleting category: {e}")
@@ -150,6 +171,7 @@ def delete_product(product_id):
     try:
         if db:
             db.collection('products').document(product_id).delete()
+            clear_cache('products')
             return True
     except Exception as e:
         logger.error(f"Error deleting product: {e}")
@@ -250,61 +272,43 @@ def api_set_header_settings():
 
 # ===================== صفحة الدخول والتحقق =====================
 
-# 🔒 متغير لتتبع طلبات إرسال الكود (حماية إضافية)
-code_request_tracker = {}
-
 @admin_bp.route('/api/admin/send_code', methods=['POST'])
 def api_send_admin_code():
     """إرسال كود التحقق للمالك"""
-    global admin_login_codes, failed_login_attempts, code_request_tracker
-    
     try:
         data = request.json
         password = data.get('password', '')
-        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+        client_ip = get_client_ip(request)
         
         # 🔒 حماية إضافية: تحديد عدد طلبات الكود لكل IP (3 طلبات كل 10 دقائق)
-        current_time = time.time()
-        if client_ip in code_request_tracker:
-            tracker = code_request_tracker[client_ip]
-            # تنظيف الطلبات القديمة (أكثر من 10 دقائق)
-            tracker['requests'] = [t for t in tracker['requests'] if current_time - t < 600]
-            
-            if len(tracker['requests']) >= 3:
-                oldest_request = min(tracker['requests'])
-                wait_time = int(600 - (current_time - oldest_request))
-                return jsonify({
-                    'status': 'error',
-                    'message': f'⚠️ تم تجاوز حد طلبات الكود. انتظر {wait_time} ثانية'
-                })
-        else:
-            code_request_tracker[client_ip] = {'requests': []}
+        requests_count = rate_limit_store.count(SCOPE_ADMIN_CODE_REQUEST, client_ip, ADMIN_CODE_REQUESTS_WINDOW)
+        if requests_count >= ADMIN_CODE_REQUESTS_LIMIT:
+            wait_time = rate_limit_store.retry_after(SCOPE_ADMIN_CODE_REQUEST, client_ip, ADMIN_CODE_REQUESTS_WINDOW)
+            return jsonify({
+                'status': 'error',
+                'message': f'⚠️ تم تجاوز حد طلبات الكود. انتظر {wait_time} ثانية'
+            })
         
         # التحقق من الحظر بسبب محاولات فاشلة
-        if client_ip in failed_login_attempts:
-            attempt_data = failed_login_attempts[client_ip]
-            if attempt_data.get('blocked_until', 0) > time.time():
-                remaining = int(attempt_data['blocked_until'] - time.time())
-                return jsonify({
-                    'status': 'error',
-                    'message': f'⛔ تم حظرك مؤقتاً. حاول بعد {remaining} ثانية'
-                })
+        remaining = rate_limit_store.lock_remaining(SCOPE_ADMIN_LOGIN, client_ip)
+        if remaining > 0:
+            return jsonify({
+                'status': 'error',
+                'message': f'⛔ تم حظرك مؤقتاً. حاول بعد {remaining} ثانية'
+            })
         
         # التحقق من كلمة المرور
         admin_password = os.environ.get('ADMIN_PASS', 'admin123')
         
         if password != admin_password:
             # تسجيل المحاولة الفاشلة
-            if client_ip not in failed_login_attempts:
-                failed_login_attempts[client_ip] = {'count': 0, 'blocked_until': 0}
-            
-            failed_login_attempts[client_ip]['count'] += 1
-            attempts_left = 5 - failed_login_attempts[client_ip]['count']
+            attempts_left = rate_limit_store.record_failure(
+                SCOPE_ADMIN_LOGIN, client_ip,
+                ADMIN_MAX_ATTEMPTS, ADMIN_LOCKOUT_SECONDS, ADMIN_LOCKOUT_SECONDS
+            )
             
             # حظر بعد 5 محاولات
-            if failed_login_attempts[client_ip]['count'] >= 5:
-                failed_login_attempts[client_ip]['blocked_until'] = time.time() + 900
-                
+            if attempts_left == 0:
                 # إرسال تنبيه أمني للمالك
                 try:
                     alert_msg = f"""
@@ -331,20 +335,11 @@ def api_send_admin_code():
                 'message': f'❌ كلمة مرور خاطئة! المحاولات المتبقية: {attempts_left}'
             })
         
-        # كلمة المرور صحيحة - توليد كود عشوائي
-        code = str(random.randint(100000, 999999))
-        
         # 🔒 تسجيل طلب الكود للحماية من الإرسال المتكرر
-        code_request_tracker[client_ip]['requests'].append(current_time)
-        
-        # حفظ الكود مع وقت الانتهاء (3 دقائق)
-        admin_login_codes = {
-            'code': code,
-            'created_at': time.time(),
-            'expires_at': time.time() + 180,
-            'used': False,
-            'ip': client_ip
-        }
+        rate_limit_store.hit(SCOPE_ADMIN_CODE_REQUEST, client_ip, ADMIN_CODE_REQUESTS_WINDOW)
+        
+        # كلمة المرور صحيحة - توليد كود عشوائي وحفظه (ينتهي بعد 3 دقائق)
+        code = admin_login_codes.issue(ADMIN_CODE_KEY, ip=client_ip)
         
         # إرسال الكود للمالك عبر البوت
         try:
@@ -362,8 +357,7 @@ def api_send_admin_code():
                 bot.send_message(ADMIN_ID, code_msg, parse_mode='Markdown')
                 
                 # مسح المحاولات الفاشلة عند النجاح
-                if client_ip in failed_login_attempts:
-                    del failed_login_attempts[client_ip]
+                rate_limit_store.reset(SCOPE_ADMIN_LOGIN, client_ip)
                 
                 return jsonify({'status': 'success', 'message': 'تم إرسال الكود'})
             else:
@@ -385,44 +379,33 @@ def api_send_admin_code():
 @admin_bp.route('/api/admin/verify_code', methods=['POST'])
 def api_verify_admin_code():
     """التحقق من كود الدخول"""
-    global admin_login_codes
-    
     try:
         data = request.json
         code = data.get('code', '').strip()
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
         
-        # التحقق من وجود كود نشط
-        if not admin_login_codes or not admin_login_codes.get('code'):
+        # التحقق من وجود كود نشط (الكود المنتهي يُحذف تلقائياً)
+        if not admin_login_codes.get(ADMIN_CODE_KEY):
             return jsonify({
                 'status': 'error',
-                'message': '❌ لا يوجد كود نشط. اطلب كود جديد'
+                'message': '❌ لا يوجد كود نشط أو انتهت صلاحيته. اطلب كود جديد'
             })
         
-        # التحقق من انتهاء الصلاحية
-        if time.time() > admin_login_codes.get('expires_at', 0):
-            admin_login_codes = {}
+        # التحقق من صحة الكود (كل محاولة تُحتسب)
+        if not admin_login_codes.verify(ADMIN_CODE_KEY, code):
             return jsonify({
                 'status': 'error',
-                'message': '⏰ انتهت صلاحية الكود! اطلب كود جديد'
+                'message': '❌ كود خاطئ!'
             })
         
-        # التحقق من استخدام الكود مسبقاً
-        if admin_login_codes.get('used'):
+        # التحقق من استخدام الكود مسبقاً (طلب متزامن استخدمه قبلنا)
+        if not admin_login_codes.consume(ADMIN_CODE_KEY):
             return jsonify({
                 'status': 'error',
                 'message': '❌ تم استخدام هذا الكود مسبقاً'
             })
         
-        # التحقق من صحة الكود
-        if code != admin_login_codes.get('code'):
-            return jsonify({
-                'status': 'error',
-                'message': '❌ كود خاطئ!'
-            })
-        
         # الكود صحيح - تسجيل الدخول
-        admin_login_codes['used'] = True
         session['is_admin'] = True
         
         # 🔒 تسجيل دخول الأدمن في سجل الأمان
@@ -442,9 +425,6 @@ def api_verify_admin_code():
         except:
             pass
         
-        # مسح الكود
-        admin_login_codes = {}
-        
         return jsonify({'status': 'success', 'message': 'تم التحقق بنجاح'})
         
     except Exception as e:
@@ -1338,6 +1318,7 @@ def api_add_product_new():
         
         if db:
             db.collection('products').document(product_id).set(product_data)
+            clear_cache('products')
             print(f"✅ تم حفظ المنتج في Firebase: {name} (التسليم: {delivery_type})")
         
         return jsonify({'status': 'success', 'product_id': product_id})
@@ -1424,6 +1405,7 @@ def api_add_product():
         }
         
         db.collection('products').document(new_id).set(item)
+        clear_cache('products')
         print(f"✅ تم حفظ المنتج {new_id} في Firestore: {name}")
         
         try:
@@ -1453,35 +1435,68 @@ def api_generate_keys():
         amount = float(data.get('amount'))
         count = int(data.get('count', 1))
         
-        if amount <= 0 or count <= 0 or count > 100:
+        if amount <= 0 or count <= 0 or count > MAX_KEYS_PER_BATCH:
             return {'status': 'error', 'message': 'أرقام غير صحيحة'}
         
-        generated_keys = []
-        batch = db.batch()
-        
-        for _ in range(count):
-            key_code = f"KEY-{random.randint(10000, 99999)}-{random.randint(1000, 9999)}"
-            
-            key_data = {
-                'amount': amount,
-                'used': False,
-                'used_by': None,
-                'created_at': firestore.SERVER_TIMESTAMP
-            }
-            
-            doc_ref = db.collection('charge_keys').document(key_code)
-            batch.set(doc_ref, key_data)
-            
-            generated_keys.append(key_code)
-            
-        batch.commit()
+        # التوليد في الخلفية: اللوحة تتابع الحالة من status_url ثم تحمّل الملف
+        batch_id = start_charge_keys_generation(amount, count, created_by='admin_panel')
         
-        return {'status': 'success', 'keys': generated_keys}
+        return {
+            'status': 'success',
+            'batch_id': batch_id,
+            'count': count,
+            'state': 'generating',
+            'status_url': f"/api/charge_keys/batch/{batch_id}",
+            'download_url': f"/api/charge_keys/batch/{batch_id}/export?format=csv"
+        }
 
     except Exception as e:
         print(f"Error generating keys: {e}")
         return {'status': 'error', 'message': f'فشل التوليد: {str(e)}'}
 
+
+@admin_bp.route('/api/charge_keys/batch/<batch_id>', methods=['GET'])
+def api_key_batch_status(batch_id):
+    """حالة عملية توليد (generating / completed / failed)"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح!'}, 403
+    
+    batch = get_key_batch(batch_id)
+    if not batch:
+        return {'status': 'error', 'message': 'الدفعة غير موجودة'}, 404
+    
+    state = batch.get('status', 'generating')
+    count = batch.get('count', 0)
+    return {
+        'status': 'success',
+        'batch_id': batch_id,
+        'state': state,
+        'count': count,
+        'created_count': batch.get('created_count', 0),
+        'error': batch.get('error', ''),
+        # الأعداد الكبيرة تُحمّل كملف بدل إرجاعها في JSON
+        'keys': list_batch_keys(batch_id) if state == 'completed' and count <= INLINE_KEYS_LIMIT else [],
+        'download_url': f"/api/charge_keys/batch/{batch_id}/export?format=csv"
+    }
+
+
+@admin_bp.route('/api/charge_keys/batch/<batch_id>/export', methods=['GET'])
+def api_export_key_batch(batch_id):
+    """تحميل مفاتيح عملية توليد كملف CSV أو نص (يُرسل تدريجياً)"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح!'}, 403
+    
+    if not get_key_batch(batch_id):
+        return {'status': 'error', 'message': 'الدفعة غير موجودة'}, 404
+    
+    fmt = 'txt' if request.args.get('format') == 'txt' else 'csv'
+    mimetype = 'text/csv' if fmt == 'csv' else 'text/plain'
+    return Response(
+        stream_with_context(iter_batch_export(batch_id, fmt)),
+        mimetype=f'{mimetype}; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename={batch_id}.{fmt}'}
+    )
+
 # ===================== API الأقسام =====================
 
 @admin_bp.route('/api/admin/get_categories', methods=['GET'])
@@ -1549,6 +1564,7 @@ def api_add_category():
         
         if db:
             db.collection('categories').document(cat_id).set(new_category)
+            clear_cache('categories')
             print(f"✅ تم حفظ القسم في Firebase: {name} ({delivery_type})")
         
         return jsonify({'status': 'success', 'category': new_category})
@@ -1599,6 +1615,7 @@ def api_update_category():
                             db.collection('products').document(item['id']).update({'category': new_name})
                         except:
                             pass
+            clear_cache('products')
         
         cat_found.update(update_data)
         return jsonify({'status': 'success', 'category': cat_found})
@@ -1660,6 +1677,7 @@ def api_reorder_categories():
                     db.collection('categories').document(cat_id).update({'order': idx + 1})
                 except:
                     pass
+        clear_cache('categories')
         
         return jsonify({'status': 'success'})
         
@@ -1668,6 +1686,7 @@ def api_reorder_categories():
         return jsonify({'status': 'error', 'message': 'حدث خطأ، حاول لاحقاً'})
 
 @admin_bp.route('/api/categories', methods=['GET'])
+@catalog_cached()
 def api_public_categories():
     """جلب الأقسام للعرض العام"""
     try:
@@ -1686,7 +1705,7 @@ def api_public_categories():
         })
     except Exception as e:
         logger.error(f"Error in public categories: {e}")
-        return jsonify({'status': 'error', 'message': 'حدث خطأ، حاول لاحقاً'})
+        return jsonify({'status': 'error', 'message': 'حدث خطأ، حاول لاحقاً'}), 500
 
 # ===================== إعدادات العرض =====================
 
@@ -1718,6 +1737,7 @@ def api_set_display_settings():
                 db.collection('settings').document('display').set({
                     'categories_columns': cols
                 }, merge=True)
+            clear_cache('categories')  # عدد الأعمدة جزء من /api/categories
             
             return jsonify({'status': 'success'})
         else:
@@ -2129,6 +2149,8 @@ def api_add_manager():
                 admin_data['username'] = telegram_username
             
             db.collection('admins').add(admin_data)
+            admin_profiles.remember(telegram_id, fetched_name)
+            admin_registry.invalidate()
             
             # إشعار المالك
             notify_owner(
@@ -2170,6 +2192,8 @@ def api_delete_manager():
         admin_info = admin_doc.to_dict() if admin_doc.exists else {}
         
         db.collection('admins').document(admin_id).delete()
+        admin_profiles.forget(admin_info.get('telegram_id'))
+        admin_registry.invalidate()
         
         # إشعار المالك
         notify_owner(
@@ -2566,10 +2590,11 @@ def api_clear_cache():
         return jsonify({'status': 'error', 'message': 'غير مصرح'}), 403
     
     try:
-        from firebase_utils import clear_cache, get_cache_status
+        from firebase_utils import get_cache_status
         
         # مسح كل الكاش
         clear_cache()
+        page_cache.clear()
         
         return jsonify({
             'status': 'success',
@@ -2593,13 +2618,47 @@ def api_cache_status():
         
         return jsonify({
             'status': 'success',
-            'cache': status
+            'cache': status,
+            'pages': page_cache.stats()
         })
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
 
+# ===================== الخدمات الخارجية =====================
+
+@admin_bp.route('/api/admin/circuit_breakers')
+def api_circuit_breakers():
+    """حالة قواطع الدائرة وزمن استجابة الخدمات الخارجية (لهذه العملية)"""
+    if not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'غير مصرح'}), 403
+
+    from circuit_breaker import get_breakers_status
+    from http_client import get_http_metrics
+    return jsonify({
+        'status': 'success',
+        'breakers': get_breakers_status(),
+        'hosts': get_http_metrics()
+    })
+
+
+@admin_bp.route('/api/admin/circuit_breakers/reset', methods=['POST'])
+def api_reset_circuit_breaker():
+    """إعادة فتح خدمة يدوياً بعد إصلاحها"""
+    if not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'غير مصرح'}), 403
+
+    from circuit_breaker import get_breaker, BREAKER_SETTINGS
+    name = (request.json or {}).get('name', '')
+    if name not in BREAKER_SETTINGS:
+        return jsonify({'status': 'error', 'message': 'خدمة غير معروفة'}), 400
+
+    get_breaker(name).reset()
+    logger.info(f"⚡ تمت إعادة تشغيل قاطع {name} يدوياً")
+    return jsonify({'status': 'success', 'breaker': get_breaker(name).status()})
+
+
 # ===================== دالة التهيئة =====================
 
 def init_admin(app_db, app_bot, admin_id, app_limiter=None, bot_active=False):
@@ -5,12 +5,13 @@ from flask import Blueprint, request, jsonify, session
 from firebase_utils import (
     get_collection_list, get_collection_data,
     get_balance, get_user_cart, get_products_by_category,
-    get_categories
+    get_categories, get_user_data
 )
 from security_utils import (
     require_session_user, validate_collection_name,
     sanitize_error_message, require_session_user
 )
+from services.photo_service import session_photo_url
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
@@ -27,6 +28,34 @@ def get_user_balance():
     balance = get_balance(user_id)
     return {'balance': balance}
 
+@api_bp.route('/user_bits', methods=['GET'])
+def get_user_bits():
+    """
+    بيانات المستخدم الصغيرة في صفحات المتجر (الاسم، الصورة، الرصيد، عدد السلة، حالة التوثيق)
+    الصفحات نفسها محفوظة بدونها (ETag وكاش الصفحات) فتُحمل منفصلة
+    """
+    user_id = session.get('user_id')
+    bits = {'logged_in': bool(user_id), 'balance': 0, 'cart_count': 0,
+            'phone_verified': False, 'totp_enabled': False}
+
+    if user_id:
+        bits['user_id'] = user_id
+        bits['user_name'] = session.get('user_name', '')
+        bits['profile_photo'] = session_photo_url(session)
+        try:
+            user_data = get_user_data(user_id) or {}  # قراءة واحدة للرصيد وحالة التوثيق
+            bits['balance'] = user_data.get('balance', 0.0)
+            cart = get_user_cart(str(user_id)) or {}
+            bits['cart_count'] = len(cart.get('items', []))
+            bits['phone_verified'] = bool(user_data.get('phone_verified', False))
+            bits['totp_enabled'] = bool(user_data.get('totp_enabled', False))
+        except Exception as e:
+            print(f"❌ خطأ في جلب بيانات المستخدم: {e}")
+
+    response = jsonify(bits)
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
 @api_bp.route('/tabs/list', methods=['GET'])
 def get_tabs_list():
     """جلب قائمة Collections المتاحة كـ tabs - v2"""
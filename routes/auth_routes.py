@@ -3,13 +3,16 @@ Auth Routes - تسجيل الدخول والتحقق والتسجيل
 """
 from flask import Blueprint, request, jsonify, session, redirect, url_for, render_template
 from extensions import db, bot
+from services.photo_service import public_photo_url
 from utils import regenerate_session, generate_code, validate_phone
+from rate_limit_store import rate_limit_store, get_client_ip, SCOPE_USER_LOGIN
 import time
 import logging
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from config import SMTP_SERVER, SMTP_PORT, SMTP_EMAIL, SMTP_PASSWORD
+from circuit_breaker import get_breaker
 
 # === Authentica API (WhatsApp/SMS OTP) ===
 try:
@@ -43,63 +46,38 @@ except ImportError:
 auth_bp = Blueprint('auth', __name__)
 
 # ==================== حماية من محاولات تسجيل الدخول ====================
-# تخزين مؤقت لمحاولات الدخول الفاشلة
-login_failed_attempts = {}  # {ip: {'count': 0, 'blocked_until': 0, 'last_attempt': 0}}
+# المحاولات الفاشلة تُحفظ في المخزن الموحد (نافذة منزلقة 15 دقيقة)
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_WINDOW_SECONDS = 900
+LOGIN_LOCKOUT_SECONDS = 900  # 15 دقيقة
 
 def check_login_rate_limit():
     """التحقق من rate limit لتسجيل الدخول"""
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    if client_ip:
-        client_ip = client_ip.split(',')[0].strip()
+    client_ip = get_client_ip(request)
     
-    current_time = time.time()
-    
-    if client_ip in login_failed_attempts:
-        attempt_data = login_failed_attempts[client_ip]
-        
-        # التحقق من الحظر
-        if attempt_data.get('blocked_until', 0) > current_time:
-            remaining = int(attempt_data['blocked_until'] - current_time)
-            return False, f'⛔ تم حظرك مؤقتاً. حاول بعد {remaining} ثانية'
-        
-        # إعادة تعيين العداد بعد 15 دقيقة من آخر محاولة
-        if current_time - attempt_data.get('last_attempt', 0) > 900:
-            login_failed_attempts[client_ip] = {'count': 0, 'blocked_until': 0, 'last_attempt': current_time}
+    remaining = rate_limit_store.lock_remaining(SCOPE_USER_LOGIN, client_ip)
+    if remaining > 0:
+        return False, f'⛔ تم حظرك مؤقتاً. حاول بعد {remaining} ثانية'
     
     return True, None
 
 def record_failed_login():
     """تسجيل محاولة دخول فاشلة"""
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    if client_ip:
-        client_ip = client_ip.split(',')[0].strip()
-    
-    current_time = time.time()
-    
-    if client_ip not in login_failed_attempts:
-        login_failed_attempts[client_ip] = {'count': 0, 'blocked_until': 0, 'last_attempt': current_time}
-    
-    login_failed_attempts[client_ip]['count'] += 1
-    login_failed_attempts[client_ip]['last_attempt'] = current_time
-    
-    attempts = login_failed_attempts[client_ip]['count']
+    client_ip = get_client_ip(request)
     
     # حظر بعد 5 محاولات فاشلة لمدة 15 دقيقة
-    if attempts >= 5:
-        login_failed_attempts[client_ip]['blocked_until'] = current_time + 900  # 15 دقيقة
+    remaining = rate_limit_store.record_failure(
+        SCOPE_USER_LOGIN, client_ip,
+        LOGIN_MAX_ATTEMPTS, LOGIN_WINDOW_SECONDS, LOGIN_LOCKOUT_SECONDS
+    )
+    if remaining == 0:
         logger.warning(f"⚠️ حظر IP {client_ip} بسبب محاولات دخول فاشلة متكررة")
-        return 0
     
-    return 5 - attempts
+    return remaining
 
 def reset_login_attempts():
     """إعادة تعيين عداد المحاولات بعد دخول ناجح"""
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    if client_ip:
-        client_ip = client_ip.split(',')[0].strip()
-    
-    if client_ip in login_failed_attempts:
-        del login_failed_attempts[client_ip]
+    rate_limit_store.reset(SCOPE_USER_LOGIN, get_client_ip(request))
 
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -157,7 +135,7 @@ def login():
         session.clear()
         session['user_id'] = user_id
         session['user_name'] = user_data.get('username', f'مستخدم {user_id}')
-        session['profile_photo'] = user_data.get('profile_photo', '')
+        session['profile_photo'] = public_photo_url(user_id, user_data)
         session['login_time'] = time.time()
         regenerate_session()
         
@@ -295,7 +273,7 @@ def get_user_profile():
             'username': user_data.get('username'),
             'phone': user_data.get('phone'),
             'balance': user_data.get('balance', 0),
-            'profile_photo': user_data.get('profile_photo', '')
+            'profile_photo': public_photo_url(user_id, user_data)
         }
     })
 
@@ -345,6 +323,13 @@ def send_email_otp(to_email, code):
         msg.attach(MIMEText(f"رمز التحقق: {code}", 'plain', 'utf-8'))
         msg.attach(MIMEText(html_body, 'html', 'utf-8'))
 
+        # ⚡ خادم البريد متوقف: رفض فوري بدل انتظار مهلتي SSL و TLS
+        smtp_breaker = get_breaker('smtp')
+        if not smtp_breaker.allow():
+            print(f"⚡ خادم البريد غير متاح مؤقتاً - لم يتم الإرسال إلى: {to_email}")
+            return False
+        started = time.time()
+
         print(f"📧 محاولة إرسال إيميل إلى: {to_email} عبر {SMTP_SERVER}:{SMTP_PORT}")
         
         # محاولة SSL أولاً (port 465)
@@ -353,6 +338,7 @@ def send_email_otp(to_email, code):
                 server.login(SMTP_EMAIL, SMTP_PASSWORD)
                 server.send_message(msg)
                 print(f"✅ تم إرسال الإيميل بنجاح إلى: {to_email}")
+                smtp_breaker.record_success((time.time() - started) * 1000)
                 return True
         except Exception as ssl_error:
             print(f"⚠️ فشل SSL: {ssl_error}, جاري تجربة TLS...")
@@ -366,9 +352,11 @@ def send_email_otp(to_email, code):
                 server.login(SMTP_EMAIL, SMTP_PASSWORD)
                 server.send_message(msg)
                 print(f"✅ تم إرسال الإيميل بنجاح (TLS) إلى: {to_email}")
+                smtp_breaker.record_success((time.time() - started) * 1000)
                 return True
         except Exception as tls_error:
             print(f"❌ فشل TLS أيضاً: {tls_error}")
+            smtp_breaker.record_failure((time.time() - started) * 1000, tls_error)
             return False
         
     except smtplib.SMTPAuthenticationError as e:
@@ -7,13 +7,15 @@ from datetime import datetime, timedelta
 import random
 
 from extensions import db, FIREBASE_AVAILABLE
-from firebase_utils import get_user_cart, save_user_cart, clear_user_cart, get_balance
+from firebase_utils import get_user_cart, save_user_cart, clear_user_cart, get_balance, clear_cache
 from google.cloud import firestore
 from security_utils import (
     require_session_user, get_session_user_id, verify_user_ownership,
     checkout_with_transaction, log_security_event, sanitize_error_message
 )
 from encryption_utils import decrypt_data
+from idempotency_store import idempotent
+from services.outbox import add_outbox_entry, telegram_payload, order_email_payload, dispatch_async
 
 # استيراد دالة إشعار التفاعلات
 try:
@@ -289,10 +291,117 @@ def api_cart_remove():
         return jsonify({'status': 'error', 'message': 'حدث خطأ'})
 
 
+def build_checkout_outbox(writer, user_id, buyer_name, purchased_items, total, new_balance,
+                          buyer_email='', telegram_username=''):
+    """
+    كتابة آثار شراء السلة في الصادر (ضمن نفس transaction الشراء)
+
+    Returns:
+        list: معرفات مستندات الصادر
+    """
+    import telebot
+
+    outbox_ids = []
+    first_order = purchased_items[0]['order_id']
+
+    # فصل المنتجات الفورية عن اليدوية
+    instant_items = [i for i in purchased_items if i.get('delivery_type') == 'instant']
+    manual_items = [i for i in purchased_items if i.get('delivery_type') == 'manual']
+
+    # رسالة المشتري عبر البوت
+    msg = "🎉 تم شراء سلتك بنجاح!\n\n"
+    
+    if instant_items:
+        msg += "⚡ منتجات تسليم فوري:\n"
+        for item in instant_items:
+            msg += f"📦 {item['name']}\n"
+            msg += f"💰 {item['price']} ر.س\n"
+            msg += f"🆔 #{item['order_id']}\n"
+            if item.get('hidden_data'):
+                # فك تشفير البيانات السرية (الرسالة كاملة تُحفظ مشفرة في الصادر)
+                decrypted_data = decrypt_data(item['hidden_data'])
+                msg += f"🔐 البيانات:\n{decrypted_data}\n"
+            msg += "─────────────\n"
+    
+    if manual_items:
+        msg += "\n👨‍💼 منتجات تسليم يدوي (بانتظار التنفيذ):\n"
+        for item in manual_items:
+            msg += f"📦 {item['name']}\n"
+            msg += f"💰 {item['price']} ر.س\n"
+            msg += f"🆔 #{item['order_id']}\n"
+            msg += "⏳ سيتم تنفيذه قريباً\n"
+            msg += "─────────────\n"
+    
+    msg += f"\n💳 رصيدك المتبقي: {new_balance:.2f} ر.س"
+    outbox_ids.append(add_outbox_entry(
+        writer, 'telegram_message', telegram_payload(user_id, msg), entry_id=f"{first_order}-buyer"
+    ))
+
+    # إشعار الأدمن والمشرفين للطلبات اليدوية
+    for item in manual_items:
+        claim_markup = telebot.types.InlineKeyboardMarkup()
+        claim_markup.add(telebot.types.InlineKeyboardButton(
+            "📋 استلام الطلب", 
+            callback_data=f"claim_order_{item['order_id']}"
+        ))
+        
+        # رسالة بدون بيانات المشتري - ستظهر فقط بعد الاستلام
+        admin_msg = f"🆕 طلب يدوي جديد!\n\n"
+        admin_msg += f"🆔 رقم الطلب: #{item['order_id']}\n"
+        admin_msg += f"📦 المنتج: {item['name']}\n"
+        admin_msg += f"💰 السعر: {item['price']} ر.س\n"
+        admin_msg += f"\n🔒 بيانات المشتري ستظهر بعد الاستلام"
+        admin_msg += f"\n👇 اضغط لاستلام الطلب"
+        outbox_ids.append(add_outbox_entry(
+            writer, 'telegram_admins', telegram_payload(None, admin_msg, reply_markup=claim_markup),
+            entry_id=f"{item['order_id']}-admins"
+        ))
+
+    # إشعار عام للأدمن
+    if ADMIN_ID:
+        admin_msg = f"🛒 شراء سلة جديد!\n\n"
+        admin_msg += f"👤 المشتري: {buyer_name} ({user_id})\n"
+        admin_msg += f"📦 عدد المنتجات: {len(purchased_items)}\n"
+        admin_msg += f"⚡ فوري: {len(instant_items)} | 👨‍💼 يدوي: {len(manual_items)}\n"
+        admin_msg += f"💰 الإجمالي: {total:.2f} ر.س"
+        outbox_ids.append(add_outbox_entry(
+            writer, 'telegram_message', telegram_payload(ADMIN_ID, admin_msg), entry_id=f"{first_order}-owner"
+        ))
+
+    # إرسال بيانات الطلب بالإيميل (إذا مربوط ومفعّل)
+    if buyer_email:
+        email_items = []
+        for item in purchased_items:
+            ei = {
+                'name': item.get('name', ''),
+                'price': item.get('price', 0),
+                'order_id': item.get('order_id', ''),
+                'delivery_type': item.get('delivery_type', 'instant')
+            }
+            if item.get('hidden_data') and item.get('delivery_type') == 'instant':
+                ei['hidden_data'] = decrypt_data(item['hidden_data'])
+            email_items.append(ei)
+        outbox_ids.append(add_outbox_entry(
+            writer, 'order_email', order_email_payload(buyer_email, email_items, total, new_balance),
+            entry_id=f"{first_order}-email"
+        ))
+
+    # إشعار لقناة التفاعلات
+    product_names = ', '.join([item.get('name', 'منتج')[:20] for item in purchased_items[:3]])
+    outbox_ids.append(add_outbox_entry(writer, 'activity', {
+        'activity_type': 'purchase',
+        'user_id': str(user_id),
+        'username': telegram_username,
+        'details': {'product': product_names, 'price': total}
+    }, entry_id=f"{first_order}-activity"))
+
+    return outbox_ids
+
 
 
 @cart_bp.route('/api/cart/checkout', methods=['POST'])
 @require_session_user()
+@idempotent('cart_checkout')
 def api_cart_checkout():
     """إتمام شراء السلة - محمي من Race Condition و Authentication Bypass"""
     global bot, ADMIN_ID
@@ -443,13 +552,20 @@ def api_cart_checkout():
                 except:
                     pass
             
+            # آثار ما بعد الشراء تُكتب في الصادر ضمن نفس الـ transaction
+            # وتُرسل في الخلفية بعد الحفظ
+            outbox_ids = build_checkout_outbox(
+                transaction, user_id, buyer_name, purchased_items_data, total, new_balance,
+                user_data.get('email', '') if user_data.get('email_verified', False) else '',
+                session.get('telegram_username', '')
+            )
+            
             return {
                 'purchased_items': purchased_items_data,
                 'new_balance': new_balance,
                 'buyer_name': buyer_name,
                 'order_ids': order_ids,
-                'buyer_email': user_data.get('email', ''),
-                'email_verified': user_data.get('email_verified', False)
+                'outbox_ids': outbox_ids
             }
         
         # تنفيذ العملية بأمان
@@ -467,128 +583,17 @@ def api_cart_checkout():
         # بعد نجاح العملية
         purchased_items = result['purchased_items']
         new_balance = result['new_balance']
-        buyer_name = result['buyer_name']
         order_ids = result['order_ids']
-        buyer_email = result.get('buyer_email', '')
-        email_verified = result.get('email_verified', False)
         
         # حذف السلة من Firebase
         clear_user_cart(user_id)
+        clear_cache('products')  # المنتجات أصبحت مباعة (نسخة كتالوج جديدة)
         
-        # فصل المنتجات الفورية عن اليدوية
-        instant_items = [i for i in purchased_items if i.get('delivery_type') == 'instant']
-        manual_items = [i for i in purchased_items if i.get('delivery_type') == 'manual']
-        
-        # إرسال البيانات للمشتري عبر البوت
-        if bot:
-            try:
-                msg = "🎉 تم شراء سلتك بنجاح!\n\n"
-                
-                if instant_items:
-                    msg += "⚡ منتجات تسليم فوري:\n"
-                    for item in instant_items:
-                        msg += f"📦 {item['name']}\n"
-                        msg += f"💰 {item['price']} ر.س\n"
-                        msg += f"🆔 #{item['order_id']}\n"
-                        if item.get('hidden_data'):
-                            # فك تشفير البيانات السرية قبل الإرسال
-                            decrypted_data = decrypt_data(item['hidden_data'])
-                            msg += f"🔐 البيانات:\n{decrypted_data}\n"
-                        msg += "─────────────\n"
-                
-                if manual_items:
-                    msg += "\n👨‍💼 منتجات تسليم يدوي (بانتظار التنفيذ):\n"
-                    for item in manual_items:
-                        msg += f"📦 {item['name']}\n"
-                        msg += f"💰 {item['price']} ر.س\n"
-                        msg += f"🆔 #{item['order_id']}\n"
-                        msg += "⏳ سيتم تنفيذه قريباً\n"
-                        msg += "─────────────\n"
-                
-                msg += f"\n💳 رصيدك المتبقي: {new_balance:.2f} ر.س"
-                
-                bot.send_message(int(user_id), msg)
-            except Exception as e:
-                print(f"⚠️ فشل إرسال رسالة للمشتري: {e}")
-            
-            # إشعار الأدمن والمشرفين للطلبات اليدوية
-            if manual_items and ADMIN_ID:
-                try:
-                    import telebot
-                    
-                    # جلب قائمة المشرفين
-                    admin_ids = [ADMIN_ID]  # المالك أولاً
-                    try:
-                        admins_ref = db.collection('admins').stream()
-                        for admin_doc in admins_ref:
-                            admin_data = admin_doc.to_dict()
-                            admin_ids.append(int(admin_data['telegram_id']))
-                    except:
-                        pass
-                    
-                    for item in manual_items:
-                        claim_markup = telebot.types.InlineKeyboardMarkup()
-                        claim_markup.add(telebot.types.InlineKeyboardButton(
-                            "📋 استلام الطلب", 
-                            callback_data=f"claim_order_{item['order_id']}"
-                        ))
-                        
-                        # رسالة بدون بيانات المشتري - ستظهر فقط بعد الاستلام
-                        admin_msg = f"🆕 طلب يدوي جديد!\n\n"
-                        admin_msg += f"🆔 رقم الطلب: #{item['order_id']}\n"
-                        admin_msg += f"📦 المنتج: {item['name']}\n"
-                        admin_msg += f"💰 السعر: {item['price']} ر.س\n"
-                        admin_msg += f"\n🔒 بيانات المشتري ستظهر بعد الاستلام"
-                        admin_msg += f"\n👇 اضغط لاستلام الطلب"
-                        
-                        # إرسال لجميع المشرفين والمالك
-                        for admin_id in admin_ids:
-                            try:
-                                bot.send_message(admin_id, admin_msg, reply_markup=claim_markup)
-                            except Exception as e:
-                                print(f"⚠️ فشل إرسال لـ {admin_id}: {e}")
-                                
-                except Exception as e:
-                    print(f"⚠️ فشل إشعار الأدمنز: {e}")
-            
-            # إشعار عام للأدمن
-            if ADMIN_ID:
-                try:
-                    admin_msg = f"🛒 شراء سلة جديد!\n\n"
-                    admin_msg += f"👤 المشتري: {buyer_name} ({user_id})\n"
-                    admin_msg += f"📦 عدد المنتجات: {len(purchased_items)}\n"
-                    admin_msg += f"⚡ فوري: {len(instant_items)} | 👨‍💼 يدوي: {len(manual_items)}\n"
-                    admin_msg += f"💰 الإجمالي: {total:.2f} ر.س"
-                    bot.send_message(ADMIN_ID, admin_msg)
-                except:
-                    pass
+        dispatch_async(result['outbox_ids'])
         
-        # إرسال بيانات الطلب بالإيميل (إذا مربوط ومفعّل)
-        if buyer_email and email_verified:
-            email_items = []
-            for item in purchased_items:
-                ei = {
-                    'name': item.get('name', ''),
-                    'price': item.get('price', 0),
-                    'order_id': item.get('order_id', ''),
-                    'delivery_type': item.get('delivery_type', 'instant')
-                }
-                if item.get('hidden_data') and item.get('delivery_type') == 'instant':
-                    ei['hidden_data'] = decrypt_data(item['hidden_data'])
-                email_items.append(ei)
-            send_order_email(buyer_email, email_items, total, new_balance)
-
         # تسجيل الحدث الأمني
         log_security_event('CHECKOUT_SUCCESS', user_id, f'الإجمالي: {total}, المنتجات: {len(purchased_items)}')
         
-        # إرسال إشعار لقناة التفاعلات
-        telegram_username = session.get('telegram_username', '')
-        product_names = ', '.join([item.get('name', 'منتج')[:20] for item in purchased_items[:3]])
-        send_activity_notification('purchase', user_id, telegram_username, {
-            'product': product_names,
-            'price': total
-        })
-        
         return jsonify({
             'status': 'success',
             'message': 'تم الشراء بنجاح!',
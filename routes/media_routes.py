@@ -0,0 +1,65 @@
+"""
+Media Routes - الصور المحلية (صور الحسابات، الصور المصغرة للأقسام والمنتجات)
+"""
+from flask import Blueprint, Response, request, session, redirect
+from services.photo_service import get_avatar, avatar_mimetype
+from services.image_proxy import get_image, verify_signature, nearest_width, ImageFetchError
+
+media_bp = Blueprint('media', __name__)
+
+# الرابط يحتوي رقم النسخة (file_unique_id) فيمكن تخزينه في المتصفح سنة كاملة
+AVATAR_MAX_AGE = 365 * 24 * 3600
+AVATAR_FALLBACK_MAX_AGE = 300
+
+# الصور المصغرة: أسبوع في المتصفح وشهر في الـ CDN
+IMAGE_CACHE_CONTROL = 'public, max-age=604800, s-maxage=2592000'
+IMAGE_FALLBACK_MAX_AGE = 300
+
+
+@media_bp.route('/avatar/<user_id>')
+def user_avatar(user_id):
+    """صورة حساب المستخدم (لصاحب الحساب والأدمن فقط)"""
+    if not user_id.isdigit():
+        return Response(status=404)
+    if str(session.get('user_id')) != user_id and not session.get('is_admin'):
+        return Response(status=404)
+
+    version = request.args.get('v')
+    try:
+        data, current_version = get_avatar(user_id, version)
+    except Exception as e:
+        print(f"⚠️ خطأ في عرض صورة الحساب: {e}")
+        data, current_version = None, None
+    if not data:
+        return Response(status=404)
+
+    response = Response(data, mimetype=avatar_mimetype(data))
+    if version and version == current_version:
+        response.headers['Cache-Control'] = f'private, max-age={AVATAR_MAX_AGE}, immutable'
+    else:
+        # رابط بدون نسخة أو نسخة قديمة: كاش قصير
+        response.headers['Cache-Control'] = f'private, max-age={AVATAR_FALLBACK_MAX_AGE}'
+    response.set_etag(current_version)
+    return response.make_conditional(request)
+
+
+@media_bp.route('/img')
+def proxied_image():
+    """صورة مصغرة WebP من رابط خارجي (الرابط يُولد من القوالب عبر img_url)"""
+    src = request.args.get('u', '')
+    if not verify_signature(src, request.args.get('s', '')):
+        return Response(status=403)
+    width = nearest_width(request.args.get('w'))
+
+    try:
+        data = get_image(src, width)
+    except ImageFetchError:
+        # تعذر التجهيز: المتصفح يحمل الأصلية (الرابط موقع فلا يُستخدم كتحويل مفتوح)
+        response = redirect(src, code=302)
+        response.headers['Cache-Control'] = f'public, max-age={IMAGE_FALLBACK_MAX_AGE}'
+        return response
+
+    response = Response(data, mimetype='image/webp')
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    response.set_etag(f"{request.args.get('s')}-{width}")
+    return response.make_conditional(request)
@@ -3,6 +3,8 @@ Profile Routes - مسارات صفحة الحساب الشخصي
 """
 from flask import Blueprint, render_template, session, redirect, url_for, jsonify, request
 from extensions import db, logger, bot, ADMIN_ID, BOT_USERNAME
+from services.order_history import get_recent_orders
+from services.photo_service import public_photo_url
 from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 from telebot import types
@@ -12,7 +14,7 @@ import time
 import base64
 import io
 import os
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 
 # استيراد أدوات التشفير
 try:
@@ -81,6 +83,71 @@ def _get_send_email_otp():
         return lambda *a, **kw: False
 
 
+# ==================== الرصيد المجمد ====================
+# فترة التجميد: 72 ساعة (3 أيام)
+FREEZE_MINUTES = 72 * 60  # 4320 دقيقة = 72 ساعة
+
+
+def _charge_datetime(charge_ts, now):
+    """تحويل وقت الشحنة (Firestore Timestamp / datetime / Unix) إلى datetime بتوقيت UTC"""
+    if charge_ts:
+        if hasattr(charge_ts, 'timestamp'):
+            # DatetimeWithNanoseconds من Firebase
+            return datetime.fromtimestamp(charge_ts.timestamp(), timezone.utc)
+        if isinstance(charge_ts, (int, float)):
+            # Unix timestamp (رقم)
+            return datetime.fromtimestamp(charge_ts, timezone.utc)
+    # إذا لم يوجد وقت صالح، نعتبره "الآن" (مجمد)
+    return now
+
+
+def get_frozen_charges(user_id, now=None):
+    """
+    حساب الرصيد المجمد من شحنات آخر 72 ساعة فقط
+    يستعلم بنافذة زمنية (timestamp >= الآن - 72 ساعة) بدل جلب كل شحنات المستخدم
+    
+    ملاحظة: الشحنات تُسجل بـ SERVER_TIMESTAMP أو بـ time.time()، وهما نوعان مختلفان
+    في Firestore فيُنفذ استعلام لكل نوع (يتطلب فهرس user_id + timestamp)
+    
+    Returns:
+        tuple: (إجمالي المجمد, أطول وقت متبقي بالدقائق, قائمة الشحنات المجمدة)
+    """
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(minutes=FREEZE_MINUTES)
+    charges_query = db.collection('charge_history').where(filter=FieldFilter('user_id', '==', user_id))
+    
+    charges = {}
+    try:
+        for cutoff_value in (cutoff, cutoff.timestamp()):
+            window_query = charges_query.where(filter=FieldFilter('timestamp', '>=', cutoff_value))
+            for charge_doc in window_query.stream():
+                charges[charge_doc.id] = charge_doc.to_dict()
+    except Exception as e:
+        # fallback: جلب كل الشحنات (مثلاً إذا لم يُنشأ الفهرس بعد)
+        logger.warning(f"⚠️ فشل استعلام الشحنات بنافذة زمنية، سيتم جلب الكل: {e}")
+        charges = {doc.id: doc.to_dict() for doc in charges_query.stream()}
+    
+    total_frozen = 0.0
+    max_minutes_left = 0
+    frozen_charges = []
+    
+    for charge in charges.values():
+        charge_dt = _charge_datetime(charge.get('timestamp'), now)
+        minutes_passed = (now - charge_dt).total_seconds() / 60
+        
+        # شرط التجميد
+        if minutes_passed < FREEZE_MINUTES:
+            charge_amount = float(charge.get('amount', 0))
+            minutes_left = int(FREEZE_MINUTES - minutes_passed)
+            total_frozen += charge_amount
+            max_minutes_left = max(max_minutes_left, minutes_left)
+            frozen_charges.append({'amount': charge_amount, 'minutes_left': minutes_left})
+    
+    # ترتيب الشحنات من الأقل وقتاً للأكثر (الأقرب للإتاحة أولاً)
+    frozen_charges.sort(key=lambda x: x['minutes_left'])
+    return total_frozen, max_minutes_left, frozen_charges
+
+
 def send_verification_notification(user_id, user_name, telegram_username, verification_type):
     """إرسال إشعار توثيق للقناة"""
     try:
@@ -148,37 +215,17 @@ def profile():
         
         user_data = user_doc.to_dict()
         
-        # جلب آخر 3 طلبات من collection('orders')
-        orders = []
-        try:
-            # جلب جميع الطلبات مرتبة حسب التاريخ (بدون where للتجنب من الحاجة للـ index)
-            # ثم تصفيتها في الكود
-            orders_query = db.collection('orders').order_by(
-                'created_at', direction='DESCENDING'
-            ).limit(100)  # جلب 100 لأننا سنصفيها
-            
-            orders_docs = orders_query.stream()
-            
-            for order_doc in orders_docs:
-                order_data = order_doc.to_dict()
-                # تصفية حسب buyer_id
-                if order_data.get('buyer_id') == user_id:
-                    orders.append({
-                        'id': order_doc.id,
-                        'product_name': order_data.get('item_name', 'منتج'),
-                        'price': order_data.get('price', 0),
-                        'status': order_data.get('status', 'pending'),
-                        'created_at': order_data.get('created_at'),
-                        'quantity': 1,
-                        'total': order_data.get('price', 0),
-                        'payment_method': order_data.get('payment_method', 'wallet')
-                    })
-                    # توقف بعد جلب 3 طلبات
-                    if len(orders) >= 3:
-                        break
-        except Exception as e:
-            logger.error(f"خطأ في جلب الطلبات: {e}")
-            orders = []
+        # جلب آخر 3 طلبات للمستخدم (استعلام مفهرس بدل مسح آخر 100 طلب في المتجر)
+        orders = [{
+            'id': order_data['id'],
+            'product_name': order_data.get('item_name', 'منتج'),
+            'price': order_data.get('price', 0),
+            'status': order_data.get('status', 'pending'),
+            'created_at': order_data.get('created_at'),
+            'quantity': 1,
+            'total': order_data.get('price', 0),
+            'payment_method': order_data.get('payment_method', 'wallet')
+        } for order_data in get_recent_orders(user_id, limit=3)]
         
         # تحويل التواريخ إلى صيغة محلية
         for order in orders:
@@ -207,7 +254,7 @@ def profile():
             order['status_ar'] = status_map.get(order.get('status'), 'غير معروف')
         
         # التحقق من وجود الصورة
-        profile_photo = user_data.get('profile_photo', '')
+        profile_photo = public_photo_url(user_id, user_data)
         
         # حساب المبلغ المتاح للسحب العادي باستخدام المعادلة الذهبية
         normal_withdraw_amount = 0
@@ -219,56 +266,10 @@ def profile():
             now = datetime.datetime.now(datetime.timezone.utc)
             
             # ===== المعادلة الذهبية: المتاح = الرصيد الحالي - المجمد =====
-            # فترة التجميد: 72 ساعة (3 أيام)
-            FREEZE_MINUTES = 72 * 60  # 4320 دقيقة = 72 ساعة
-            
-            total_frozen_balance = 0.0
-            min_minutes_left = 0
             recent_charges = []  # آخر 3 شحنات للعرض
             
-            # جلب شحنات المستخدم
-            try:
-                all_user_charges = db.collection('charge_history')\
-                    .where(filter=FieldFilter('user_id', '==', user_id))\
-                    .get()
-            except Exception as query_error:
-                print(f"⚠️ Query failed: {query_error}")
-                all_user_charges = []
-            
-            for charge_doc in all_user_charges:
-                charge = charge_doc.to_dict()
-                charge_amt = float(charge.get('amount', 0))
-                charge_ts = charge.get('timestamp')
-                
-                # --- تصحيح التعامل مع التوقيت ---
-                charge_dt = None
-                
-                if charge_ts:
-                    # التعامل مع أنواع التوقيت المختلفة من Firebase
-                    if hasattr(charge_ts, 'timestamp'):
-                        # DatetimeWithNanoseconds من Firebase
-                        charge_dt = datetime.datetime.fromtimestamp(charge_ts.timestamp(), datetime.timezone.utc)
-                    elif isinstance(charge_ts, datetime.datetime):
-                        # datetime عادي - نتأكد أنه UTC
-                        charge_dt = charge_ts.replace(tzinfo=datetime.timezone.utc) if charge_ts.tzinfo is None else charge_ts
-                    elif isinstance(charge_ts, (int, float)):
-                        # Unix timestamp (رقم)
-                        charge_dt = datetime.datetime.fromtimestamp(charge_ts, datetime.timezone.utc)
-                
-                # إذا لم يوجد وقت صالح، نعتبره "الآن" (مجمد)
-                if not charge_dt:
-                    charge_dt = now
-                
-                # حساب الفرق بالدقائق
-                time_diff = now - charge_dt
-                minutes_passed = time_diff.total_seconds() / 60
-                
-                # شرط التجميد
-                if minutes_passed < FREEZE_MINUTES:
-                    total_frozen_balance += charge_amt
-                    minutes_left = FREEZE_MINUTES - minutes_passed
-                    if minutes_left > min_minutes_left:
-                        min_minutes_left = int(minutes_left)
+            # جلب شحنات آخر 72 ساعة فقط
+            total_frozen_balance, min_minutes_left, _ = get_frozen_charges(user_id, now)
             
             # جلب آخر 3 شحنات للعرض (بدون order_by لتجنب مشكلة الـ Index)
             try:
@@ -426,59 +427,31 @@ def withdraw_page():
         # === حساب الرصيد المتاح للسحب العادي ===
         import datetime as dt
         now = dt.datetime.now(dt.timezone.utc)
-        FREEZE_MINUTES = 72 * 60  # 4320 دقيقة = 72 ساعة
-        
         total_frozen = 0.0
         min_minutes_left = 0
         frozen_charges_list = []  # قائمة الشحنات المجمدة مع أوقاتها
         
         try:
-            user_charges = db.collection('charge_history').where(filter=FieldFilter('user_id', '==', user_id)).get()
+            total_frozen, min_minutes_left, frozen_charges = get_frozen_charges(user_id, now)
             
-            for charge_doc in user_charges:
-                charge = charge_doc.to_dict()
-                charge_amount = float(charge.get('amount', 0))
-                charge_ts = charge.get('timestamp')
+            # إضافة الوقت المتبقي كنص لكل شحنة
+            for charge in frozen_charges:
+                remaining_int = charge['minutes_left']
+                if remaining_int > 60:
+                    hours = remaining_int // 60
+                    mins = remaining_int % 60
+                    time_str = f"{hours} ساعة و {mins} دقيقة"
+                else:
+                    time_str = f"{remaining_int} دقيقة"
                 
-                if charge_ts:
-                    try:
-                        if hasattr(charge_ts, 'timestamp'):
-                            charge_dt = dt.datetime.fromtimestamp(charge_ts.timestamp(), dt.timezone.utc)
-                        elif isinstance(charge_ts, (int, float)):
-                            charge_dt = dt.datetime.fromtimestamp(charge_ts, dt.timezone.utc)
-                        else:
-                            charge_dt = now
-                        
-                        minutes_passed = (now - charge_dt).total_seconds() / 60
-                        
-                        if minutes_passed < FREEZE_MINUTES:
-                            total_frozen += charge_amount
-                            remaining = FREEZE_MINUTES - minutes_passed
-                            if remaining > min_minutes_left:
-                                min_minutes_left = int(remaining)
-                            
-                            # إضافة للقائمة مع الوقت المتبقي
-                            remaining_int = int(remaining)
-                            if remaining_int > 60:
-                                hours = remaining_int // 60
-                                mins = remaining_int % 60
-                                time_str = f"{hours} ساعة و {mins} دقيقة"
-                            else:
-                                time_str = f"{remaining_int} دقيقة"
-                            
-                            frozen_charges_list.append({
-                                'amount': charge_amount,
-                                'time_left': time_str,
-                                'minutes_left': remaining_int
-                            })
-                    except:
-                        pass
+                frozen_charges_list.append({
+                    'amount': charge['amount'],
+                    'time_left': time_str,
+                    'minutes_left': remaining_int
+                })
         except Exception as e:
             logger.error(f"خطأ في حساب الرصيد المجمد: {e}")
         
-        # ترتيب الشحنات من الأقل وقتاً للأكثر (الأقرب للإتاحة أولاً)
-        frozen_charges_list.sort(key=lambda x: x['minutes_left'])
-        
         available_for_normal = max(0, balance - total_frozen)
         
         # تحويل الدقائق لنص مقروء
@@ -676,7 +649,7 @@ def api_profile():
         return jsonify({
             'user_id': user_id,
             'name': user_data.get('name', ''),
-            'profile_photo': user_data.get('profile_photo', ''),
+            'profile_photo': public_photo_url(user_id, user_data),
             'balance': user_data.get('balance', 0)
         })
     
@@ -1287,50 +1260,12 @@ def submit_withdraw():
             fee_percent = 5.5
             
             # ===== المعادلة الذهبية: المتاح = الرصيد الحالي - المجمد =====
-            import datetime
-            now = datetime.datetime.now(datetime.timezone.utc)
-            
-            # فترة التجميد: 72 ساعة (3 أيام)
-            FREEZE_MINUTES = 72 * 60  # 4320 دقيقة = 72 ساعة
-            
             total_frozen_balance = 0.0
             min_minutes_left = 0
             
             try:
-                # جلب شحنات المستخدم
-                all_user_charges = db.collection('charge_history')\
-                    .where(filter=FieldFilter('user_id', '==', user_id))\
-                    .get()
-                
-                for charge_doc in all_user_charges:
-                    charge = charge_doc.to_dict()
-                    charge_amt = float(charge.get('amount', 0))
-                    charge_ts = charge.get('timestamp')
-                    
-                    # --- تصحيح التعامل مع التوقيت ---
-                    charge_dt = None
-                    
-                    if charge_ts:
-                        if hasattr(charge_ts, 'timestamp'):
-                            charge_dt = datetime.datetime.fromtimestamp(charge_ts.timestamp(), datetime.timezone.utc)
-                        elif isinstance(charge_ts, datetime.datetime):
-                            charge_dt = charge_ts.replace(tzinfo=datetime.timezone.utc) if charge_ts.tzinfo is None else charge_ts
-                        elif isinstance(charge_ts, (int, float)):
-                            charge_dt = datetime.datetime.fromtimestamp(charge_ts, datetime.timezone.utc)
-                    
-                    if not charge_dt:
-                        charge_dt = now
-                    
-                    # حساب الفرق بالدقائق
-                    time_diff = now - charge_dt
-                    minutes_passed = time_diff.total_seconds() / 60
-                    
-                    # شرط التجميد
-                    if minutes_passed < FREEZE_MINUTES:
-                        total_frozen_balance += charge_amt
-                        minutes_left = FREEZE_MINUTES - minutes_passed
-                        if minutes_left > min_minutes_left:
-                            min_minutes_left = int(minutes_left)
+                # جلب شحنات آخر 72 ساعة فقط
+                total_frozen_balance, min_minutes_left, _ = get_frozen_charges(user_id)
             except Exception as e:
                 # في حالة الخطأ، نعتبر كل الرصيد متاح
                 total_frozen_balance = 0
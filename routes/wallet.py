@@ -8,8 +8,10 @@ import time
 import hashlib
 import requests
 
+import http_client
+from idempotency_store import idempotent
 from extensions import db, FIREBASE_AVAILABLE
-from firebase_utils import get_balance, add_balance, get_charge_key, use_charge_key, query_where
+from firebase_utils import get_balance, redeem_charge_key, query_where
 from google.cloud import firestore
 from security_utils import (
     require_session_user, get_session_user_id, checkout_with_transaction,
@@ -140,6 +142,7 @@ def wallet_page():
 
 @wallet_bp.route('/wallet/pay', methods=['POST'])
 @require_session_user()
+@idempotent('wallet_pay')  # 🔁 إعادة الإرسال لا تنشئ فاتورة EdfaPay ثانية
 def wallet_pay():
     """معالجة طلب الشحن من صفحة المحفظة - محمي من Authentication Bypass"""
     global pending_payments
@@ -205,7 +208,7 @@ def wallet_pay():
         
         print(f"📤 Wallet Pay Request: {payload}")
         
-        response = requests.post(EDFAPAY_API_URL, data=payload, timeout=30)
+        response = http_client.post(EDFAPAY_API_URL, data=payload, timeout=http_client.EDFAPAY_TIMEOUT, breaker='edfapay')
         
         print(f"📥 EdfaPay Raw Response: {response.text}")
         
@@ -255,6 +258,9 @@ def wallet_pay():
             print(f"❌ EdfaPay Error: {error_msg}")
             return jsonify({'success': False, 'message': error_msg})
             
+    except http_client.ServiceUnavailable:
+        print(f"⚡ Wallet Pay: بوابة الدفع متوقفة مؤقتاً (القاطع مفتوح)")
+        return jsonify({'success': False, 'message': 'بوابة الدفع غير متاحة مؤقتاً، حاول بعد قليل'})
     except requests.exceptions.Timeout:
         print(f"❌ Wallet Pay Timeout")
         return jsonify({'success': False, 'message': 'انتهى وقت الاتصال - حاول مرة أخرى'})
@@ -367,35 +373,21 @@ def charge_balance_api():
     if not key_code:
         return jsonify({'success': False, 'message': 'الرجاء إدخال كود الشحن'})
     
-    # البحث عن الكود في Firebase
-    key_data = get_charge_key(key_code)
+    # Transaction واحدة: التحقق من الكود + تعليمه مستخدماً + الرصيد + السجلات
+    try:
+        result = redeem_charge_key(key_code, user_id, method='key')
+    except Exception as e:
+        print(f"❌ خطأ في شحن الكود: {e}")
+        return jsonify({'success': False, 'message': 'حدث خطأ، حاول لاحقاً'})
     
-    if not key_data:
+    if result['result'] == 'not_found':
         return jsonify({'success': False, 'message': 'كود الشحن غير صحيح أو غير موجود'})
     
-    if key_data.get('used', False):
+    if result['result'] == 'used':
         return jsonify({'success': False, 'message': 'هذا الكود تم استخدامه مسبقاً'})
     
-    # شحن الرصيد
-    amount = key_data.get('amount', 0)
-    new_balance = add_balance(user_id, amount)
-    
-    # تحديث الكود كمستخدم
-    use_charge_key(key_code, user_id)
-    
-    # حفظ سجل الشحنة
-    if db:
-        try:
-            db.collection('charge_history').add({
-                'user_id': user_id,
-                'amount': amount,
-                'key_code': key_code,
-                'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
-                'timestamp': time.time(),
-                'type': 'charge'
-            })
-        except Exception as e:
-            print(f"خطأ في حفظ سجل الشحن: {e}")
+    amount = result['amount']
+    new_balance = result['new_balance']
     
     return jsonify({
         'success': True, 
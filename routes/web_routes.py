@@ -1,15 +1,18 @@
 """
 Web Routes - صفحات الويب
 """
-from flask import Blueprint, render_template, session
+from flask import Blueprint, render_template, session, request
 from firebase_utils import (
     get_balance, get_user_cart, get_categories, 
     get_products_by_category, get_product_by_id,
-    get_all_categories_sales, get_user_data,
+    get_all_categories_sales,
     get_all_products_for_store
 )
 from extensions import BOT_USERNAME
 from config import CONTACT_BOT_URL, CONTACT_WHATSAPP
+from http_cache import catalog_cached
+from page_cache import page_cache
+from services.photo_service import session_photo_url
 import json
 
 web_bp = Blueprint('web', __name__)
@@ -17,11 +20,12 @@ web_bp = Blueprint('web', __name__)
 
 # ===================== صفحة تفاصيل المنتج =====================
 @web_bp.route('/product/<product_id>')
+@catalog_cached()
 def product_detail(product_id):
     """صفحة تفاصيل المنتج"""
     user_id = session.get('user_id')
     user_name = session.get('user_name', 'ضيف')
-    profile_photo = session.get('profile_photo', '')
+    profile_photo = session_photo_url(session)
     is_logged_in = bool(user_id)
     
     # جلب الرصيد
@@ -91,30 +95,25 @@ def product_detail(product_id):
 
 
 @web_bp.route('/')
+@catalog_cached()
 def index():
     """الصفحة الرئيسية - عرض الفئات الافتراضية 3×3"""
-    user_id = session.get('user_id')
-    user_name = session.get('user_name', 'ضيف')
-    profile_photo = session.get('profile_photo', '')
-    is_logged_in = bool(user_id)
-    
-    # 1. جلب الرصيد وبيانات المستخدم
-    balance = 0.0
-    phone_verified = False
-    totp_enabled = False
-    if user_id:
-        try:
-            balance = get_balance(user_id)
-            user_data = get_user_data(user_id)
-            phone_verified = user_data.get('phone_verified', False)
-            totp_enabled = user_data.get('totp_enabled', False)
-        except:
-            balance = 0.0
-    
-    # 2. جلب الفئات
+    # الصفحة لا تحتوي بيانات المستخدم (تُحمل من /api/user_bits) فتُحفظ مرسومة:
+    # نسخة للزوار ونسخة للمسجلين (الهيدر وقائمة الحساب)
+    is_logged_in = bool(session.get('user_id'))
+    variant = 'member' if is_logged_in else 'guest'
+    return page_cache.get_or_render(
+        ('web.index', variant, request.full_path),
+        lambda: _render_index(is_logged_in)
+    )
+
+
+def _render_index(is_logged_in):
+    """رسم الصفحة الرئيسية بدون بيانات المستخدم"""
+    # 1. جلب الفئات
     categories = get_categories()
     
-    # 3. جلب عدد المبيعات لكل فئة
+    # 2. جلب عدد المبيعات لكل فئة
     sales_counts = get_all_categories_sales()
     
     # جلب المنتجات مرة واحدة وتصفية حسب القسم
@@ -124,38 +123,44 @@ def index():
         cat['products_count'] = sum(1 for p in all_products if p.get('category') == cat_name)
         cat['sales_count'] = sales_counts.get(cat_name, 0)
     
-    # 4. جلب عدد منتجات السلة
-    cart_count = 0
-    if user_id:
-        cart = get_user_cart(str(user_id)) or {}
-        cart_count = len(cart.get('items', []))
-    
-    # 5. تحضير JSON للفئات
+    # 3. تحضير JSON للفئات
     categories_json = json.dumps([{'id': cat.get('id', ''), 'name': cat.get('name', '')} for cat in categories])
     
     return render_template('categories.html',
                          categories=categories,
                          categories_json=categories_json,
-                         balance=balance,
-                         current_user_id=user_id or 0,
-                         current_user=user_id,
-                         user_name=user_name,
-                         profile_photo=profile_photo,
+                         balance=0.0,
+                         current_user_id=0,
+                         current_user=None,
+                         user_name='',
+                         profile_photo='',
                          is_logged_in=is_logged_in,
-                         phone_verified=phone_verified,
-                         totp_enabled=totp_enabled,
-                         cart_count=cart_count,
+                         phone_verified=False,
+                         totp_enabled=False,
+                         cart_count=0,
                          bot_username=BOT_USERNAME,
                          contact_bot_url=CONTACT_BOT_URL,
                          contact_whatsapp=CONTACT_WHATSAPP)
 
 @web_bp.route('/t/<category_id>')
+@catalog_cached()
 def category_products(category_id):
     """صفحة منتجات الفئة"""
     user_id = session.get('user_id')
-    user_name = session.get('user_name', 'ضيف')
-    profile_photo = session.get('profile_photo', '')
-    is_logged_in = bool(user_id)
+    if user_id:
+        # المسجل يرى مشترياته من الفئة: الصفحة تُرسم له مباشرة
+        return _render_category(category_id, user_id)
+    # الزوار: صفحة واحدة محفوظة للجميع
+    return page_cache.get_or_render(
+        ('web.category_products', request.full_path),
+        lambda: _render_category(category_id)
+    )
+
+
+def _render_category(category_id, user_id=None):
+    """رسم صفحة الفئة (بدون user_id: نسخة الزوار)"""
+    user_name = session.get('user_name', 'ضيف') if user_id else 'ضيف'
+    profile_photo = session_photo_url(session) if user_id else ''
     
     # جلب الرصيد
     balance = 0.0
@@ -216,7 +221,7 @@ def category_products(category_id):
                          current_user=user_id,
                          user_name=user_name,
                          profile_photo=profile_photo,
-                         is_logged_in=is_logged_in,
+                         is_logged_in=bool(user_id),
                          cart_count=cart_count)
 
 @web_bp.route('/404')
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+المهام المجدولة
+===============
+Thread خفيف داخل التطبيق ينفذ المهام الدورية (تذكيرات دفتر الحسابات...)
+
+- يعمل مع أكثر من worker: قبل كل دورة يحاول أخذ "عقد" (lease) في Firestore
+  وعملية واحدة فقط تملك العقد وتنفذ المهام، والباقي ينتظر
+- إذا توقفت العملية المالكة ينتهي العقد تلقائياً وتأخذه عملية أخرى
+"""
+
+import os
+import time
+import uuid
+import socket
+import threading
+import logging
+
+from extensions import db, bot, BOT_ACTIVE
+from config import (
+    SCHEDULER_ENABLED, SCHEDULER_TICK_SECONDS,
+    REMINDER_BATCH_SIZE, REMINDER_SEND_PER_SECOND,
+    REMINDER_MAX_ATTEMPTS, REMINDER_MAX_BACKOFF_HOURS,
+    LEDGER_RETENTION_DAYS, LEDGER_CLEANUP_INTERVAL
+)
+
+try:
+    from firebase_admin import firestore
+except ImportError:
+    firestore = None
+
+logger = logging.getLogger(__name__)
+
+LEASE_COLLECTION = 'scheduler_leases'
+LEASE_NAME = 'main'
+LEASE_SECONDS = SCHEDULER_TICK_SECONDS * 3  # ينتهي العقد إذا فاتت ثلاث دورات
+
+
+# ==================== العقد (Leader Lease) ====================
+
+class FirestoreLease:
+    """عقد مؤقت في Firestore يضمن تنفيذ المهام من عملية واحدة فقط"""
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+    @property
+    def ref(self):
+        return db.collection(LEASE_COLLECTION).document(self.name)
+
+    def acquire(self):
+        """
+        أخذ العقد أو تجديده
+
+        Returns:
+            bool: True إذا كانت هذه العملية هي المالكة
+        """
+        ref = self.ref
+
+        @firestore.transactional
+        def do_acquire(transaction):
+            now = time.time()
+            doc = ref.get(transaction=transaction)
+            if doc.exists:
+                data = doc.to_dict()
+                if data.get('holder') != self.holder and float(data.get('expires_at', 0)) > now:
+                    return False
+            transaction.set(ref, {
+                'holder': self.holder,
+                'expires_at': now + self.ttl,
+                'renewed_at': firestore.SERVER_TIMESTAMP
+            })
+            return True
+
+        return do_acquire(db.transaction())
+
+    def release(self):
+        """ترك العقد (عند الإيقاف) لتأخذه عملية أخرى فوراً"""
+        ref = self.ref
+
+        @firestore.transactional
+        def do_release(transaction):
+            doc = ref.get(transaction=transaction)
+            if doc.exists and doc.to_dict().get('holder') == self.holder:
+                transaction.delete(ref)
+
+        try:
+            do_release(db.transaction())
+        except Exception as e:
+            logger.error(f"خطأ في ترك عقد المهام: {e}")
+
+
+# ==================== المهام ====================
+
+class _Job:
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.last_run = 0
+
+
+_jobs = []
+
+
+def register_job(name, func, interval):
+    """إضافة مهمة دورية (interval بالثواني)"""
+    _jobs.append(_Job(name, func, interval))
+
+
+TELEGRAM_MESSAGE_LIMIT = 4096  # أقصى طول لرسالة تيليجرام (حرف)
+
+
+def _chunk_reminder_lines(header, lines):
+    """
+    تقسيم سطور التذكير إلى رسائل لا تتجاوز حد تيليجرام
+
+    Args:
+        lines: [(السطر، معرف العملية)]
+
+    Returns:
+        list: [(نص الرسالة، [معرفات العمليات فيها])]
+    """
+    chunks = []
+    text, ids = header, []
+    for line, tx_id in lines:
+        line = line[:TELEGRAM_MESSAGE_LIMIT - len(header) - 1]
+        if ids and len(text) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            chunks.append((text, ids))
+            text, ids = header, []
+        text = f"{text}\n{line}"
+        ids.append(tx_id)
+    if ids:
+        chunks.append((text, ids))
+    return chunks
+
+
+def send_ledger_reminders():
+    """
+    إرسال تذكيرات دفتر الحسابات المستحقة
+    رسالة واحدة لكل مستخدم بكل عملياته المستحقة (تُقسم إذا تجاوزت حد تيليجرام)، بمعدل محدود للإرسال
+
+    - وصلت الرسالة: العملية تُعلّم كمرسلة
+    - 400 أو 403 (المحادثة غير موجودة، المستخدم حظر البوت): فشل نهائي، تُزال من الفهرس
+    - حد الإرسال (429) أو القاطع المفتوح: تبقى كما هي للدورة القادمة
+    - باقي الأخطاء: عداد محاولات + تأجيل متزايد (حتى لا تملأ الدفعات القادمة)
+
+    Returns:
+        int: عدد العمليات التي تم التذكير بها
+    """
+    from firebase_utils import (
+        get_pending_reminders, mark_reminders_sent,
+        mark_reminders_failed, defer_reminders
+    )
+    from telebot import types
+    from circuit_breaker import CircuitOpenError
+
+    if not (BOT_ACTIVE and bot):
+        return 0
+
+    reminders = get_pending_reminders(limit=REMINDER_BATCH_SIZE)
+    if not reminders:
+        return 0
+
+    # تجميع حسب صاحب الدفتر + تجاهل المسددة (تُزال من الفهرس فقط)
+    by_owner = {}
+    done_ids = []
+    failed = {}   # {السبب: [ids]} فشل نهائي
+    deferred = {}  # {السبب: [عمليات]} خطأ مؤقت
+    for tx in reminders:
+        if tx.get('status') != 'pending':
+            done_ids.append(tx['id'])
+            continue
+        by_owner.setdefault(tx.get('owner_id'), []).append(tx)
+
+    service_names = {'tamara': 'تمارا', 'tabby': 'تابي', 'other': 'أخرى'}
+    send_interval = 1.0 / REMINDER_SEND_PER_SECOND
+    sent_count = 0
+    stop = False
+
+    for owner_id, items in by_owner.items():
+        # نص عادي بدون Markdown: أسماء الشركاء يكتبها المستخدم وقد تحتوي _ أو * أو `
+        lines = []
+        for tx in items:
+            srv_name = service_names.get(tx.get('service', ''), 'أخرى')
+            lines.append((f"👤 {tx.get('partner_name', '')} - {srv_name}: {float(tx.get('amount', 0)):.0f} ر.س", tx['id']))
+
+        chunks = _chunk_reminder_lines("⏰ تذكير بالمستحقات\n", lines)
+        for index, (text, chunk_ids) in enumerate(chunks):
+            markup = None
+            if index == len(chunks) - 1:
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton("📂 فتح المحاسبة", callback_data="acc_main"))
+
+            try:
+                bot.send_message(int(owner_id), text, reply_markup=markup)
+                sent_count += len(chunk_ids)
+                done_ids.extend(chunk_ids)
+            except CircuitOpenError as e:
+                # تيليجرام غير متاح: لا فائدة من المحاولة لباقي المستخدمين الآن
+                logger.warning(f"⚠️ تيليجرام غير متاح، تأجيل باقي التذكيرات: {e}")
+                stop = True
+                break
+            except Exception as e:
+                error_code = getattr(e, 'error_code', None)
+                if error_code == 429:
+                    # تجاوزنا حد تيليجرام: نكمل في الدورة القادمة
+                    logger.warning(f"⚠️ حد الإرسال في تيليجرام، تأجيل باقي التذكيرات: {e}")
+                    stop = True
+                    break
+                remaining_ids = {id_ for _, ids in chunks[index:] for id_ in ids}
+                if error_code in (400, 403):
+                    # المحادثة غير موجودة أو المستخدم حظر البوت: لا نعيد المحاولة
+                    logger.info(f"🚫 لا يمكن مراسلة {owner_id} ({error_code})، إلغاء تذكيراته")
+                    failed.setdefault(f"telegram {error_code}", []).extend(remaining_ids)
+                    break
+                # خطأ مؤقت أو غير متوقع: إعادة المحاولة لاحقاً بتأجيل متزايد
+                logger.error(f"خطأ في إرسال تذكير لـ {owner_id}: {e}")
+                deferred.setdefault(str(e), []).extend(tx for tx in items if tx['id'] in remaining_ids)
+                break
+            finally:
+                time.sleep(send_interval)
+
+        if stop:
+            break
+
+    mark_reminders_sent(done_ids)
+    for reason, ids in failed.items():
+        mark_reminders_failed(ids, reason)
+    for reason, txs in deferred.items():
+        defer_reminders(txs, reason, max_attempts=REMINDER_MAX_ATTEMPTS, max_backoff_hours=REMINDER_MAX_BACKOFF_HOURS)
+    if sent_count:
+        print(f"⏰ تم إرسال {sent_count} تذكير")
+    return sent_count
+
+
+def cleanup_ledger():
+    """حذف فواتير دفتر الحسابات الأقدم من LEDGER_RETENTION_DAYS"""
+    from firebase_utils import cleanup_old_ledger_transactions
+    return cleanup_old_ledger_transactions(days=LEDGER_RETENTION_DAYS)
+
+
+def dispatch_outbox():
+    """تنفيذ آثار الطلبات المتبقية في الصادر (فشلت أو توقفت العملية قبل تنفيذها)"""
+    from services.outbox import dispatch_due
+    return dispatch_due()
+
+
+register_job('ledger_reminders', send_ledger_reminders, SCHEDULER_TICK_SECONDS)
+register_job('ledger_cleanup', cleanup_ledger, LEDGER_CLEANUP_INTERVAL)
+register_job('outbox', dispatch_outbox, SCHEDULER_TICK_SECONDS)
+
+
+# ==================== الـ Thread ====================
+
+_lease = FirestoreLease(LEASE_NAME, LEASE_SECONDS)
+_stop_event = threading.Event()
+_scheduler_thread = None
+
+
+def run_due_jobs():
+    """تنفيذ المهام التي حان وقتها (إذا كانت هذه العملية تملك العقد)"""
+    try:
+        if not _lease.acquire():
+            return False
+    except Exception as e:
+        logger.error(f"خطأ في أخذ عقد المهام: {e}")
+        return False
+
+    now = time.time()
+    for job in _jobs:
+        if now - job.last_run < job.interval:
+            continue
+        job.last_run = now
+        try:
+            job.func()
+        except Exception as e:
+            logger.error(f"خطأ في المهمة {job.name}: {e}")
+    return True
+
+
+def _scheduler_loop():
+    while not _stop_event.wait(SCHEDULER_TICK_SECONDS):
+        run_due_jobs()
+
+
+def start_scheduler():
+    """تشغيل المهام المجدولة (مرة واحدة لكل عملية)"""
+    global _scheduler_thread
+    if not SCHEDULER_ENABLED or not db or firestore is None:
+        return False
+    if _scheduler_thread and _scheduler_thread.is_alive():
+        return True
+
+    _stop_event.clear()
+    _scheduler_thread = threading.Thread(target=_scheduler_loop, name='scheduler', daemon=True)
+    _scheduler_thread.start()
+    print(f"⏱️ تم تشغيل المهام المجدولة (كل {SCHEDULER_TICK_SECONDS} ثانية)")
+    return True
+
+
+def stop_scheduler():
+    """إيقاف المهام وترك العقد"""
+    _stop_event.set()
+    if db and firestore is not None:
+        _lease.release()
@@ -401,6 +401,8 @@ def add_security_headers(response):
 # ==================== 6. Security Logging - تسجيل الأحداث الأمنية ====================
 
 import json
+import atexit
+import threading
 from datetime import datetime
 
 # Logger خاص بالأمان
@@ -448,10 +450,119 @@ class SecurityEvent:
 _security_events_buffer = []
 _db_reference = None
 
+# إعدادات الكاتب الخلفي لسجلات الأمان
+SECURITY_LOG_BATCH_SIZE = int(os.environ.get('SECURITY_LOG_BATCH_SIZE', 50))  # حفظ كل N حدث
+SECURITY_LOG_FLUSH_MS = int(os.environ.get('SECURITY_LOG_FLUSH_MS', 2000))  # أو كل T ميلي ثانية
+SECURITY_LOG_MAX_BUFFER = int(os.environ.get('SECURITY_LOG_MAX_BUFFER', 2000))  # الحد الأقصى للطابور
+FIRESTORE_BATCH_LIMIT = 500  # حد Firestore لعمليات الـ batch الواحد
+
+_SEVERITY_RANK = {'INFO': 0, 'WARNING': 1, 'CRITICAL': 2}
+
+_security_buffer_cond = threading.Condition()
+_security_writer_thread = None
+_security_dropped_events = 0
+
+
 def set_security_db(db):
-    """تعيين مرجع قاعدة البيانات للتسجيل"""
+    """تعيين مرجع قاعدة البيانات للتسجيل وتشغيل الكاتب الخلفي"""
     global _db_reference
     _db_reference = db
+    if db:
+        _start_security_writer()
+
+
+def _enqueue_security_event(record):
+    """
+    إضافة حدث لطابور الحفظ (داخلي)
+    عند امتلاء الطابور يُحذف الأقدم من الأقل خطورة (INFO ثم WARNING)
+    ولا يُحذف CRITICAL ما دام هناك حدث أقل منه
+    """
+    global _security_dropped_events
+    rank = _SEVERITY_RANK.get(record.get('severity'), 0)
+    
+    with _security_buffer_cond:
+        if len(_security_events_buffer) >= SECURITY_LOG_MAX_BUFFER:
+            # البحث عن أقدم حدث بأقل مستوى خطورة
+            victim_index = None
+            victim_rank = rank
+            for i, queued in enumerate(_security_events_buffer):
+                queued_rank = _SEVERITY_RANK.get(queued.get('severity'), 0)
+                if queued_rank < victim_rank or (victim_index is None and queued_rank == victim_rank):
+                    victim_index = i
+                    victim_rank = queued_rank
+                    if queued_rank == 0:
+                        break
+            
+            _security_dropped_events += 1
+            if victim_index is None:
+                # الحدث الجديد هو الأقل خطورة - يُتجاهل
+                return False
+            del _security_events_buffer[victim_index]
+        
+        _security_events_buffer.append(record)
+        if len(_security_events_buffer) >= SECURITY_LOG_BATCH_SIZE:
+            _security_buffer_cond.notify()
+    return True
+
+
+def _take_security_batch():
+    """سحب دفعة من الطابور (يجب استدعاؤها داخل القفل)"""
+    batch_events = _security_events_buffer[:FIRESTORE_BATCH_LIMIT]
+    del _security_events_buffer[:FIRESTORE_BATCH_LIMIT]
+    return batch_events
+
+
+def _write_security_batch(batch_events):
+    """كتابة دفعة أحداث في Firestore بعملية batch واحدة"""
+    if not batch_events or not _db_reference:
+        return
+    try:
+        batch = _db_reference.batch()
+        logs_ref = _db_reference.collection('security_logs')
+        for record in batch_events:
+            batch.set(logs_ref.document(), record)
+        batch.commit()
+    except Exception as e:
+        logger.error(f"خطأ في حفظ {len(batch_events)} سجل أمان في Firestore: {e}")
+
+
+def _security_writer_loop():
+    """حلقة الكاتب الخلفي: حفظ كل N حدث أو كل T ميلي ثانية"""
+    interval = SECURITY_LOG_FLUSH_MS / 1000.0
+    while True:
+        with _security_buffer_cond:
+            if len(_security_events_buffer) < SECURITY_LOG_BATCH_SIZE:
+                _security_buffer_cond.wait(timeout=interval)
+            batch_events = _take_security_batch()
+        _write_security_batch(batch_events)
+
+
+def _start_security_writer():
+    """تشغيل خيط الكاتب الخلفي مرة واحدة"""
+    global _security_writer_thread
+    if _security_writer_thread and _security_writer_thread.is_alive():
+        return
+    _security_writer_thread = threading.Thread(
+        target=_security_writer_loop,
+        name='security-log-writer',
+        daemon=True
+    )
+    _security_writer_thread.start()
+
+
+def flush_security_events():
+    """حفظ كل الأحداث المتبقية في الطابور فوراً (يُستدعى عند الإغلاق)"""
+    while True:
+        with _security_buffer_cond:
+            batch_events = _take_security_batch()
+        if not batch_events:
+            break
+        _write_security_batch(batch_events)
+    if _security_dropped_events:
+        logger.warning(f"⚠️ تم إسقاط {_security_dropped_events} حدث أمني بسبب امتلاء الطابور")
+
+
+atexit.register(flush_security_events)
 
 
 def log_security_event(event_type, user_id=None, ip=None, details=None, severity='INFO'):
@@ -496,15 +607,12 @@ def log_security_event(event_type, user_id=None, ip=None, details=None, severity
         else:
             security_logger.info(log_message)
         
-        # محاولة الحفظ في Firestore
+        # إضافة للطابور ليحفظها الكاتب الخلفي في Firestore على دفعات
         if _db_reference:
-            try:
-                _db_reference.collection('security_logs').add({
-                    **event_record,
-                    'timestamp': datetime.now()  # Firestore timestamp
-                })
-            except Exception as e:
-                logger.error(f"خطأ في حفظ سجل الأمان في Firestore: {e}")
+            _enqueue_security_event({
+                **event_record,
+                'timestamp': datetime.now()  # Firestore timestamp
+            })
         
         # إرسال تنبيه للأحداث الحرجة
         if severity == 'CRITICAL':
@@ -287,51 +287,32 @@ def verify_user_ownership(user_id, resource_type, resource_id, db):
 
 
 # === 9. حماية ذكية من محاولات الكود الخاطئة (بدون حظر) ===
-import time
+from rate_limit_store import rate_limit_store, SCOPE_CODE_ATTEMPTS
 
-# تخزين مؤقت لمحاولات إدخال الكود
-failed_attempts = {}  # {user_id: {'count': 3, 'timestamp': 1234567890}}
+# محاولات إدخال الكود تُحفظ في المخزن الموحد (نافذة ساعة)
 # ملاحظة: لا يوجد حظر (blocked_users) - الكود ينتهي بدل الحظر
+CODE_MAX_ATTEMPTS = 3
+CODE_ATTEMPTS_WINDOW = 3600
 
 
 def is_code_expired_due_to_wrong_attempts(user_id):
     """التحقق من انتهاء صلاحية الكود بسبب محاولات خاطئة"""
-    user_id = str(user_id)
-    
-    if user_id not in failed_attempts:
-        return False
-    
-    attempts = failed_attempts[user_id]['count']
+    attempts = rate_limit_store.count(SCOPE_CODE_ATTEMPTS, str(user_id), CODE_ATTEMPTS_WINDOW)
     
     # بعد 3 محاولات خاطئة: الكود ينتهي ويجب طلب جديد
-    if attempts >= 3:
-        return True
-    
-    return False
+    return attempts >= CODE_MAX_ATTEMPTS
 
 
 def record_failed_code_attempt(user_id):
     """تسجيل محاولة خاطئة في إدخال الكود"""
-    user_id = str(user_id)
-    current_time = time.time()
-    
-    if user_id not in failed_attempts:
-        failed_attempts[user_id] = {'count': 0, 'timestamp': current_time}
-    
-    # إعادة تعيين العداد إذا مرت ساعة
-    if current_time - failed_attempts[user_id]['timestamp'] > 3600:
-        failed_attempts[user_id] = {'count': 1, 'timestamp': current_time}
-    else:
-        failed_attempts[user_id]['count'] += 1
-    
-    attempts = failed_attempts[user_id]['count']
+    attempts = rate_limit_store.hit(SCOPE_CODE_ATTEMPTS, str(user_id), CODE_ATTEMPTS_WINDOW)
     
     # ✅ التعديل الجديد:
     # - بعد 3 محاولات خاطئة: الكود ينتهي (يصبح غير صالح)
     # - المستخدم يطلب كود جديد تلقائياً
     # - لا حظر على الإطلاق
     
-    if attempts >= 3:
+    if attempts >= CODE_MAX_ATTEMPTS:
         return 'code_expired', None  # الكود انتهى، اطلب جديد
     
     return None, None
@@ -340,20 +321,14 @@ def record_failed_code_attempt(user_id):
 def reset_failed_attempts(user_id):
     """إعادة تعيين محاولات المستخدم بعد نجاح التحقق أو طلب كود جديد"""
     user_id = str(user_id)
-    if user_id in failed_attempts:
-        del failed_attempts[user_id]
+    rate_limit_store.reset(SCOPE_CODE_ATTEMPTS, user_id)
     log_security_event('CODE_VERIFICATION_SUCCESS', user_id, 'تم التحقق بنجاح')
 
 
 def get_remaining_attempts(user_id):
     """الحصول على المحاولات المتبقية"""
-    user_id = str(user_id)
-    
-    if user_id not in failed_attempts:
-        return 3, None
-    
-    attempts = failed_attempts[user_id]['count']
-    remaining = 3 - attempts
+    attempts = rate_limit_store.count(SCOPE_CODE_ATTEMPTS, str(user_id), CODE_ATTEMPTS_WINDOW)
+    remaining = CODE_MAX_ATTEMPTS - attempts
     
     if remaining <= 0:
         return 0, 'الكود انتهى - الرجاء طلب كود جديد'
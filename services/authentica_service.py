@@ -8,6 +8,8 @@
 
 import requests
 import logging
+
+import http_client
 from config import (
     AUTHENTICA_API_KEY,
     AUTHENTICA_API_URL,
@@ -86,11 +88,12 @@ def send_otp_whatsapp(phone, otp_code=None, method=None):
 
         logger.info(f"📤 إرسال OTP عبر {send_method} إلى {formatted_phone}")
 
-        response = requests.post(
+        response = http_client.post(
             f"{AUTHENTICA_API_URL}/send-otp",
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=http_client.AUTHENTICA_TIMEOUT,
+            breaker='authentica'
         )
 
         result = response.json()
@@ -108,6 +111,9 @@ def send_otp_whatsapp(phone, otp_code=None, method=None):
             logger.error(f"❌ فشل إرسال OTP: {error_msg}")
             return {'success': False, 'message': error_msg, 'otp': None}
 
+    except http_client.ServiceUnavailable:
+        logger.warning("⚡ Authentica متوقفة مؤقتاً (القاطع مفتوح)")
+        return {'success': False, 'message': 'خدمة الرسائل غير متاحة مؤقتاً، حاول بعد قليل أو سجّل بالإيميل', 'otp': None}
     except requests.exceptions.Timeout:
         logger.error("❌ انتهت مهلة الاتصال بـ Authentica")
         return {'success': False, 'message': 'انتهت مهلة الاتصال، حاول مرة أخرى', 'otp': None}
@@ -151,11 +157,12 @@ def verify_otp_authentica(phone, otp_code):
 
         logger.info(f"🔍 التحقق من OTP للرقم {formatted_phone}")
 
-        response = requests.post(
+        response = http_client.post(
             f"{AUTHENTICA_API_URL}/verify-otp",
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=http_client.AUTHENTICA_TIMEOUT,
+            breaker='authentica'
         )
 
         result = response.json()
@@ -168,6 +175,9 @@ def verify_otp_authentica(phone, otp_code):
             logger.warning(f"⚠️ فشل التحقق: {error_msg}")
             return {'success': False, 'message': error_msg}
 
+    except http_client.ServiceUnavailable:
+        logger.warning("⚡ Authentica متوقفة مؤقتاً (القاطع مفتوح)")
+        return {'success': False, 'message': 'خدمة التحقق غير متاحة مؤقتاً، حاول بعد قليل'}
     except Exception as e:
         logger.error(f"❌ خطأ في التحقق: {e}")
         return {'success': False, 'message': 'حدث خطأ أثناء التحقق'}
@@ -184,10 +194,11 @@ def get_authentica_balance():
             'Accept': 'application/json'
         }
 
-        response = requests.get(
+        response = http_client.get(
             f"{AUTHENTICA_API_URL}/balance",
             headers=headers,
-            timeout=15
+            timeout=http_client.AUTHENTICA_TIMEOUT,
+            breaker='authentica'
         )
 
         result = response.json()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+خدمة توليد مفاتيح الشحن
+=======================
+توليد عشرات الآلاف من مفاتيح الشحن دفعة واحدة:
+- أكواد عشوائية آمنة (secrets) بدل random
+- إنشاء فقط (create) - لا يمكن الكتابة فوق مفتاح موجود
+- حفظ على دفعات (500 مفتاح) تُرسل بالتوازي
+- كل عملية توليد لها معرف (batch_id) لتصدير مفاتيحها لاحقاً كملف CSV/نص
+- لوحة التحكم تبدأ التوليد في الخلفية (start_charge_keys_generation) وتتابع
+  حالته من مستند الدفعة (generating / completed / failed) ثم تحمّل الملف
+  (العملية المولدة تحدث heartbeat_at، وإذا توقفت تُعلّم الدفعة فاشلة عند قراءتها)
+"""
+
+import time
+import secrets
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions import db
+
+try:
+    from firebase_admin import firestore
+except ImportError:
+    firestore = None
+
+try:
+    from google.api_core.exceptions import AlreadyExists, Conflict
+    CREATE_CONFLICT_ERRORS = (AlreadyExists, Conflict)
+except ImportError:
+    CREATE_CONFLICT_ERRORS = ()
+
+logger = logging.getLogger(__name__)
+
+MAX_KEYS_PER_BATCH = 50000     # أقصى عدد مفاتيح في عملية توليد واحدة
+WRITE_CHUNK_SIZE = 500         # حد Firestore لعدد العمليات في batch واحد
+COMMIT_WORKERS = 8             # عدد الدفعات التي تُرسل بالتوازي
+MAX_CHUNK_RETRIES = 3          # إعادة توليد الدفعة عند تصادم (نادر جداً)
+INLINE_KEYS_LIMIT = 100        # حتى هذا العدد تُرجع المفاتيح مباشرة في الرد
+GENERATION_WORKERS = 2         # عمليات التوليد التي تعمل في الخلفية في نفس الوقت
+PROGRESS_INTERVAL = 2          # ثوانٍ بين تحديثات created_count في مستند الدفعة
+GENERATION_STALE_SECONDS = 300  # دفعة بدون نبض (heartbeat_at) لهذه المدة تُعتبر متوقفة وتُعلّم فاشلة
+
+# التوليد في الخلفية (طلب لوحة التحكم يرجع batch_id فوراً)
+_generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix='charge-keys')
+
+# بدون الأحرف المتشابهة (0/O, 1/I/L) لتسهيل الإدخال اليدوي
+KEY_ALPHABET = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
+KEY_GROUPS = 4
+KEY_GROUP_LENGTH = 4
+
+
+def generate_key_code():
+    """كود شحن عشوائي آمن بصيغة KEY-XXXX-XXXX-XXXX-XXXX (~79 bit)"""
+    groups = [
+        ''.join(secrets.choice(KEY_ALPHABET) for _ in range(KEY_GROUP_LENGTH))
+        for _ in range(KEY_GROUPS)
+    ]
+    return 'KEY-' + '-'.join(groups)
+
+
+def new_batch_id():
+    """معرف عملية التوليد"""
+    return f"KB-{time.strftime('%Y%m%d')}-{secrets.token_hex(4).upper()}"
+
+
+def _commit_chunk(amount, count, batch_id):
+    """
+    إنشاء دفعة مفاتيح (create فقط)
+    عند وجود مفتاح بنفس الكود تفشل الدفعة كاملة بدون كتابة - فنعيد توليدها بأكواد جديدة
+
+    Returns:
+        list: أكواد المفاتيح التي تم إنشاؤها
+    """
+    for attempt in range(MAX_CHUNK_RETRIES):
+        codes = {generate_key_code() for _ in range(count)}
+        while len(codes) < count:
+            codes.add(generate_key_code())
+
+        batch = db.batch()
+        for code in codes:
+            batch.create(db.collection('charge_keys').document(code), {
+                'amount': amount,
+                'used': False,
+                'used_by': None,
+                'batch_id': batch_id,
+                'created_at': firestore.SERVER_TIMESTAMP
+            })
+        try:
+            batch.commit()
+            return sorted(codes)
+        except CREATE_CONFLICT_ERRORS as e:
+            logger.warning(f"⚠️ تصادم في أكواد الشحن (محاولة {attempt + 1}): {e}")
+    raise RuntimeError('فشل إنشاء دفعة المفاتيح بعد عدة محاولات')
+
+
+def _create_batch(amount, count, created_by):
+    """التحقق من الأرقام وإنشاء مستند الدفعة (status=generating)"""
+    amount = float(amount)
+    count = int(count)
+    if amount <= 0 or count <= 0 or count > MAX_KEYS_PER_BATCH:
+        raise ValueError('أرقام غير صحيحة')
+    if not db:
+        raise RuntimeError('قاعدة البيانات غير متصلة')
+
+    batch_id = new_batch_id()
+    db.collection('charge_key_batches').document(batch_id).set({
+        'amount': amount,
+        'count': count,
+        'created_count': 0,
+        'created_by': str(created_by),
+        'status': 'generating',
+        'heartbeat_at': time.time(),
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    return batch_id, amount, count
+
+
+def _generate_batch_keys(batch_id, amount, count):
+    """إنشاء مفاتيح دفعة موجودة وتحديث حالتها"""
+    batch_ref = db.collection('charge_key_batches').document(batch_id)
+    batch_ref.update({'heartbeat_at': time.time()})
+    chunk_sizes = [min(WRITE_CHUNK_SIZE, count - start) for start in range(0, count, WRITE_CHUNK_SIZE)]
+    keys = []
+    last_progress = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=min(COMMIT_WORKERS, len(chunk_sizes))) as executor:
+            for chunk_keys in executor.map(lambda size: _commit_chunk(amount, size, batch_id), chunk_sizes):
+                keys.extend(chunk_keys)
+                if time.time() - last_progress >= PROGRESS_INTERVAL:
+                    batch_ref.update({'created_count': len(keys), 'heartbeat_at': time.time()})
+                    last_progress = time.time()
+    except Exception as e:
+        # الدفعات التي نجحت تبقى مرتبطة بالـ batch_id ويمكن تصديرها
+        batch_ref.update({'status': 'failed', 'created_count': len(keys), 'error': str(e)})
+        raise
+
+    batch_ref.update({
+        'status': 'completed',
+        'created_count': len(keys),
+        'completed_at': firestore.SERVER_TIMESTAMP
+    })
+    print(f"🔑 تم توليد {len(keys)} مفتاح شحن بقيمة {amount} (الدفعة {batch_id})")
+    return keys
+
+
+def generate_charge_keys(amount, count, created_by=''):
+    """
+    توليد مفاتيح شحن (ينتظر انتهاء التوليد)
+
+    Args:
+        amount: قيمة كل مفتاح
+        count: عدد المفاتيح (حتى MAX_KEYS_PER_BATCH)
+        created_by: من قام بالتوليد (للسجل)
+
+    Returns:
+        dict: {batch_id, count, amount, keys}
+    """
+    batch_id, amount, count = _create_batch(amount, count, created_by)
+    keys = _generate_batch_keys(batch_id, amount, count)
+    return {'batch_id': batch_id, 'count': len(keys), 'amount': amount, 'keys': keys}
+
+
+def _generate_in_background(batch_id, amount, count):
+    try:
+        _generate_batch_keys(batch_id, amount, count)
+    except Exception as e:
+        logger.error(f"❌ فشل توليد دفعة المفاتيح {batch_id}: {e}")
+
+
+def start_charge_keys_generation(amount, count, created_by=''):
+    """
+    بدء توليد مفاتيح شحن في الخلفية
+
+    Returns:
+        str: batch_id (الحالة تُتابع من get_key_batch)
+    """
+    batch_id, amount, count = _create_batch(amount, count, created_by)
+    _generation_executor.submit(_generate_in_background, batch_id, amount, count)
+    return batch_id
+
+
+def get_key_batch(batch_id):
+    """
+    بيانات عملية توليد
+    دفعة generating بدون نبض منذ GENERATION_STALE_SECONDS (توقفت العملية المولدة)
+    تُعلّم failed، والمفاتيح التي أُنشئت قبل التوقف تبقى قابلة للتصدير
+    """
+    if not db or not batch_id:
+        return None
+    batch_ref = db.collection('charge_key_batches').document(batch_id)
+    doc = batch_ref.get()
+    if not doc.exists:
+        return None
+    batch = doc.to_dict()
+
+    heartbeat_at = batch.get('heartbeat_at') or 0
+    if batch.get('status') == 'generating' and time.time() - heartbeat_at > GENERATION_STALE_SECONDS:
+        stale = {'status': 'failed', 'error': 'توقف التوليد قبل اكتماله'}
+        batch_ref.update(stale)
+        batch.update(stale)
+        logger.warning(f"⚠️ دفعة المفاتيح {batch_id} متوقفة منذ {int(time.time() - heartbeat_at)} ثانية، تم تعليمها فاشلة")
+    return batch
+
+
+def _batch_keys_query(batch_id):
+    query = db.collection('charge_keys')
+    try:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        return query.where(filter=FieldFilter('batch_id', '==', batch_id))
+    except ImportError:
+        return query.where('batch_id', '==', batch_id)
+
+
+def list_batch_keys(batch_id, limit=INLINE_KEYS_LIMIT):
+    """أكواد مفاتيح دفعة صغيرة (للعرض المباشر في لوحة التحكم)"""
+    if not db or not batch_id:
+        return []
+    return sorted(doc.id for doc in _batch_keys_query(batch_id).limit(limit).stream())
+
+
+def iter_batch_export(batch_id, fmt='csv'):
+    """
+    مولّد أسطر ملف التصدير (يُقرأ من Firestore أثناء الإرسال بدون تحميل الكل في الذاكرة)
+
+    Args:
+        fmt: 'csv' (الكود,القيمة,مستخدم) أو 'txt' (كود في كل سطر)
+    """
+    if fmt == 'csv':
+        yield 'code,amount,used\n'
+
+    for doc in _batch_keys_query(batch_id).stream():
+        if fmt == 'csv':
+            data = doc.to_dict()
+            yield f"{doc.id},{data.get('amount', 0)},{'yes' if data.get('used') else 'no'}\n"
+        else:
+            yield f"{doc.id}\n"
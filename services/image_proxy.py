@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+وكيل الصور (Image Proxy)
+========================
+صور الأقسام والمنتجات روابط خارجية بالحجم الكامل (imgur...)، فكانت شبكة الأقسام
+تحمّل عدة ميجابايت على الجوال وتعتمد على سرعة المواقع الخارجية. الآن:
+
+- القوالب تستخدم img_url() / img_srcset() بدل الرابط الأصلي
+- المسار /img يجلب الصورة الأصلية مرة واحدة، ويصغرها لكل العروض المحددة
+  (IMAGE_WIDTHS) ويحولها إلى WebP (Pillow)، ويحفظها في كاش على القرص
+- الروابط موقعة (HMAC) حتى لا يُستخدم المسار لجلب روابط عشوائية
+- لا يُسمح بالعناوين الداخلية (localhost والشبكات الخاصة)
+
+بدون Pillow تعود الروابط للصورة الأصلية كما كانت
+"""
+
+import os
+import io
+import hmac
+import socket
+import hashlib
+import logging
+import ipaddress
+import threading
+from urllib.parse import urlencode, urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_client
+from disk_cache import DiskLRUCache
+from store_backend import get_backend
+from config import SECRET_KEY, MEDIA_CACHE_DIR, IMAGE_CACHE_MAX_MB
+
+# Pillow (اختياري - يأتي مع qrcode[pil])
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = None
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WIDTHS = (96, 240, 480, 800)   # العروض المتاحة (بكسل)
+DEFAULT_WIDTH = 480
+WEBP_QUALITY = 78
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40 * 1000 * 1000
+MAX_REDIRECTS = 3
+FAILURE_TTL = 600                    # الصورة التي فشل جلبها لا يُعاد جلبها قبل 10 دقائق
+
+image_cache = DiskLRUCache(
+    os.path.join(MEDIA_CACHE_DIR, 'img'),
+    max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024
+)
+
+# أقفال موزعة حسب الرابط: نفس الصورة لا تُجلب مرتين في نفس الوقت
+_source_locks = [threading.Lock() for _ in range(64)]
+
+
+class ImageFetchError(Exception):
+    """تعذر جلب أو معالجة الصورة الأصلية"""
+
+
+# ==================== الروابط ====================
+
+def _source_hash(src):
+    return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+
+def _signature(src):
+    return hmac.new(SECRET_KEY.encode('utf-8'), src.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def verify_signature(src, signature):
+    return bool(signature) and hmac.compare_digest(_signature(src), signature)
+
+
+def _is_proxyable(src):
+    return bool(src) and PIL_AVAILABLE and src.startswith(('http://', 'https://'))
+
+
+def nearest_width(width):
+    """أقرب عرض متاح (لا نولد أحجاماً عشوائية)"""
+    try:
+        width = int(width)
+    except (TypeError, ValueError):
+        return DEFAULT_WIDTH
+    for candidate in IMAGE_WIDTHS:
+        if candidate >= width:
+            return candidate
+    return IMAGE_WIDTHS[-1]
+
+
+def img_url(src, width=DEFAULT_WIDTH):
+    """رابط الصورة المصغرة (للقوالب) - الروابط المحلية تبقى كما هي"""
+    if not _is_proxyable(src):
+        return src or ''
+    query = urlencode({'u': src, 'w': nearest_width(width), 's': _signature(src)})
+    return f"/img?{query}"
+
+
+def img_srcset(src, widths=IMAGE_WIDTHS):
+    """قيمة srcset لكل العروض المتاحة"""
+    if not _is_proxyable(src):
+        return ''
+    return ', '.join(f"{img_url(src, width)} {width}w" for width in widths)
+
+
+# ==================== الجلب والمعالجة ====================
+
+def _check_host(parsed):
+    """
+    رفض العناوين الداخلية
+
+    Returns:
+        str: عنوان IP الذي تم فحصه (الاتصال يكون به وليس بحل DNS جديد)
+    """
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ImageFetchError('رابط غير مدعوم')
+    default_port = 443 if parsed.scheme == 'https' else 80
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or default_port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise ImageFetchError(f"تعذر الوصول للمضيف: {e}")
+    if not addresses:
+        raise ImageFetchError('تعذر الوصول للمضيف')
+    for address in addresses:
+        if not ipaddress.ip_address(address[4][0]).is_global:
+            raise ImageFetchError('عنوان داخلي غير مسموح')
+    return addresses[0][4][0]
+
+
+class _PinnedHostAdapter(HTTPAdapter):
+    """
+    اتصال بعنوان IP محدد مع الإبقاء على اسم المضيف في SNI والتحقق من الشهادة
+    (حتى لا يتغير العنوان بين الفحص والاتصال - DNS rebinding)
+    """
+
+    def __init__(self, hostname):
+        self._hostname = hostname
+        super().__init__(pool_connections=1, pool_maxsize=1, max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self._hostname
+        kwargs['assert_hostname'] = self._hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _request_pinned(session, parsed, ip):
+    """GET مباشرة على العنوان الذي تم فحصه، مع Host الأصلي"""
+    host = f"[{ip}]" if ':' in ip else ip
+    netloc = f"{host}:{parsed.port}" if parsed.port else host
+    if parsed.scheme == 'https':
+        previous = session.adapters.get('https://')
+        session.mount('https://', _PinnedHostAdapter(parsed.hostname))
+        previous.close()
+    return session.get(
+        parsed._replace(netloc=netloc).geturl(),
+        headers={'Host': parsed.netloc.rsplit('@', 1)[-1]},
+        timeout=http_client.DEFAULT_TIMEOUT,
+        stream=True,
+        allow_redirects=False
+    )
+
+
+def _fetch(src):
+    """تحميل الصورة الأصلية (مع حد للحجم والتحويلات)"""
+    url = src
+    session = requests.Session()
+    session.trust_env = False  # بروكسي النظام يحل الاسم من جديد
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            response = _request_pinned(session, parsed, _check_host(parsed))
+            try:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers.get('Location', ''))
+                    continue
+                if response.status_code != 200:
+                    raise ImageFetchError(f"HTTP {response.status_code}")
+                content = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    content.extend(chunk)
+                    if len(content) > MAX_SOURCE_BYTES:
+                        raise ImageFetchError('حجم الصورة أكبر من المسموح')
+                return bytes(content)
+            finally:
+                response.close()
+        raise ImageFetchError('تحويلات كثيرة')
+    finally:
+        session.close()
+
+
+def _render_all(data):
+    """تصغير الصورة لكل العروض المتاحة وتحويلها إلى WebP"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_SOURCE_PIXELS:
+                raise ImageFetchError('أبعاد الصورة أكبر من المسموح')
+            has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            results = {}
+            for width in IMAGE_WIDTHS:
+                resized = image.copy()
+                if resized.width > width:
+                    resized.thumbnail((width, width * 4))
+                output = io.BytesIO()
+                resized.save(output, 'WEBP', quality=WEBP_QUALITY, method=4)
+                results[width] = output.getvalue()
+            return results
+    except ImageFetchError:
+        raise
+    except Exception as e:
+        raise ImageFetchError(f"صورة غير صالحة: {e}")
+
+
+def _cache_key(src, width):
+    return f"img:{_source_hash(src)}:{width}"
+
+
+def get_image(src, width):
+    """
+    الصورة المصغرة من الكاش، أو جلبها ومعالجتها (مرة واحدة لكل العروض)
+
+    Returns:
+        bytes: صورة WebP
+
+    Raises:
+        ImageFetchError: تعذر الجلب أو المعالجة (أو فشل قريب محفوظ)
+    """
+    width = nearest_width(width)
+    data = image_cache.get(_cache_key(src, width))
+    if data is not None:
+        return data
+
+    source_hash = _source_hash(src)
+    failure_key = f"img_fail:{source_hash}"
+    with _source_locks[int(source_hash[:8], 16) % len(_source_locks)]:
+        data = image_cache.get(_cache_key(src, width))
+        if data is not None:
+            return data
+        if get_backend().get(failure_key):
+            raise ImageFetchError('فشل جلب الصورة مؤخراً')
+
+        try:
+            rendered = _render_all(_fetch(src))
+        except Exception as e:
+            get_backend().set(failure_key, '1', ex=FAILURE_TTL)
+            logger.warning(f"⚠️ تعذر تجهيز الصورة {src[:100]}: {e}")
+            if isinstance(e, ImageFetchError):
+                raise
+            raise ImageFetchError(str(e))
+
+        for rendered_width, rendered_data in rendered.items():
+            image_cache.set(_cache_key(src, rendered_width), rendered_data)
+        return rendered[width]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+سجل طلبات المستخدم
+==================
+مصدر واحد لكل صفحات الطلبات (طلباتي، الملف الشخصي، المشتريات):
+
+- استعلام واحد على orders مفهرس بـ (buyer_id, created_at تنازلي)
+  (الفهرس معرف في firestore.indexes.json)
+- لا يُقرأ إلا حجم الصفحة المطلوبة، مرتبة من الأحدث بدون ترتيب في الكود
+- التصفح بمؤشر (cursor) = معرف آخر طلب في الصفحة السابقة
+
+ملاحظة: الطلبات القديمة بدون created_at لا تظهر في الاستعلام المرتب
+"""
+
+import logging
+
+from extensions import db
+from firebase_utils import query_where
+
+try:
+    from firebase_admin import firestore
+except ImportError:
+    firestore = None
+
+logger = logging.getLogger(__name__)
+
+ORDERS_COLLECTION = 'orders'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+
+
+def _page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _user_orders_query(user_id):
+    return query_where(db.collection(ORDERS_COLLECTION), 'buyer_id', '==', str(user_id)).order_by(
+        'created_at', direction=firestore.Query.DESCENDING
+    )
+
+
+def get_order_history(user_id, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    صفحة من طلبات المستخدم من الأحدث للأقدم
+
+    Args:
+        user_id: معرف المشتري
+        limit: حجم الصفحة (بحد أقصى MAX_PAGE_SIZE)
+        cursor: next_cursor من الصفحة السابقة (None للصفحة الأولى)
+
+    Returns:
+        tuple: (orders, next_cursor)
+               orders قائمة بيانات الطلبات مع 'id'، و next_cursor = None إذا لا توجد صفحة تالية
+    """
+    if not db or not user_id:
+        return [], None
+
+    limit = _page_size(limit)
+    query = _user_orders_query(user_id)
+
+    if cursor:
+        cursor_doc = db.collection(ORDERS_COLLECTION).document(str(cursor)).get()
+        # المؤشر يجب أن يكون طلباً لنفس المستخدم
+        if not cursor_doc.exists or str(cursor_doc.to_dict().get('buyer_id')) != str(user_id):
+            return [], None
+        query = query.start_after(cursor_doc)
+
+    # نجلب طلباً إضافياً لمعرفة وجود صفحة تالية
+    docs = list(query.limit(limit + 1).stream())
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+
+    orders = []
+    for doc in docs:
+        order = doc.to_dict()
+        order['id'] = doc.id
+        orders.append(order)
+
+    next_cursor = docs[-1].id if has_more and docs else None
+    return orders, next_cursor
+
+
+def get_recent_orders(user_id, limit=3):
+    """آخر طلبات المستخدم (للملف الشخصي) - يرجع قائمة فارغة عند الخطأ"""
+    try:
+        orders, _ = get_order_history(user_id, limit=limit)
+        return orders
+    except Exception as e:
+        logger.error(f"خطأ في جلب آخر الطلبات لـ {user_id}: {e}")
+        return []
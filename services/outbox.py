@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+صندوق الصادر (Transactional Outbox)
+===================================
+آثار ما بعد الشراء (رسائل تيليجرام للمشتري والمشرفين، إيميل الطلب، إشعار القناة)
+لا تُنفذ داخل طلب HTTP:
+
+1. تُكتب كمستندات في outbox داخل نفس الـ batch/transaction الذي يحفظ الطلب
+   (إما أن يُحفظ الطلب وآثاره معاً أو لا شيء)
+2. بعد الحفظ مباشرة تُرسل في الخلفية، والاستجابة تعود للمشتري فوراً
+3. كل مستند يُحجز (lease) قبل تنفيذه فلا ينفذه عاملان معاً، ويُحذف بعد النجاح
+4. عند الفشل يُعاد جدولته بتأخير متزايد، والمهام المجدولة تلتقط ما تبقى
+   (مثلاً إذا توقفت العملية قبل الإرسال)
+
+النصوص تُحفظ مشفرة لأنها قد تحتوي بيانات المنتج
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions import db, bot, BOT_ACTIVE
+from circuit_breaker import CircuitOpenError
+from encryption_utils import encrypt_data, decrypt_data
+
+try:
+    from firebase_admin import firestore
+except ImportError:
+    firestore = None
+
+try:
+    from telebot.apihelper import ApiTelegramException
+except ImportError:
+    ApiTelegramException = None
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_COLLECTION = 'outbox'
+LEASE_SECONDS = 60             # مدة حجز المستند أثناء التنفيذ
+MAX_ATTEMPTS = 8               # بعدها يُترك المستند بحالة failed للمراجعة
+RETRY_BASE_SECONDS = 15        # التأخير بعد أول فشل (يتضاعف)
+RETRY_MAX_SECONDS = 3600
+DISPATCH_BATCH_SIZE = 50       # عدد المستندات في كل دورة من المهام المجدولة
+DISPATCH_WORKERS = 4
+
+_holder = f"{socket.gethostname()}:{os.getpid()}"
+_executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS, thread_name_prefix='outbox')
+_handlers = {}
+
+
+class PermanentError(Exception):
+    """فشل لا فائدة من إعادة محاولته"""
+
+
+def outbox_handler(kind):
+    """تسجيل منفذ لنوع من المستندات"""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+# ==================== الكتابة ====================
+
+def add_outbox_entry(writer, kind, payload, entry_id=None):
+    """
+    إضافة مستند للصادر ضمن batch أو transaction (لا يُكتب إلا مع الطلب)
+
+    Args:
+        writer: db.batch() أو transaction
+        kind: نوع الأثر ('telegram_message', 'telegram_admins', 'order_email', 'activity')
+        payload: البيانات التي يحتاجها المنفذ
+        entry_id: معرف ثابت (مثل '{order_id}-buyer') حتى لا يتكرر الأثر
+
+    Returns:
+        str: معرف المستند
+    """
+    entry_id = entry_id or uuid.uuid4().hex
+    writer.set(db.collection(OUTBOX_COLLECTION).document(entry_id), {
+        'kind': kind,
+        'payload': payload,
+        'attempts': 0,
+        'next_attempt_at': time.time(),
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    return entry_id
+
+
+def order_email_payload(to_email, order_items, total_price, new_balance=None):
+    """بيانات إيميل الطلب (المنتجات مشفرة لأنها تحتوي البيانات السرية)"""
+    return {
+        'to_email': to_email,
+        'items': encrypt_data(json.dumps(order_items, ensure_ascii=False)),
+        'total': total_price,
+        'new_balance': new_balance
+    }
+
+
+def telegram_payload(chat_id, text, reply_markup=None, parse_mode=None, fallback=None):
+    """
+    بيانات رسالة تيليجرام
+
+    Args:
+        fallback: (chat_id, text) رسالة بديلة إذا رفض تيليجرام الإرسال نهائياً
+                  (مثل إرسال البيانات للمالك إذا حظر المشتري البوت)
+    """
+    payload = {
+        'chat_id': str(chat_id) if chat_id is not None else None,  # None لرسائل telegram_admins
+        'text': encrypt_data(text),
+        'reply_markup': reply_markup.to_json() if hasattr(reply_markup, 'to_json') else reply_markup,
+        'parse_mode': parse_mode
+    }
+    if fallback:
+        payload['fallback_chat_id'] = str(fallback[0])
+        payload['fallback_text'] = encrypt_data(fallback[1])
+    return payload
+
+
+# ==================== التنفيذ ====================
+
+def _claim(ref):
+    """
+    حجز المستند للتنفيذ (تأجيل موعده بمدة الحجز)
+
+    Returns:
+        dict | None: بيانات المستند إذا تم الحجز
+    """
+    @firestore.transactional
+    def do_claim(transaction):
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        next_attempt_at = data.get('next_attempt_at')
+        if next_attempt_at is None or float(next_attempt_at) > time.time():
+            return None  # منتهي (failed) أو محجوز أو لم يحن وقته
+        transaction.update(ref, {
+            'next_attempt_at': time.time() + LEASE_SECONDS,
+            'lease_holder': _holder
+        })
+        return data
+
+    return do_claim(db.transaction())
+
+
+def _retry_delay(attempts):
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+
+
+def process_entry(entry_id):
+    """
+    تنفيذ مستند واحد
+
+    Returns:
+        bool: True إذا نُفذ بنجاح
+    """
+    ref = db.collection(OUTBOX_COLLECTION).document(entry_id)
+    try:
+        data = _claim(ref)
+    except Exception as e:
+        logger.error(f"خطأ في حجز مستند الصادر {entry_id}: {e}")
+        return False
+    if not data:
+        return False
+
+    kind = data.get('kind')
+    handler = _handlers.get(kind)
+    try:
+        if not handler:
+            raise PermanentError(f"نوع غير معروف: {kind}")
+        handler(data.get('payload') or {})
+    except CircuitOpenError as e:
+        # الخدمة متوقفة: لا تُحسب محاولة، نعود بعد انتهاء فترة الإيقاف
+        ref.update({'next_attempt_at': time.time() + max(e.retry_after, RETRY_BASE_SECONDS), 'last_error': str(e)[:200]})
+        return False
+    except Exception as e:
+        attempts = int(data.get('attempts', 0)) + 1
+        if isinstance(e, PermanentError) or attempts >= MAX_ATTEMPTS:
+            logger.error(f"❌ فشل نهائي لمستند الصادر {entry_id} ({kind}) بعد {attempts} محاولة: {e}")
+            ref.update({
+                'status': 'failed',
+                'attempts': attempts,
+                'next_attempt_at': firestore.DELETE_FIELD,
+                'last_error': str(e)[:200]
+            })
+        else:
+            logger.warning(f"⚠️ فشل مستند الصادر {entry_id} ({kind}) - محاولة {attempts}: {e}")
+            ref.update({
+                'attempts': attempts,
+                'next_attempt_at': time.time() + _retry_delay(attempts),
+                'last_error': str(e)[:200]
+            })
+        return False
+
+    ref.delete()
+    return True
+
+
+def dispatch_async(entry_ids):
+    """تنفيذ المستندات في الخلفية مباشرة بعد حفظ الطلب"""
+    for entry_id in entry_ids:
+        _executor.submit(process_entry, entry_id)
+
+
+def dispatch_due(limit=DISPATCH_BATCH_SIZE):
+    """
+    تنفيذ المستندات المستحقة (مهمة مجدولة - تلتقط ما فشل أو لم يُنفذ)
+
+    Returns:
+        int: عدد المستندات المنفذة
+    """
+    from firebase_utils import query_where
+
+    if not db:
+        return 0
+    query = query_where(db.collection(OUTBOX_COLLECTION), 'next_attempt_at', '<=', time.time())
+    entry_ids = [doc.id for doc in query.order_by('next_attempt_at').limit(limit).stream()]
+
+    done = sum(1 for entry_id in entry_ids if process_entry(entry_id))
+    if done:
+        print(f"📤 تم تنفيذ {done} من آثار الطلبات المؤجلة")
+    return done
+
+
+# ==================== المنفذات ====================
+
+def _is_permanent_telegram_error(e):
+    return (ApiTelegramException is not None and isinstance(e, ApiTelegramException)
+            and getattr(e, 'error_code', None) != 429)
+
+
+@outbox_handler('telegram_message')
+def _send_telegram_message(payload):
+    if not (BOT_ACTIVE and bot):
+        raise RuntimeError('البوت غير متاح')
+    try:
+        bot.send_message(
+            int(payload['chat_id']),
+            decrypt_data(payload.get('text', '')),
+            reply_markup=payload.get('reply_markup'),
+            parse_mode=payload.get('parse_mode')
+        )
+    except Exception as e:
+        if not _is_permanent_telegram_error(e):
+            raise
+        if payload.get('fallback_chat_id'):
+            bot.send_message(
+                int(payload['fallback_chat_id']),
+                decrypt_data(payload.get('fallback_text', '')) + f"\n❌ السبب: {e}"
+            )
+            return
+        raise PermanentError(str(e))
+
+
+@outbox_handler('telegram_admins')
+def _send_telegram_admins(payload):
+    """رسالة للمالك وكل المشرفين (قائمة المشرفين تُقرأ وقت الإرسال)"""
+    if not (BOT_ACTIVE and bot):
+        raise RuntimeError('البوت غير متاح')
+
+    from notifications import fan_out
+    from admin_cache import admin_registry
+
+    text = decrypt_data(payload.get('text', ''))
+    results = fan_out(admin_registry.recipients(), lambda chat_id: bot.send_message(
+        chat_id, text, reply_markup=payload.get('reply_markup'), parse_mode=payload.get('parse_mode')
+    ))
+    # فشل مشرف واحد لا يعيد الإرسال للجميع، إلا إذا كانت الخدمة متوقفة (لم يُرسل شيء)
+    errors = [error for error in results.values() if error is not None]
+    if errors and len(errors) == len(results) and all(isinstance(e, CircuitOpenError) for e in errors):
+        raise errors[0]
+
+
+@outbox_handler('order_email')
+def _send_order_email(payload):
+    from notifications import send_order_email
+    send_order_email(
+        payload['to_email'],
+        json.loads(decrypt_data(payload['items'])),
+        payload.get('total', 0),
+        payload.get('new_balance'),
+        wait=True
+    )
+
+
+@outbox_handler('activity')
+def _send_activity(payload):
+    from notifications import send_activity_notification, ACTIVITY_CHANNEL_ID
+    if not ACTIVITY_CHANNEL_ID:
+        return
+    if not send_activity_notification(payload.get('activity_type'), payload.get('user_id'),
+                                      payload.get('username'), payload.get('details')):
+        raise RuntimeError('فشل إرسال إشعار القناة')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+صور حسابات المستخدمين
+=====================
+بدل رابط api.telegram.org (الذي يحتوي توكن البوت ويُحمّل الصورة الأصلية في كل زيارة):
+
+- الصورة تُجلب من تيليجرام مرة واحدة وتُصغر إلى WebP صغير (Pillow)
+- تُحفظ في كاش على القرص (LRU محدود الحجم) بمفتاح file_unique_id
+- تُعرض من مسار /avatar/<user_id>?v=<file_unique_id> مع Cache-Control طويل
+  (تغيير الصورة في تيليجرام يغير file_unique_id وبالتالي الرابط)
+- المستخدم يحفظ فيه: profile_photo (الرابط)، profile_photo_file_id، profile_photo_unique_id
+"""
+
+import os
+import io
+import logging
+
+import http_client
+from extensions import db, bot
+from disk_cache import DiskLRUCache
+from config import MEDIA_CACHE_DIR, AVATAR_CACHE_MAX_MB
+
+# Pillow (اختياري - يأتي مع qrcode[pil])
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = None
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+AVATAR_SIZE = 160             # أبعاد الصورة المعروضة (بكسل)
+AVATAR_WEBP_QUALITY = 80
+MAX_SOURCE_BYTES = 5 * 1024 * 1024
+
+avatar_cache = DiskLRUCache(
+    os.path.join(MEDIA_CACHE_DIR, 'avatars'),
+    max_bytes=AVATAR_CACHE_MAX_MB * 1024 * 1024
+)
+
+
+def avatar_url(user_id, unique_id=None):
+    """رابط الصورة في الموقع (مع رقم النسخة للكاش الطويل)"""
+    if unique_id:
+        return f"/avatar/{user_id}?v={unique_id}"
+    return f"/avatar/{user_id}"
+
+
+def public_photo_url(user_id, user_data):
+    """
+    رابط الصورة للعرض من بيانات المستخدم
+    الروابط القديمة المحفوظة (api.telegram.org) لا تُرسل للمتصفح أبداً
+    """
+    if not user_data:
+        return ''
+    if user_data.get('profile_photo_unique_id'):
+        return avatar_url(user_id, user_data['profile_photo_unique_id'])
+    stored = user_data.get('profile_photo') or ''
+    if 'api.telegram.org' in stored:
+        return avatar_url(user_id)
+    return stored
+
+
+def session_photo_url(session):
+    """
+    رابط الصورة المحفوظ في الجلسة بعد تنقيته
+    (الجلسات القديمة قد تحمل رابط api.telegram.org الذي يحتوي التوكن)
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return ''
+    return public_photo_url(user_id, {'profile_photo': session.get('profile_photo', '')})
+
+
+def avatar_mimetype(data):
+    return 'image/webp' if data[:4] == b'RIFF' else 'image/jpeg'
+
+
+def _cache_key(user_id, unique_id):
+    # user_id في المفتاح: النسخة (v) في الرابط لا تفتح صورة مستخدم آخر
+    return f"avatar:{user_id}:{unique_id}:{AVATAR_SIZE}"
+
+
+def _pick_size(sizes):
+    """أصغر نسخة من الصورة تكفي للعرض (تيليجرام يرسل 160 و 320 و 640)"""
+    for size in sizes:
+        if size.width >= AVATAR_SIZE:
+            return size
+    return sizes[-1]
+
+
+def _download(file_id):
+    """تحميل الملف من تيليجرام (التوكن يبقى في الخادم)"""
+    file_info = bot.get_file(file_id)
+    response = http_client.get(
+        f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}",
+        timeout=http_client.TELEGRAM_TIMEOUT,
+        breaker='telegram'
+    )
+    response.raise_for_status()
+    if len(response.content) > MAX_SOURCE_BYTES:
+        raise ValueError('حجم الصورة أكبر من المسموح')
+    return response.content
+
+
+def _to_avatar(data):
+    """تصغير الصورة وتحويلها إلى WebP (بدون Pillow تُحفظ كما هي)"""
+    if not PIL_AVAILABLE:
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGB')
+        image.thumbnail((AVATAR_SIZE, AVATAR_SIZE))
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=AVATAR_WEBP_QUALITY, method=4)
+        return output.getvalue()
+
+
+def _store(user_id, file_id, unique_id):
+    """تحميل ومعالجة وحفظ الصورة في الكاش"""
+    data = _to_avatar(_download(file_id))
+    avatar_cache.set(_cache_key(user_id, unique_id), data)
+    return data
+
+
+def refresh_user_photo(user_id):
+    """
+    فحص صورة المستخدم في تيليجرام (طلب واحد)، والتحميل فقط إذا تغير file_unique_id
+
+    Returns:
+        dict | None: الحقول التي تُحفظ في مستند المستخدم، أو None إذا لا توجد صورة
+    """
+    try:
+        photos = bot.get_user_profile_photos(int(user_id), limit=1)
+        if not photos.total_count:
+            return None
+        size = _pick_size(photos.photos[0])
+        if avatar_cache.get(_cache_key(user_id, size.file_unique_id)) is None:
+            _store(user_id, size.file_id, size.file_unique_id)
+        return {
+            'profile_photo': avatar_url(user_id, size.file_unique_id),
+            'profile_photo_file_id': size.file_id,
+            'profile_photo_unique_id': size.file_unique_id
+        }
+    except Exception as e:
+        print(f"⚠️ خطأ في جلب صورة البروفايل: {e}")
+        return None
+
+
+def get_avatar(user_id, version=None):
+    """
+    بيانات صورة المستخدم للعرض
+
+    Returns:
+        tuple: (bytes, unique_id) أو (None, None)
+    """
+    if version:
+        data = avatar_cache.get(_cache_key(user_id, version))
+        if data is not None:
+            return data, version
+
+    if not db:
+        return None, None
+    user_doc = db.collection('users').document(str(user_id)).get()
+    if not user_doc.exists:
+        return None, None
+    user_data = user_doc.to_dict()
+
+    file_id = user_data.get('profile_photo_file_id')
+    unique_id = user_data.get('profile_photo_unique_id')
+    if file_id and unique_id:
+        data = avatar_cache.get(_cache_key(user_id, unique_id))
+        if data is None:
+            # حُذفت من الكاش: إعادة التحميل بالمعرف المحفوظ
+            try:
+                data = _store(user_id, file_id, unique_id)
+            except Exception as e:
+                logger.error(f"خطأ في تحميل صورة المستخدم {user_id}: {e}")
+                return None, None
+        return data, unique_id
+
+    # مستخدم قديم (رابط تيليجرام محفوظ فقط): فحص مرة واحدة وحفظ الحقول الجديدة
+    if not user_data.get('profile_photo'):
+        return None, None
+    fields = refresh_user_photo(user_id)
+    if not fields:
+        return None, None
+    db.collection('users').document(str(user_id)).update(fields)
+    return avatar_cache.get(_cache_key(user_id, fields['profile_photo_unique_id'])), fields['profile_photo_unique_id']
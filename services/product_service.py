@@ -38,6 +38,7 @@ class ProductService:
             product_data['created_at'] = firestore.SERVER_TIMESTAMP
             
             self.db.collection('products').document(product_id).set(product_data)
+            self.firebase_utils.clear_cache('products')
             print(f"✅ تم إضافة المنتج: {product_id}")
             return product_id
         except Exception as e:
@@ -61,6 +61,30 @@ function showToast(message, type = 'success', actionText = null, actionCallback
     setTimeout(() => toast.classList.remove('show'), 3500);
 }
 
+// ========== طلبات الشراء والدفع بدون تكرار ==========
+// كل عملية لها Idempotency-Key، وإعادة المحاولة بعد انقطاع الشبكة تستخدم نفس المفتاح
+// فيرجع الخادم نفس الرد بدل تنفيذ الشراء أو إنشاء الفاتورة مرتين
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+}
+
+async function idempotentPost(url, body, retries = 2) {
+    const key = newIdempotencyKey();
+    for (let attempt = 0; ; attempt++) {
+        try {
+            return await fetch(url, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json', 'Idempotency-Key': key},
+                body: JSON.stringify(body || {})
+            });
+        } catch (e) {
+            if (attempt >= retries) throw e;
+            await new Promise(resolve => setTimeout(resolve, 500 * (attempt + 1)));
+        }
+    }
+}
+
 // ========== إغلاق بـ Escape ==========
 document.addEventListener('keydown', function(e) {
     if (e.key === 'Escape') {
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+مخزن الحالة المشترك
+===================
+واجهة تخزين بنمط Redis تُستخدم للبيانات المؤقتة المشتركة بين العمليات
+(حدود المحاولات، الحظر المؤقت، أكواد التحقق...)
+
+- إذا تم ضبط STATE_STORE_URL على redis://: يُستخدم Redis
+  (مكتبة redis غير مثبتة أو فشل الاتصال: خطأ عند التشغيل بدل الرجوع للذاكرة المحلية،
+  لأن المخزن المحلي لا يُشارك بين العمليات فتفشل ضمانات عدم التكرار بصمت)
+- غير ذلك (memory://): مخزن محلي في الذاكرة يحاكي نفس الأوامر مع حذف تلقائي للمفاتيح المنتهية
+"""
+
+import time
+import threading
+import logging
+
+from config import STATE_STORE_URL
+
+logger = logging.getLogger(__name__)
+
+# استيراد Redis (اختياري)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    redis = None
+    REDIS_AVAILABLE = False
+
+
+class StateStoreUnavailable(RuntimeError):
+    """STATE_STORE_URL يشير إلى Redis ولا يمكن استخدامه"""
+
+
+# ==================== المخزن المحلي ====================
+
+class LocalBackend:
+    """
+    مخزن محلي في الذاكرة يطبق جزءاً من أوامر Redis
+    القيم النصية تُخزن كنصوص (مثل Redis مع decode_responses=True)
+    """
+
+    SWEEP_INTERVAL = 60  # تنظيف المفاتيح المنتهية كل دقيقة
+
+    def __init__(self):
+        self._data = {}      # {key: value}
+        self._expires = {}   # {key: expires_at}
+        self._lock = threading.RLock()
+        self._last_sweep = time.time()
+
+    # --- أدوات داخلية ---
+
+    def _alive(self, key):
+        """التحقق من وجود المفتاح وعدم انتهائه (يحذفه إذا انتهى)"""
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return key in self._data
+
+    def _maybe_sweep(self):
+        """حذف كل المفاتيح المنتهية بشكل دوري"""
+        now = time.time()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for key in [k for k, exp in self._expires.items() if exp <= now]:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    # --- أوامر النصوص ---
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            self._maybe_sweep()
+            if nx and self._alive(key):
+                return None
+            self._data[key] = str(value)
+            if ex:
+                self._expires[key] = time.time() + ex
+            else:
+                self._expires.pop(key, None)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    removed += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.time() + seconds
+            return True
+
+    def ttl(self, key):
+        with self._lock:
+            if not self._alive(key):
+                return -2
+            expires_at = self._expires.get(key)
+            if expires_at is None:
+                return -1
+            return max(0, int(expires_at - time.time()))
+
+    # --- أوامر الـ hash ---
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            self._maybe_sweep()
+            fields = dict(mapping or {})
+            if field is not None:
+                fields[field] = value
+            hash_value = self._data.get(key) if self._alive(key) else None
+            if hash_value is None:
+                hash_value = {}
+                self._data[key] = hash_value
+            added = sum(1 for f in fields if f not in hash_value)
+            hash_value.update({f: str(v) for f, v in fields.items()})
+            return added
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data[key]) if self._alive(key) else {}
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            hash_value = self._data.get(key) if self._alive(key) else None
+            if hash_value is None:
+                hash_value = {}
+                self._data[key] = hash_value
+            new_value = int(hash_value.get(field, 0)) + amount
+            hash_value[field] = str(new_value)
+            return new_value
+
+    # --- أوامر المجموعات المرتبة (sorted sets) ---
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            self._maybe_sweep()
+            zset = self._data.get(key) if self._alive(key) else None
+            if zset is None:
+                zset = {}
+                self._data[key] = zset
+            added = sum(1 for member in mapping if member not in zset)
+            zset.update({member: float(score) for member, score in mapping.items()})
+            return added
+
+    def zremrangebyscore(self, key, min_score, max_score):
+        with self._lock:
+            if not self._alive(key):
+                return 0
+            zset = self._data[key]
+            stale = [m for m, s in zset.items() if min_score <= s <= max_score]
+            for member in stale:
+                del zset[member]
+            return len(stale)
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._data[key]) if self._alive(key) else 0
+
+    def zrange(self, key, start, end, withscores=False):
+        with self._lock:
+            if not self._alive(key):
+                return []
+            items = sorted(self._data[key].items(), key=lambda item: item[1])
+            end = len(items) if end == -1 else end + 1
+            items = items[start:end]
+            return items if withscores else [member for member, _ in items]
+
+    # --- التنفيذ الذري ---
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline:
+    """تجميع أوامر وتنفيذها دفعة واحدة تحت القفل (مثل MULTI/EXEC)"""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._backend, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self._backend._lock:
+            results = [method(*args, **kwargs) for method, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+# ==================== اختيار المخزن ====================
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _create_backend():
+    """إنشاء المخزن حسب الإعدادات"""
+    if STATE_STORE_URL.startswith(('redis://', 'rediss://')):
+        if not REDIS_AVAILABLE:
+            logger.error("❌ STATE_STORE_URL يشير إلى Redis لكن مكتبة redis غير مثبتة")
+            raise StateStoreUnavailable('مكتبة redis غير مثبتة (pip install -r requirements.txt)')
+        try:
+            client = redis.Redis.from_url(STATE_STORE_URL, decode_responses=True)
+            client.ping()
+        except Exception as e:
+            logger.error(f"❌ فشل الاتصال بـ Redis (STATE_STORE_URL): {e}")
+            raise StateStoreUnavailable(f'فشل الاتصال بـ Redis: {e}') from e
+        print("✅ مخزن الحالة: Redis")
+        return client
+    return LocalBackend()
+
+
+def get_backend():
+    """الحصول على المخزن المشترك (يُنشأ مرة واحدة)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """استبدال المخزن (مثلاً بمخزن محلي وهمي)"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def is_shared_backend():
+    """هل المخزن مشترك بين العمليات (Redis)؟"""
+    return not isinstance(get_backend(), LocalBackend)
+
+
+def get_limiter_storage_uri():
+    """عنوان التخزين لـ Flask-Limiter (نفس Redis إن وُجد)"""
+    if is_shared_backend():
+        return STATE_STORE_URL
+    return "memory://"
@@ -9,8 +9,9 @@ import requests
 import hashlib
 import uuid
 from telebot import types
+import http_client
 from extensions import (
-    bot, db, user_states, verification_codes,
+    bot, db, user_states, bot_drafts, verification_codes,
     ADMIN_ID, logger, BOT_ACTIVE, SITE_URL,
     EDFAPAY_MERCHANT_ID, EDFAPAY_PASSWORD
 )
@@ -34,24 +35,22 @@ try:
 except ImportError:
     firestore = None
 
-# استيراد FieldFilter للنسخ الجديدة
-try:
-    from google.cloud.firestore_v1.base_query import FieldFilter
-    USE_FIELD_FILTER = True
-except ImportError:
-    USE_FIELD_FILTER = False
-
 # استيراد دوال Firebase
 from firebase_utils import (
-    get_balance, add_balance, deduct_balance,
+    add_balance, deduct_balance,
     get_categories, get_products, get_product_by_id,
-    get_charge_key, use_charge_key, create_charge_key,
+    redeem_charge_key,
     save_pending_payment, get_pending_payment,
-    get_all_products_for_store, get_all_charge_keys
+    get_all_products_for_store, get_all_charge_keys, clear_cache
 )
 
 from utils import generate_code
 import telebot
+from .callback_router import CallbackRouter
+from services.charge_key_service import generate_charge_keys, MAX_KEYS_PER_BATCH
+from deliverability_store import deliverability
+from admin_cache import admin_profiles, admin_registry
+from services.photo_service import refresh_user_photo
 
 # استيراد نظام الإشعارات
 try:
@@ -74,6 +73,10 @@ except ImportError:
     encrypt_data = lambda x: x
     decrypt_data = lambda x: x
 
+# === موجه الأزرار: معالج واحد في البوت يوجه كل callback_data عبر قاموس ===
+callback_router = CallbackRouter()
+callback_router.attach(bot)
+
 # دالة توليد كود التحقق
 def generate_verification_code():
     return str(random.randint(100000, 999999))
@@ -95,21 +98,6 @@ def log_message(message, handler_name):
     print(f"💬 النص: {message.text}")
     print("="*50)
 
-# === دالة جلب صورة المستخدم ===
-def get_user_profile_photo(user_id):
-    """جلب صورة بروفايل المستخدم من تيليجرام"""
-    try:
-        photos = bot.get_user_profile_photos(int(user_id), limit=1)
-        if photos.total_count > 0:
-            file_id = photos.photos[0][0].file_id
-            file_info = bot.get_file(file_id)
-            photo_url = f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}"
-            return photo_url
-    except Exception as e:
-        print(f"⚠️ خطأ في جلب صورة البروفايل: {e}")
-    return None
-
-
 # ===================== النسخ الاحتياطي =====================
 import io
 import datetime
@@ -182,6 +170,12 @@ def manual_backup(message):
         bot.reply_to(message, f"❌ فشل النسخ الاحتياطي!\nالخطأ: {e}")
 
 
+@bot.my_chat_member_handler()
+def track_bot_membership(update):
+    """تحديث حالة إمكانية مراسلة المستخدم عند حظر البوت أو بدئه من جديد"""
+    deliverability.learn_from_chat_member(update)
+
+
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     log_message(message, "معالج /start")
@@ -192,8 +186,8 @@ def send_welcome(message):
             user_name += ' ' + message.from_user.last_name
         username = message.from_user.username or ''
         
-        # جلب صورة البروفايل من تيليجرام
-        profile_photo = get_user_profile_photo(user_id)
+        # جلب صورة البروفايل من تيليجرام (تُحمّل فقط إذا تغيرت وتُعرض من /avatar)
+        photo_fields = refresh_user_photo(user_id)
         
         # جلب رصيد المستخدم
         balance = 0.0
@@ -214,8 +208,8 @@ def send_welcome(message):
                         'created_at': firestore.SERVER_TIMESTAMP,
                         'last_seen': firestore.SERVER_TIMESTAMP
                     }
-                    if profile_photo:
-                        user_data['profile_photo'] = profile_photo
+                    if photo_fields:
+                        user_data.update(photo_fields)
                     user_ref.set(user_data)
                     print(f"✅ مستخدم جديد تم إنشاؤه")
                     
@@ -230,8 +224,8 @@ def send_welcome(message):
                         'telegram_started': True,  # تحديث: المستخدم بدأ محادثة مع البوت
                         'last_seen': firestore.SERVER_TIMESTAMP
                     }
-                    if profile_photo:
-                        update_data['profile_photo'] = profile_photo
+                    if photo_fields:
+                        update_data.update(photo_fields)
                     user_ref.update(update_data)
                     print(f"✅ مستخدم موجود تم تحديثه")
             except Exception as e:
@@ -268,7 +262,7 @@ def send_welcome(message):
         traceback.print_exc()
 
 # معالج أزرار Inline
-@bot.callback_query_handler(func=lambda call: call.data == "my_id")
+@callback_router.exact("my_id")
 def handle_myid_button(call):
     try:
         bot.send_message(
@@ -282,7 +276,7 @@ def handle_myid_button(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 # معالج زر الدعم الفني
-@bot.callback_query_handler(func=lambda call: call.data == "support_contact")
+@callback_router.exact("support_contact")
 def handle_support_button(call):
     """معالج زر الدعم الفني"""
     try:
@@ -312,7 +306,7 @@ def handle_support_button(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 # معالج زر الرجوع للقائمة الرئيسية
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_main")
+@callback_router.exact("back_to_main")
 def handle_back_to_main(call):
     """الرجوع للقائمة الرئيسية"""
     try:
@@ -357,7 +351,7 @@ def handle_back_to_main(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 # معالج زر إنشاء فاتورة
-@bot.callback_query_handler(func=lambda call: call.data == "create_invoice")
+@callback_router.exact("create_invoice")
 def handle_create_invoice_button(call):
     """معالج زر إنشاء فاتورة من الصفحة الرئيسية"""
     try:
@@ -418,8 +412,71 @@ def my_id(message):
     except Exception as e:
         print(f"❌ خطأ: {e}")
 
-# تخزين بيانات المنتج المؤقتة
-temp_product_data = {}
+# ==================== المعالجات متعددة الخطوات ====================
+# الخطوة المنتظرة تُحفظ في user_states والبيانات في bot_drafts (المخزن المشترك)
+# بدل register_next_step_handler والقواميس في الذاكرة، فتعمل مع أكثر من عملية
+# handle_user_state_message يوجه الرسالة لدالة الخطوة حسب الحالة
+wizard_steps = {}  # {state: func(message)}
+
+
+def wizard_step(state):
+    """تسجيل دالة خطوة لحالة معينة"""
+    def decorator(func):
+        wizard_steps[state] = func
+        return func
+    return decorator
+
+
+def expect_step(user_id, state):
+    """انتظار رسالة المستخدم التالية لخطوة معينة"""
+    user_states[user_id] = {'state': state, 'created_at': time.time()}
+
+
+def update_draft(key, **fields):
+    """تحديث مسودة في المخزن المشترك"""
+    draft = dict(bot_drafts.get(key) or {})
+    draft.update(fields)
+    bot_drafts[key] = draft
+    return draft
+
+
+# ==================== إضافة منتج (للمالك) ====================
+
+PRODUCT_CATEGORIES = ["نتفلكس", "شاهد", "ديزني بلس", "اوسن بلس", "فديو بريميم", "اشتراكات أخرى"]
+PRODUCT_DELIVERY_CHOICES = {"⚡ تسليم فوري": 'instant', "👨‍💼 تسليم يدوي": 'manual'}
+
+
+def _product_draft_key(user_id):
+    return f"product:{user_id}"
+
+
+def _product_draft(message):
+    """مسودة المنتج (أو None مع رسالة انتهاء إذا حُذفت)"""
+    draft = bot_drafts.get(_product_draft_key(message.from_user.id))
+    if draft is None:
+        user_states.clear(message.from_user.id)
+        bot.reply_to(message, "⚠️ انتهت الجلسة. أرسل /add_product للبدء من جديد", reply_markup=types.ReplyKeyboardRemove())
+    return draft
+
+
+def _cancel_add_product(message):
+    user_id = message.from_user.id
+    bot_drafts.clear(_product_draft_key(user_id))
+    user_states.clear(user_id)
+    return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
+
+
+def _categories_markup():
+    markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
+    markup.add(*[types.KeyboardButton(name) for name in PRODUCT_CATEGORIES])
+    return markup
+
+
+def _delivery_markup():
+    markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
+    markup.add(*[types.KeyboardButton(label) for label in PRODUCT_DELIVERY_CHOICES])
+    return markup
+
 
 # أمر إضافة منتج (فقط للمالك)
 @bot.message_handler(commands=['add_product'])
@@ -430,169 +487,148 @@ def add_product_command(message):
     
     # بدء عملية إضافة منتج جديد
     user_id = message.from_user.id
-    temp_product_data[user_id] = {}
+    bot_drafts[_product_draft_key(user_id)] = {}
+    expect_step(user_id, 'product_name')
     
-    msg = bot.reply_to(message, "📦 **إضافة منتج جديد**\n\n📝 أرسل اسم المنتج:", parse_mode="Markdown")
-    bot.register_next_step_handler(msg, process_product_name)
+    bot.reply_to(message, "📦 **إضافة منتج جديد**\n\n📝 أرسل اسم المنتج:", parse_mode="Markdown")
 
+@wizard_step('product_name')
 def process_product_name(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
-    temp_product_data[user_id]['item_name'] = message.text.strip()
+    update_draft(_product_draft_key(user_id), item_name=message.text.strip())
     bot.reply_to(message, f"✅ تم إضافة الاسم: {message.text.strip()}")
     
-    msg = bot.send_message(message.chat.id, "💰 أرسل سعر المنتج (بالريال):")
-    bot.register_next_step_handler(msg, process_product_price)
+    expect_step(user_id, 'product_price')
+    bot.send_message(message.chat.id, "💰 أرسل سعر المنتج (بالريال):")
 
+@wizard_step('product_price')
 def process_product_price(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
     # التحقق من السعر
     try:
         price = float(message.text.strip())
-        temp_product_data[user_id]['price'] = str(price)
-        bot.reply_to(message, f"✅ تم إضافة السعر: {price} ريال")
-        
-        # إرسال أزرار الفئات
-        markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        markup.add(
-            types.KeyboardButton("نتفلكس"),
-            types.KeyboardButton("شاهد"),
-            types.KeyboardButton("ديزني بلس"),
-            types.KeyboardButton("اوسن بلس"),
-            types.KeyboardButton("فديو بريميم"),
-            types.KeyboardButton("اشتراكات أخرى")
-        )
-        
-        msg = bot.send_message(message.chat.id, "🏷️ اختر فئة المنتج:", reply_markup=markup)
-        bot.register_next_step_handler(msg, process_product_category)
-        
     except ValueError:
-        msg = bot.reply_to(message, "❌ السعر يجب أن يكون رقماً! أرسل السعر مرة أخرى:")
-        bot.register_next_step_handler(msg, process_product_price)
+        expect_step(user_id, 'product_price')
+        return bot.reply_to(message, "❌ السعر يجب أن يكون رقماً! أرسل السعر مرة أخرى:")
+    
+    update_draft(_product_draft_key(user_id), price=str(price))
+    bot.reply_to(message, f"✅ تم إضافة السعر: {price} ريال")
+    
+    # إرسال أزرار الفئات
+    expect_step(user_id, 'product_category')
+    bot.send_message(message.chat.id, "🏷️ اختر فئة المنتج:", reply_markup=_categories_markup())
 
+@wizard_step('product_category')
 def process_product_category(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
-    
-    valid_categories = ["نتفلكس", "شاهد", "ديزني بلس", "اوسن بلس", "فديو بريميم", "اشتراكات أخرى"]
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
-    if message.text.strip() not in valid_categories:
-        markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        markup.add(
-            types.KeyboardButton("نتفلكس"),
-            types.KeyboardButton("شاهد"),
-            types.KeyboardButton("ديزني بلس"),
-            types.KeyboardButton("اوسن بلس"),
-            types.KeyboardButton("فديو بريميم"),
-            types.KeyboardButton("اشتراكات أخرى")
-        )
-        msg = bot.reply_to(message, "❌ فئة غير صحيحة! اختر من الأزرار:", reply_markup=markup)
-        return bot.register_next_step_handler(msg, process_product_category)
+    if message.text.strip() not in PRODUCT_CATEGORIES:
+        expect_step(user_id, 'product_category')
+        return bot.reply_to(message, "❌ فئة غير صحيحة! اختر من الأزرار:", reply_markup=_categories_markup())
     
-    temp_product_data[user_id]['category'] = message.text.strip()
+    update_draft(_product_draft_key(user_id), category=message.text.strip())
     bot.reply_to(message, f"✅ تم اختيار الفئة: {message.text.strip()}", reply_markup=types.ReplyKeyboardRemove())
     
-    msg = bot.send_message(message.chat.id, "📝 أرسل تفاصيل المنتج (مثل: مدة الاشتراك، المميزات، إلخ):")
-    bot.register_next_step_handler(msg, process_product_details)
+    expect_step(user_id, 'product_details')
+    bot.send_message(message.chat.id, "📝 أرسل تفاصيل المنتج (مثل: مدة الاشتراك، المميزات، إلخ):")
 
+@wizard_step('product_details')
 def process_product_details(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
-    temp_product_data[user_id]['details'] = message.text.strip()
+    update_draft(_product_draft_key(user_id), details=message.text.strip())
     bot.reply_to(message, "✅ تم إضافة التفاصيل")
     
     markup = types.ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
     markup.add(types.KeyboardButton("تخطي"))
     
-    msg = bot.send_message(message.chat.id, "🖼️ أرسل رابط صورة المنتج (أو اضغط تخطي):", reply_markup=markup)
-    bot.register_next_step_handler(msg, process_product_image)
+    expect_step(user_id, 'product_image')
+    bot.send_message(message.chat.id, "🖼️ أرسل رابط صورة المنتج (أو اضغط تخطي):", reply_markup=markup)
 
+@wizard_step('product_image')
 def process_product_image(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
     if message.text.strip() == "تخطي":
-        temp_product_data[user_id]['image_url'] = "https://placehold.co/300x200/6c5ce7/ffffff?text=No+Image"
+        update_draft(_product_draft_key(user_id), image_url="https://placehold.co/300x200/6c5ce7/ffffff?text=No+Image")
         bot.reply_to(message, "⏭️ تم تخطي الصورة", reply_markup=types.ReplyKeyboardRemove())
     else:
-        temp_product_data[user_id]['image_url'] = message.text.strip()
+        update_draft(_product_draft_key(user_id), image_url=message.text.strip())
         bot.reply_to(message, "✅ تم إضافة رابط الصورة", reply_markup=types.ReplyKeyboardRemove())
     
-    msg = bot.send_message(message.chat.id, "🔐 أرسل البيانات المخفية (الايميل والباسورد مثلاً):")
-    bot.register_next_step_handler(msg, process_product_hidden_data)
+    expect_step(user_id, 'product_hidden_data')
+    bot.send_message(message.chat.id, "🔐 أرسل البيانات المخفية (الايميل والباسورد مثلاً):")
 
+@wizard_step('product_hidden_data')
 def process_product_hidden_data(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
-    temp_product_data[user_id]['hidden_data'] = message.text.strip()
+    # تُحفظ في المسودة مشفرة (المخزن المشترك قد يكون Redis)
+    update_draft(_product_draft_key(user_id), hidden_data=encrypt_data(message.text.strip()))
     bot.reply_to(message, "✅ تم إضافة البيانات المخفية")
     
     # سؤال عن نوع التسليم
-    markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-    markup.add(
-        types.KeyboardButton("⚡ تسليم فوري"),
-        types.KeyboardButton("👨‍💼 تسليم يدوي")
-    )
-    
-    msg = bot.send_message(
+    expect_step(user_id, 'product_delivery_type')
+    bot.send_message(
         message.chat.id, 
         "📦 اختر نوع التسليم:\n\n"
         "⚡ **تسليم فوري**: يتم إرسال البيانات تلقائياً للمشتري\n"
         "👨‍💼 **تسليم يدوي**: يتم إشعار الأدمن لتنفيذ الطلب",
         parse_mode="Markdown",
-        reply_markup=markup
+        reply_markup=_delivery_markup()
     )
-    bot.register_next_step_handler(msg, process_product_delivery_type)
 
+@wizard_step('product_delivery_type')
 def process_product_delivery_type(message):
     user_id = message.from_user.id
     
     if message.text == '/cancel':
-        temp_product_data.pop(user_id, None)
-        return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
-    
-    if message.text == "⚡ تسليم فوري":
-        temp_product_data[user_id]['delivery_type'] = 'instant'
-        delivery_display = "⚡ تسليم فوري"
-    elif message.text == "👨‍💼 تسليم يدوي":
-        temp_product_data[user_id]['delivery_type'] = 'manual'
-        delivery_display = "👨‍💼 تسليم يدوي"
-    else:
-        markup = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        markup.add(
-            types.KeyboardButton("⚡ تسليم فوري"),
-            types.KeyboardButton("👨‍💼 تسليم يدوي")
-        )
-        msg = bot.reply_to(message, "❌ اختيار غير صحيح! اختر من الأزرار:", reply_markup=markup)
-        return bot.register_next_step_handler(msg, process_product_delivery_type)
+        return _cancel_add_product(message)
+    if _product_draft(message) is None:
+        return
     
+    delivery_type = PRODUCT_DELIVERY_CHOICES.get(message.text)
+    if not delivery_type:
+        expect_step(user_id, 'product_delivery_type')
+        return bot.reply_to(message, "❌ اختيار غير صحيح! اختر من الأزرار:", reply_markup=_delivery_markup())
+    delivery_display = message.text
+    
+    product = update_draft(_product_draft_key(user_id), delivery_type=delivery_type)
     bot.reply_to(message, f"✅ نوع التسليم: {delivery_display}", reply_markup=types.ReplyKeyboardRemove())
     
     # عرض ملخص المنتج
-    product = temp_product_data[user_id]
     summary = (
         "📦 **ملخص المنتج:**\n\n"
         f"📝 الاسم: {product['item_name']}\n"
@@ -600,7 +636,7 @@ def process_product_delivery_type(message):
         f"🏷️ الفئة: {product['category']}\n"
         f"📋 التفاصيل: {product['details']}\n"
         f"🖼️ الصورة: {product['image_url']}\n"
-        f"🔐 البيانات: {product['hidden_data']}\n"
+        f"🔐 البيانات: {decrypt_data(product['hidden_data'])}\n"
         f"📦 التسليم: {delivery_display}\n\n"
         "هل تريد إضافة هذا المنتج؟"
     )
@@ -611,74 +647,65 @@ def process_product_delivery_type(message):
         types.KeyboardButton("❌ إلغاء")
     )
     
-    msg = bot.send_message(message.chat.id, summary, parse_mode="Markdown", reply_markup=markup)
-    bot.register_next_step_handler(msg, confirm_add_product)
+    expect_step(user_id, 'product_confirm')
+    bot.send_message(message.chat.id, summary, parse_mode="Markdown", reply_markup=markup)
 
+@wizard_step('product_confirm')
 def confirm_add_product(message):
     user_id = message.from_user.id
     
-    if message.text == "✅ موافق":
-        product = temp_product_data.get(user_id)
-        
-        if product:
-            # تشفير البيانات السرية قبل الحفظ
-            encrypted_hidden = encrypt_data(product['hidden_data']) if product.get('hidden_data') else ''
-            
-            # إضافة المنتج
-            product_id = str(uuid.uuid4())  # رقم فريد لا يتكرر
-            delivery_type = product.get('delivery_type', 'instant')
-            item = {
-                'id': product_id,
-                'item_name': product['item_name'],
-                'price': str(product['price']),
-                'seller_id': str(ADMIN_ID),
-                'seller_name': 'المالك',
-                'hidden_data': encrypted_hidden,
-                'category': product['category'],
-                'details': product['details'],
-                'image_url': product['image_url'],
-                'delivery_type': delivery_type,
-                'sold': False
-            }
-            
-            # حفظ في Firebase أولاً
-            try:
-                db.collection('products').document(product_id).set({
-                    'item_name': item['item_name'],
-                    'price': float(product['price']),
-                    'seller_id': str(ADMIN_ID),
-                    'seller_name': 'المالك',
-                    'hidden_data': encrypted_hidden,
-                    'category': item['category'],
-                    'details': item['details'],
-                    'image_url': item['image_url'],
-                    'delivery_type': delivery_type,
-                    'sold': False,
-                    'created_at': firestore.SERVER_TIMESTAMP
-                })
-                print(f"✅ تم حفظ المنتج {product_id} في Firebase")
-            except Exception as e:
-                print(f"❌ خطأ في حفظ المنتج في Firebase: {e}")
-            
-            # جلب عدد المنتجات من Firebase
-            products_count = len(get_all_products_for_store())
-            
-            delivery_display = "⚡ فوري" if delivery_type == 'instant' else "👨‍💼 يدوي"
-            bot.reply_to(message,
-                         f"✅ **تم إضافة المنتج بنجاح!**\n\n"
-                         f"📦 المنتج: {product['item_name']}\n"
-                         f"💰 السعر: {product['price']} ريال\n"
-                         f"🏷️ الفئة: {product['category']}\n"
-                         f"📦 التسليم: {delivery_display}\n"
-                         f"📊 إجمالي المنتجات: {products_count}",
-                         parse_mode="Markdown",
-                         reply_markup=types.ReplyKeyboardRemove())
-        
-        # حذف البيانات المؤقتة
-        temp_product_data.pop(user_id, None)
-    else:
-        bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
-        temp_product_data.pop(user_id, None)
+    if message.text != "✅ موافق":
+        return _cancel_add_product(message)
+    
+    product = _product_draft(message)
+    if product is None:
+        return
+    
+    # حذف البيانات المؤقتة (الحذف الناجح يحجز الحفظ: تأكيد مكرر لا يضيف المنتج مرتين)
+    user_states.clear(user_id)
+    if not bot_drafts.clear(_product_draft_key(user_id)):
+        return
+    
+    # البيانات السرية مشفرة منذ خطوة الإدخال
+    encrypted_hidden = product.get('hidden_data', '')
+    
+    # إضافة المنتج
+    product_id = str(uuid.uuid4())  # رقم فريد لا يتكرر
+    delivery_type = product.get('delivery_type', 'instant')
+    
+    # حفظ في Firebase أولاً
+    try:
+        db.collection('products').document(product_id).set({
+            'item_name': product['item_name'],
+            'price': float(product['price']),
+            'seller_id': str(ADMIN_ID),
+            'seller_name': 'المالك',
+            'hidden_data': encrypted_hidden,
+            'category': product['category'],
+            'details': product['details'],
+            'image_url': product['image_url'],
+            'delivery_type': delivery_type,
+            'sold': False,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        clear_cache('products')
+        print(f"✅ تم حفظ المنتج {product_id} في Firebase")
+    except Exception as e:
+        print(f"❌ خطأ في حفظ المنتج في Firebase: {e}")
+    
+    # جلب عدد المنتجات من Firebase
+    products_count = len(get_all_products_for_store())
+    
+    delivery_display = "⚡ فوري" if delivery_type == 'instant' else "👨‍💼 يدوي"
+    bot.reply_to(message,
+                 f"✅ **تم إضافة المنتج بنجاح!**\n\n"
+                 f"📦 المنتج: {product['item_name']}\n"
+                 f"💰 السعر: {product['price']} ريال\n"
+                 f"🏷️ الفئة: {product['category']}\n"
+                 f"📦 التسليم: {delivery_display}\n"
+                 f"📊 إجمالي المنتجات: {products_count}",
+                 parse_mode="Markdown",
+                 reply_markup=types.ReplyKeyboardRemove())
 
 @bot.message_handler(commands=['code'])
 def get_verification_code(message):
@@ -687,13 +714,13 @@ def get_verification_code(message):
     if message.from_user.last_name:
         user_name += ' ' + message.from_user.last_name
     
-    # توليد كود تحقق
-    code = generate_verification_code(user_id, user_name)
+    # توليد كود تحقق وحفظه في مخزن الأكواد (نفس مخزن /verify)
+    code = verification_codes.issue(str(user_id), name=user_name)
     
     bot.send_message(message.chat.id,
                      f"🔐 **كود التحقق الخاص بك:**\n\n"
                      f"`{code}`\n\n"
-                     f"⏱️ **صالح لمدة 10 دقائق**\n\n"
+                     f"⏱️ **صالح لمدة دقيقتين**\n\n"
                      f"💡 **خطوات الدخول:**\n"
                      f"1️⃣ افتح الموقع في المتصفح\n"
                      f"2️⃣ اضغط على زر 'حسابي'\n"
@@ -755,14 +782,15 @@ def edfapay_settings(message):
             
             callback_url = f"{SITE_URL}/payment/edfapay_webhook"
             
-            response = requests.post(
+            response = http_client.post(
                 "https://api.edfapay.com/payment/merchants/callback-url",
                 json={
                     "action": "post",
                     "id": EDFAPAY_MERCHANT_ID,
                     "url": callback_url
                 },
-                timeout=30
+                timeout=http_client.EDFAPAY_TIMEOUT,
+                breaker='edfapay'
             )
             
             if response.status_code == 200:
@@ -785,13 +813,14 @@ def edfapay_settings(message):
             # التحقق من الـ callback URL المسجل
             bot.reply_to(message, "⏳ جاري التحقق من Callback URL...")
             
-            response = requests.post(
+            response = http_client.post(
                 "https://api.edfapay.com/payment/merchants/callback-url",
                 json={
                     "action": "get",
                     "id": EDFAPAY_MERCHANT_ID
                 },
-                timeout=30
+                timeout=http_client.EDFAPAY_TIMEOUT,
+                breaker='edfapay'
             )
             
             # تنظيف النص من الرموز الخاصة
@@ -809,6 +838,8 @@ def edfapay_settings(message):
     except Exception as e:
         bot.reply_to(message, f"❌ خطأ: {e}")
 
+KEYS_INLINE_IN_CHAT = 50  # أكثر من ذلك تُرسل المفاتيح كملف
+
 # أمر توليد مفاتيح الشحن
 # الاستخدام: /توليد AMOUNT [COUNT]
 # مثال: /توليد 50 10  (توليد 10 مفاتيح بقيمة 50 ريال لكل منها)
@@ -823,25 +854,36 @@ def generate_keys(message):
         count = int(parts[2]) if len(parts) > 2 else 1
         
         # التحقق من الحدود
-        if count > 100:
-            return bot.reply_to(message, "❌ الحد الأقصى 100 مفتاح في المرة الواحدة!")
+        if count <= 0 or count > MAX_KEYS_PER_BATCH:
+            return bot.reply_to(message, f"❌ العدد يجب أن يكون بين 1 و {MAX_KEYS_PER_BATCH} مفتاح!")
         
         if amount <= 0:
             return bot.reply_to(message, "❌ المبلغ يجب أن يكون أكبر من صفر!")
         
-        # توليد المفاتيح
-        generated_keys = []
-        for i in range(count):
-            # توليد مفتاح عشوائي
-            key_code = f"KEY-{random.randint(10000, 99999)}-{random.randint(1000, 9999)}"
-            
-            # حفظ في Firebase مباشرة
-            try:
-                create_charge_key(key_code, amount)
-            except Exception as e:
-                print(f"⚠️ خطأ في حفظ المفتاح في Firebase: {e}")
-            
-            generated_keys.append(key_code)
+        # توليد المفاتيح (أكواد آمنة + إنشاء فقط + دفعات متوازية)
+        try:
+            result = generate_charge_keys(amount, count, created_by=message.from_user.id)
+        except Exception as e:
+            print(f"⚠️ خطأ في توليد المفاتيح: {e}")
+            return bot.reply_to(message, "❌ فشل توليد المفاتيح، حاول مرة أخرى")
+        
+        generated_keys = result['keys']
+        
+        # الأعداد الكبيرة تُرسل كملف بدل رسالة طويلة (حد تيليجرام 4096 حرف)
+        if len(generated_keys) > KEYS_INLINE_IN_CHAT:
+            keys_file = io.BytesIO(("\n".join(generated_keys) + "\n").encode('utf-8'))
+            keys_file.name = f"{result['batch_id']}.txt"
+            bot.send_document(
+                message.chat.id, keys_file,
+                caption=(
+                    f"🎁 تم توليد {len(generated_keys)} مفتاح\n"
+                    f"💰 قيمة كل مفتاح: {amount} ريال\n"
+                    f"💵 المجموع الكلي: {amount * len(generated_keys)} ريال\n"
+                    f"🆔 الدفعة: {result['batch_id']}"
+                ),
+                reply_to_message_id=message.message_id
+            )
+            return
         
         # إرسال المفاتيح
         if count == 1:
@@ -908,7 +950,7 @@ def recharge_balance(message):
         bot.reply_to(message, f"❌ حدث خطأ: {str(e)}")
 
 # معالج زر شحن إلكتروني
-@bot.callback_query_handler(func=lambda call: call.data == "recharge_payment")
+@callback_router.exact("recharge_payment")
 def handle_recharge_payment(call):
     """طلب إدخال مبلغ الشحن"""
     try:
@@ -952,7 +994,7 @@ def handle_recharge_payment(call):
         print(f"❌ خطأ في handle_recharge_payment: {e}")
 
 # معالج زر شحن بكود
-@bot.callback_query_handler(func=lambda call: call.data == "recharge_code")
+@callback_router.exact("recharge_code")
 def handle_recharge_code(call):
     """طلب إدخال كود الشحن"""
     try:
@@ -984,7 +1026,7 @@ def handle_recharge_code(call):
         print(f"❌ خطأ في handle_recharge_code: {e}")
 
 # معالج زر إلغاء الشحن
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_recharge")
+@callback_router.exact("cancel_recharge")
 def handle_cancel_recharge(call):
     """إلغاء عملية الشحن"""
     try:
@@ -1051,7 +1093,7 @@ def create_edfapay_invoice(user_id, amount, user_name):
         # استخدام API الإنتاج
         api_url = "https://api.edfapay.com/payment/initiate"
         
-        response = requests.post(api_url, data=payload, timeout=30)
+        response = http_client.post(api_url, data=payload, timeout=http_client.EDFAPAY_TIMEOUT, breaker='edfapay')
         print(f"📤 EdfaPay Response Status: {response.status_code}")
         print(f"📤 EdfaPay Response: {response.text[:500]}")
         
@@ -1106,6 +1148,8 @@ def create_edfapay_invoice(user_id, amount, user_name):
                 'error': str(error_msg)
             }
             
+    except http_client.ServiceUnavailable:
+        return {'success': False, 'error': 'بوابة الدفع غير متاحة مؤقتاً، حاول بعد قليل'}
     except requests.exceptions.Timeout:
         return {'success': False, 'error': 'انتهت مهلة الاتصال'}
     except requests.exceptions.RequestException as e:
@@ -1117,7 +1161,8 @@ def create_edfapay_invoice(user_id, amount, user_name):
         return {'success': False, 'error': str(e)}
 
 # معالج الرسائل النصية (للمبالغ والأكواد)
-@bot.message_handler(func=lambda message: str(message.from_user.id) in user_states)
+# الفلتر يقرأ من مخزن الحالات المشترك (حالة غيرتها عملية أخرى تظهر فوراً)
+@bot.message_handler(func=lambda message: message.from_user.id in user_states)
 def handle_user_state_message(message):
     """معالج رسائل المستخدمين حسب حالتهم"""
     try:
@@ -1127,6 +1172,11 @@ def handle_user_state_message(message):
         if not state_data:
             return
         
+        # خطوات المعالجات متعددة الخطوات (صلاحيتها من مسوداتها في bot_drafts)
+        step = wizard_steps.get(state_data.get('state'))
+        if step:
+            return step(message)
+        
         # التحقق من صلاحية الحالة (10 دقائق)
         if time.time() - state_data.get('created_at', 0) > 600:
             del user_states[user_id]
@@ -1150,8 +1200,9 @@ def handle_user_state_message(message):
             if amount > 1000:
                 return bot.reply_to(message, "❌ الحد الأقصى للشحن هو 1000 ريال")
             
-            # إزالة حالة المستخدم
-            del user_states[user_id]
+            # إزالة حالة المستخدم (الحذف الناجح يحجز الخطوة: رسالة مكررة لا تُنفذ مرتين)
+            if not user_states.clear(user_id):
+                return
             
             # إرسال رسالة انتظار
             wait_msg = bot.reply_to(message, "⏳ جاري إنشاء رابط الدفع...")
@@ -1205,50 +1256,36 @@ def handle_user_state_message(message):
             key_code = message.text.strip()
             user_name = message.from_user.first_name
             
-            # إزالة حالة المستخدم
-            del user_states[user_id]
+            # إزالة حالة المستخدم (الحذف الناجح يحجز الخطوة: رسالة مكررة لا تُنفذ مرتين)
+            if not user_states.clear(user_id):
+                return
             
-            # التحقق من وجود المفتاح
-            # جلب بيانات المفتاح من Firebase
-            key_data = get_charge_key(key_code)
+            # Transaction واحدة: التحقق من المفتاح + تعليمه مستخدماً + الرصيد + charge_history (للتجميد)
+            try:
+                result = redeem_charge_key(key_code, user_id, method='telegram_key', user_name=user_name)
+            except Exception as e:
+                print(f"❌ خطأ في شحن المفتاح: {e}")
+                return bot.reply_to(message, "❌ حدث خطأ، حاول لاحقاً")
             
-            if not key_data:
+            if result['result'] == 'not_found':
                 return bot.reply_to(message, "❌ المفتاح غير صحيح أو منتهي الصلاحية!")
             
-            # التحقق من استخدام المفتاح
-            if key_data.get('used', False):
+            if result['result'] == 'used':
                 return bot.reply_to(message, 
                     f"❌ هذا المفتاح تم استخدامه بالفعل!\n\n"
-                    f"👤 استخدمه: {key_data.get('used_by', 'مستخدم')}")
-            
-            # شحن الرصيد
-            amount = key_data.get('amount', 0)
-            add_balance(user_id, amount)
+                    f"👤 استخدمه: {result.get('used_by') or 'مستخدم'}")
             
-            # ✅ تسجيل الشحنة في charge_history للتجميد
-            try:
-                db.collection('charge_history').add({
-                    'user_id': str(user_id),
-                    'amount': float(amount),
-                    'method': 'telegram_key',
-                    'key_code': key_code,
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                })
-                print(f"✅ تم تسجيل شحنة التليجرام في charge_history: {amount} ريال للمستخدم {user_id}")
-                
-                # إشعار المالك بالشحن
-                notify_new_charge(user_id, amount, method='telegram_key', username=user_name)
-            except Exception as e:
-                print(f"⚠️ خطأ في تسجيل charge_history: {e}")
+            amount = result['amount']
+            print(f"✅ تم تسجيل شحنة التليجرام في charge_history: {amount} ريال للمستخدم {user_id}")
             
-            # تحديث حالة المفتاح في Firebase
-            use_charge_key(key_code, user_name)
+            # إشعار المالك بالشحن
+            notify_new_charge(user_id, amount, method='telegram_key', username=user_name)
             
             # إرسال رسالة نجاح
             bot.reply_to(message,
                 f"✅ *تم شحن رصيدك بنجاح!*\n\n"
                 f"💰 المبلغ المضاف: {amount} ريال\n"
-                f"💵 رصيدك الحالي: {get_balance(user_id)} ريال\n\n"
+                f"💵 رصيدك الحالي: {result['new_balance']} ريال\n\n"
                 f"⏳ *ملاحظة:* المبلغ سيكون متاحاً للسحب العادي (5.5%) بعد 72 ساعة.\n"
                 f"⚡ يمكنك السحب الفوري الآن برسوم 8%.\n"
                 f"🚀 التحويل خلال 1-5 ساعات بعد الموافقة!\n\n"
@@ -1289,8 +1326,9 @@ def handle_user_state_message(message):
             if amount > 10000:
                 return bot.reply_to(message, "❌ الحد الأقصى للفاتورة هو 10,000 ريال")
             
-            # إزالة حالة المستخدم
-            del user_states[user_id]
+            # إزالة حالة المستخدم (الحذف الناجح يحجز الخطوة: رسالة مكررة لا تُنفذ مرتين)
+            if not user_states.clear(user_id):
+                return
             
             # إنشاء معرف فريد للفاتورة
             invoice_id = generate_invoice_id()
@@ -1432,7 +1470,7 @@ def create_invoice_command(message):
         reply_markup=markup
     )
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_invoice")
+@callback_router.exact("cancel_invoice")
 def handle_cancel_invoice(call):
     """إلغاء إنشاء الفاتورة"""
     user_id = str(call.from_user.id)
@@ -1501,7 +1539,7 @@ def create_customer_invoice(merchant_id, merchant_name, amount, customer_phone,
         
         print(f"📤 EdfaPay Invoice Request: {payload}")
         
-        response = requests.post(EDFAPAY_API_URL, data=payload, timeout=30)
+        response = http_client.post(EDFAPAY_API_URL, data=payload, timeout=http_client.EDFAPAY_TIMEOUT, breaker='edfapay')
         print(f"📤 EdfaPay Response: {response.status_code} - {response.text[:500]}")
         
         result = response.json()
@@ -1589,7 +1627,7 @@ def create_customer_invoice(merchant_id, merchant_name, amount, customer_phone,
         return {'success': False, 'error': str(e)}
 
 # زر استلام الطلب من قبل المشرف (النظام القديم - للطلبات في الذاكرة)
-@bot.callback_query_handler(func=lambda call: call.data.startswith('claim_') and not call.data.startswith('claim_order_'))
+@callback_router.prefix("claim_")
 def claim_order(call):
     order_id = call.data.replace('claim_', '')
     admin_id = call.from_user.id
@@ -1612,12 +1650,15 @@ def claim_order(call):
     # تحديث حالة الطلب في الذاكرة
     order['status'] = 'claimed'
     order['admin_id'] = admin_id
+    order['admin_name'] = admin_name
+    admin_profiles.remember(admin_id, admin_name)
     
-    # تحديث في Firebase
+    # تحديث في Firebase (اسم المشرف يُحفظ في الطلب حتى لا تحتاج صفحة الطلبات لتيليجرام)
     try:
         db.collection('orders').document(order_id).update({
             'status': 'claimed',
             'admin_id': str(admin_id),
+            'admin_name': admin_name,
             'claimed_at': firestore.SERVER_TIMESTAMP
         })
     except Exception as e:
@@ -1674,7 +1715,7 @@ def claim_order(call):
     bot.answer_callback_query(call.id, "✅ تم استلام الطلب! تحقق من رسائلك الخاصة.")
 
 # زر إتمام الطلب من قبل المشرف (النظام القديم - للطلبات في الذاكرة)
-@bot.callback_query_handler(func=lambda call: call.data.startswith('complete_') and not call.data.startswith('complete_order_'))
+@callback_router.prefix("complete_")
 def complete_order(call):
     order_id = call.data.replace('complete_', '')
     admin_id = call.from_user.id
@@ -1730,7 +1771,7 @@ def complete_order(call):
     bot.answer_callback_query(call.id, "✅ تم إتمام الطلب بنجاح!")
 
 # زر تأكيد الاستلام من العميل
-@bot.callback_query_handler(func=lambda call: call.data.startswith('buyer_confirm_'))
+@callback_router.prefix("buyer_confirm_")
 def buyer_confirm(call):
     order_id = call.data.replace('buyer_confirm_', '')
     
@@ -1766,7 +1807,7 @@ def buyer_confirm(call):
     bot.answer_callback_query(call.id, "✅ شكراً لك!")
 
 # زر تأكيد الاستلام (يحرر المال للبائع) - الكود القديم للتوافق
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_'))
+@callback_router.prefix("confirm_")
 def confirm_transaction(call):
     trans_id = call.data.split('_')[1]
     
@@ -1793,7 +1834,7 @@ def confirm_transaction(call):
     bot.send_message(seller_id, f"🤑 مبروك! قام العميل بتأكيد الاستلام.\n💰 تم إضافة {amount} ريال لرصيدك.\n📦 الطلب: {trans['item_name']}\n🎮 آيدي: {trans.get('game_id', 'غير محدد')}")
 
 # معالج تنفيذ الطلبات اليدوية
-@bot.callback_query_handler(func=lambda call: call.data.startswith('claim_order_'))
+@callback_router.prefix("claim_order_")
 def claim_manual_order(call):
     """معالج تنفيذ الطلب اليدوي من قبل الأدمن أو المشرف"""
     order_id = call.data.replace('claim_order_', '')
@@ -1802,21 +1843,8 @@ def claim_manual_order(call):
     
     print(f"📋 محاولة استلام الطلب: {order_id} بواسطة: {admin_name} ({admin_id})")
     
-    # التحقق من أن المستخدم هو المالك أو مشرف
-    is_owner = (admin_id == ADMIN_ID)
-    is_manager = False
-    
-    if not is_owner and db:
-        try:
-            if USE_FIELD_FILTER:
-                admins = db.collection('admins').where(filter=FieldFilter('telegram_id', '==', str(admin_id))).get()
-            else:
-                admins = db.collection('admins').where('telegram_id', '==', str(admin_id)).get()
-            is_manager = len(list(admins)) > 0
-        except:
-            pass
-    
-    if not is_owner and not is_manager:
+    # التحقق من أن المستخدم هو المالك أو مشرف (من قائمة المشرفين المحفوظة)
+    if not admin_registry.is_admin_or_owner(admin_id):
         return bot.answer_callback_query(call.id, "⛔ غير مصرح لك!", show_alert=True)
     
     try:
@@ -1839,13 +1867,16 @@ def claim_manual_order(call):
         if order.get('status') == 'claimed':
             return bot.answer_callback_query(call.id, "⚠️ تم استلام هذا الطلب من مشرف آخر!", show_alert=True)
         
-        # تحديث حالة الطلب إلى مستلم
+        # تحديث حالة الطلب إلى مستلم (مع اسم المشرف للعرض في صفحة الطلبات)
         order_ref.update({
             'status': 'claimed',
             'claimed_by': str(admin_id),
             'claimed_by_name': admin_name,
+            'admin_id': str(admin_id),
+            'admin_name': admin_name,
             'claimed_at': firestore.SERVER_TIMESTAMP
         })
+        admin_profiles.remember(admin_id, admin_name)
         
         # تحديث رسالة الأدمن
         try:
@@ -1914,7 +1945,7 @@ def claim_manual_order(call):
         bot.answer_callback_query(call.id, f"❌ حدث خطأ: {str(e)}", show_alert=True)
 
 # معالج إكمال الطلب اليدوي
-@bot.callback_query_handler(func=lambda call: call.data.startswith('complete_order_'))
+@callback_router.prefix("complete_order_")
 def complete_manual_order(call):
     """معالج إكمال الطلب اليدوي بعد التنفيذ"""
     from datetime import datetime
@@ -2017,7 +2048,7 @@ def complete_manual_order(call):
 
 # ===================== معالجات طلبات السحب =====================
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('withdraw_approve_'))
+@callback_router.prefix("withdraw_approve_")
 def handle_withdraw_approve(call):
     """معالج الموافقة على طلب السحب"""
     try:
@@ -2117,7 +2148,7 @@ def handle_withdraw_approve(call):
         bot.answer_callback_query(call.id, f"❌ حدث خطأ: {str(e)}", show_alert=True)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('withdraw_reject_'))
+@callback_router.prefix("withdraw_reject_")
 def handle_withdraw_reject(call):
     """معالج رفض طلب السحب"""
     try:
@@ -2197,42 +2228,31 @@ def handle_withdraw_reject(call):
 # استيراد دوال المحاسبة
 from firebase_utils import (
     add_ledger_transaction, get_user_ledger_stats,
+    get_ledger_summary, get_partner_summary,
     get_partner_transactions, settle_partner_debt,
     settle_single_transaction, delete_ledger_transaction,
-    get_ledger_transaction_by_id, delete_partner_all_transactions,
-    cleanup_old_ledger_transactions
+    get_ledger_transaction_by_id, delete_partner_all_transactions
 )
 from utils import get_next_weekday, get_weekday_name_arabic, format_date_arabic, get_weekday_after_weeks
 
-# مخزن مؤقت للمسودات (مع وقت الإنشاء للتنظيف التلقائي)
-acc_drafts = {}  # {user_id: {'data': {...}, 'created_at': timestamp}}
-
-# تنظيف المسودات القديمة (أكثر من ساعة)
-def cleanup_old_drafts():
-    """تنظيف المسودات المنتهية"""
-    now = time.time()
-    expired = [k for k, v in acc_drafts.items() if now - v.get('created_at', 0) > 3600]
-    for k in expired:
-        del acc_drafts[k]
-    if expired:
-        print(f"🧹 تم حذف {len(expired)} مسودات محاسبة منتهية")
+# المسودات في bot_drafts (تنتهي تلقائياً بعد ساعة)
+def _acc_draft_key(user_id):
+    return f"acc:{user_id}"
 
 
 # ==================== القائمة الرئيسية للمحاسبة ====================
 
-@bot.callback_query_handler(func=lambda call: call.data == "acc_main")
+@callback_router.exact("acc_main")
 def accounting_main_menu(call):
     """القائمة الرئيسية لنظام المحاسبة"""
     try:
-        cleanup_old_drafts()  # تنظيف المسودات القديمة
-        
-        stats = get_user_ledger_stats(call.from_user.id)
+        stats = get_ledger_summary(call.from_user.id)
         
         msg = f"""المحاسبة الخاصة
 
 💰 المبلغ بانتظار التحويل: {stats['total_debt']:.2f} ر.س
 👥 التجار: {stats['partners_count']}
-📊 العمليات: {len(stats['transactions'])}"""
+📊 العمليات: {stats['transactions_count']}"""
         
         markup = types.InlineKeyboardMarkup(row_width=2)
         markup.add(
@@ -2255,7 +2275,7 @@ def accounting_main_menu(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_start")
+@callback_router.exact("back_to_start")
 def back_to_start_menu(call):
     """العودة للقائمة الرئيسية"""
     try:
@@ -2297,7 +2317,7 @@ def back_to_start_menu(call):
 
 # ==================== إضافة عملية جديدة (Wizard) ====================
 
-@bot.callback_query_handler(func=lambda call: call.data == "acc_new_step1")
+@callback_router.exact("acc_new_step1")
 def acc_step1_service(call):
     """الخطوة 1: اختيار نوع الخدمة"""
     try:
@@ -2320,7 +2340,7 @@ def acc_step1_service(call):
         print(f"❌ خطأ في acc_step1: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_srv_"))
+@callback_router.prefix("acc_srv_")
 def acc_step2_name(call):
     """الخطوة 2: إدخال اسم التاجر/العميل"""
     try:
@@ -2328,10 +2348,7 @@ def acc_step2_name(call):
         user_id = call.from_user.id
         
         # حفظ المسودة
-        acc_drafts[user_id] = {
-            'data': {'service': service},
-            'created_at': time.time()
-        }
+        bot_drafts[_acc_draft_key(user_id)] = {'service': service}
         
         # أسماء الخدمات
         service_names = {
@@ -2340,7 +2357,7 @@ def acc_step2_name(call):
             'other': '📦 أخرى'
         }
         
-        msg = bot.edit_message_text(
+        bot.edit_message_text(
             f"✅ النوع: {service_names.get(service, service)}\n\n"
             "2️⃣ **أرسل اسم التاجر أو العميل:**\n"
             "(اكتب الاسم وأرسله)",
@@ -2348,11 +2365,12 @@ def acc_step2_name(call):
             parse_mode="Markdown"
         )
         
-        bot.register_next_step_handler(msg, acc_step3_amount)
+        expect_step(user_id, 'acc_partner_name')
     except Exception as e:
         print(f"❌ خطأ في acc_step2: {e}")
 
 
+@wizard_step('acc_partner_name')
 def acc_step3_amount(message):
     """الخطوة 3: إدخال المبلغ"""
     try:
@@ -2360,38 +2378,42 @@ def acc_step3_amount(message):
         
         if message.text and message.text.startswith('/'):
             # أمر إلغاء
-            acc_drafts.pop(user_id, None)
+            bot_drafts.clear(_acc_draft_key(user_id))
+            user_states.clear(user_id)
             return bot.reply_to(message, "❌ تم إلغاء العملية")
         
-        if user_id not in acc_drafts:
+        if _acc_draft_key(user_id) not in bot_drafts:
+            user_states.clear(user_id)
             return bot.reply_to(message, "⚠️ انتهت الجلسة. ابدأ من جديد بالضغط على 📒 المحاسبة")
         
         # حفظ الاسم
-        acc_drafts[user_id]['data']['partner_name'] = message.text.strip()
+        update_draft(_acc_draft_key(user_id), partner_name=message.text.strip())
         
-        msg = bot.send_message(
+        expect_step(user_id, 'acc_amount')
+        bot.send_message(
             message.chat.id,
             f"✅ الاسم: **{message.text.strip()}**\n\n"
             "3️⃣ **كم المبلغ الصافي؟**\n"
             "(أرقام فقط، مثال: 1500)",
             parse_mode="Markdown"
         )
-        
-        bot.register_next_step_handler(msg, acc_step4_day)
     except Exception as e:
         print(f"❌ خطأ في acc_step3: {e}")
 
 
+@wizard_step('acc_amount')
 def acc_step4_day(message):
     """الخطوة 4: اختيار يوم التذكير"""
     try:
         user_id = message.from_user.id
         
         if message.text and message.text.startswith('/'):
-            acc_drafts.pop(user_id, None)
+            bot_drafts.clear(_acc_draft_key(user_id))
+            user_states.clear(user_id)
             return bot.reply_to(message, "❌ تم إلغاء العملية")
         
-        if user_id not in acc_drafts:
+        if _acc_draft_key(user_id) not in bot_drafts:
+            user_states.clear(user_id)
             return bot.reply_to(message, "⚠️ انتهت الجلسة. ابدأ من جديد")
         
         try:
@@ -2399,7 +2421,9 @@ def acc_step4_day(message):
             if amount <= 0:
                 raise ValueError("المبلغ يجب أن يكون أكبر من صفر")
             
-            acc_drafts[user_id]['data']['amount'] = amount
+            update_draft(_acc_draft_key(user_id), amount=amount)
+            # باقي الخطوات أزرار (callback)
+            user_states.clear(user_id)
             
             # أزرار اختيار اليوم
             markup = types.InlineKeyboardMarkup(row_width=2)
@@ -2437,20 +2461,20 @@ def acc_step4_day(message):
             )
             
         except ValueError as ve:
-            msg = bot.send_message(message.chat.id, f"❌ {ve}\nأرسل رقماً صحيحاً:")
-            bot.register_next_step_handler(msg, acc_step4_day)
+            expect_step(user_id, 'acc_amount')
+            bot.send_message(message.chat.id, f"❌ {ve}\nأرسل رقماً صحيحاً:")
     except Exception as e:
         print(f"❌ خطأ في acc_step4: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_day_"))
+@callback_router.prefix("acc_day_")
 def acc_step5_time_or_save(call):
     """الخطوة 5: اختيار الوقت أو الحفظ مباشرة"""
     try:
         user_id = call.from_user.id
         choice = call.data.replace("acc_day_", "")  # tuesday, wednesday, tuesday1w, wednesday1w, skip
         
-        if user_id not in acc_drafts:
+        if _acc_draft_key(user_id) not in bot_drafts:
             bot.answer_callback_query(call.id, "انتهت الجلسة!")
             return
         
@@ -2468,7 +2492,7 @@ def acc_step5_time_or_save(call):
                 day_name = choice
                 date_str = get_next_weekday(day_name)
             
-            acc_drafts[user_id]['data']['temp_date'] = date_str
+            update_draft(_acc_draft_key(user_id), temp_date=date_str)
             
             markup = types.InlineKeyboardMarkup(row_width=3)
             markup.add(
@@ -2491,18 +2515,18 @@ def acc_step5_time_or_save(call):
         print(f"❌ خطأ في acc_step5: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_time_"))
+@callback_router.prefix("acc_time_")
 def acc_final_save(call):
     """الخطوة الأخيرة: حفظ مع التذكير"""
     try:
         user_id = call.from_user.id
         hour = call.data.split("_")[2]
         
-        if user_id not in acc_drafts:
+        if _acc_draft_key(user_id) not in bot_drafts:
             bot.answer_callback_query(call.id, "انتهت الجلسة!")
             return
         
-        date_str = acc_drafts[user_id]['data'].get('temp_date')
+        date_str = bot_drafts[_acc_draft_key(user_id)].get('temp_date')
         reminder_dt = f"{date_str} {hour}:00"
         
         finish_ledger_transaction(user_id, call.message, reminder=reminder_dt)
@@ -2513,18 +2537,19 @@ def acc_final_save(call):
 def finish_ledger_transaction(user_id, message_obj, reminder):
     """حفظ العملية النهائية"""
     try:
-        if user_id not in acc_drafts:
+        data = bot_drafts.get(_acc_draft_key(user_id))
+        if data is None:
+            return
+        
+        # تنظيف المسودة (الحذف الناجح يحجز الحفظ: ضغطة مكررة لا تُسجل العملية مرتين)
+        if not bot_drafts.clear(_acc_draft_key(user_id)):
             return
         
-        data = acc_drafts[user_id]['data']
         data['reminder_date'] = reminder
         
         # الحفظ في قاعدة البيانات
         tx_id = add_ledger_transaction(user_id, data)
         
-        # تنظيف المسودة
-        del acc_drafts[user_id]
-        
         # أسماء الخدمات
         service_names = {
             'tamara': 'تمارا',
@@ -2570,13 +2595,10 @@ def finish_ledger_transaction(user_id, message_obj, reminder):
 
 # ==================== عرض السجل ====================
 
-@bot.callback_query_handler(func=lambda call: call.data == "acc_registry")
+@callback_router.exact("acc_registry")
 def acc_registry_view(call):
     """قائمة خيارات السجل"""
     try:
-        # حذف الفواتير القديمة تلقائياً
-        deleted = cleanup_old_ledger_transactions(call.from_user.id, days=60)
-        
         markup = types.InlineKeyboardMarkup(row_width=2)
         markup.add(
             types.InlineKeyboardButton("المستحقات", callback_data="acc_show_pending"),
@@ -2596,9 +2618,6 @@ def acc_registry_view(call):
         msg += "اختر طريقة العرض:\n\n"
         msg += "⚠️ _الفواتير تُحذف تلقائياً بعد 60 يوم_"
         
-        if deleted > 0:
-            msg += f"\n\n🗑️ تم حذف {deleted} فاتورة قديمة"
-        
         bot.edit_message_text(
             msg,
             call.message.chat.id, call.message.message_id,
@@ -2608,7 +2627,7 @@ def acc_registry_view(call):
         print(f"❌ خطأ في acc_registry: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data in ["acc_show_all", "acc_show_pending", "acc_show_paid"])
+@callback_router.exact("acc_show_all", "acc_show_pending", "acc_show_paid")
 def acc_show_list(call):
     """عرض قائمة الشركاء"""
     try:
@@ -2641,17 +2660,8 @@ def acc_show_list(call):
             
             btn_text = f"{status_icon} {name} | {amount_text} ر.س ({data['count']})"
             
-            # استخدام ID مشفر بدلاً من الاسم (للأسماء الطويلة)
-            partner_id = hashlib.md5(name.encode()).hexdigest()[:8]
-            
-            # حفظ الاسم مؤقتاً
-            if user_id not in acc_drafts:
-                acc_drafts[user_id] = {'data': {}, 'created_at': time.time()}
-            if 'partner_map' not in acc_drafts[user_id]:
-                acc_drafts[user_id]['partner_map'] = {}
-            acc_drafts[user_id]['partner_map'][partner_id] = name
-            
-            markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"acc_p_{partner_id}"))
+            # الاسم يُرمز بمعرف قصير إذا تجاوز حد 64 بايت
+            markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_router.pack("acc_p_", name)))
         
         markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="acc_registry"))
         
@@ -2671,31 +2681,26 @@ def acc_show_list(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_p_"))
+@callback_router.prefix("acc_p_")
 def acc_partner_details(call):
     """عرض تفاصيل شريك"""
     try:
         user_id = call.from_user.id
-        partner_id = call.data.split("_")[2]
-        
-        # جلب الاسم الحقيقي
-        if user_id in acc_drafts and 'partner_map' in acc_drafts[user_id]:
-            partner_name = acc_drafts[user_id]['partner_map'].get(partner_id)
-        else:
-            bot.answer_callback_query(call.id, "انتهت الجلسة!")
-            return
+        partner_name = call.callback_arg
         
         if not partner_name:
             bot.answer_callback_query(call.id, "لم يتم العثور على الشريك!")
             return
         
-        transactions = get_partner_transactions(user_id, partner_name)
+        # آخر 10 عمليات + ملخص الشريك (المستحق الكامل)
+        transactions = get_partner_transactions(user_id, partner_name, limit=10)
+        partner_summary = get_partner_summary(user_id, partner_name)
         
         msg_lines = [f"👤 **كشف حساب: {partner_name}**\n"]
-        total_pending = 0
+        total_pending = partner_summary['pending'] if partner_summary else 0
         pending_transactions = []
         
-        for tx in transactions[:10]:  # آخر 10 عمليات
+        for tx in transactions:
             icon = "⏳" if tx['status'] == 'pending' else "✅"
             amount = tx['amount']
             service = tx.get('service', '')
@@ -2718,7 +2723,6 @@ def acc_partner_details(call):
             msg_lines.append(line)
             
             if tx['status'] == 'pending':
-                total_pending += float(amount)
                 pending_transactions.append({
                     'id': tx_id,
                     'amount': amount,
@@ -2750,23 +2754,16 @@ def acc_partner_details(call):
         print(f"❌ خطأ في acc_partner_details: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_confirm_settle_"))
+@callback_router.prefix("acc_confirm_settle_")
 def acc_confirm_settle(call):
     """تأكيد التسديد"""
     try:
-        user_id = call.from_user.id
-        partner_id = call.data.split("_settle_")[1]
-        
-        if user_id in acc_drafts and 'partner_map' in acc_drafts[user_id]:
-            partner_name = acc_drafts[user_id]['partner_map'].get(partner_id)
-        else:
-            bot.answer_callback_query(call.id, "انتهت الجلسة!")
-            return
+        partner_name = call.callback_arg
         
         markup = types.InlineKeyboardMarkup(row_width=2)
         markup.add(
-            types.InlineKeyboardButton("✅ نعم، تسديد", callback_data=f"acc_do_settle_{partner_id}"),
-            types.InlineKeyboardButton("❌ إلغاء", callback_data=f"acc_p_{partner_id}")
+            types.InlineKeyboardButton("✅ نعم، تسديد", callback_data=callback_router.pack("acc_do_settle_", partner_name)),
+            types.InlineKeyboardButton("❌ إلغاء", callback_data=callback_router.pack("acc_p_", partner_name))
         )
         
         bot.edit_message_text(
@@ -2779,12 +2776,12 @@ def acc_confirm_settle(call):
         print(f"❌ خطأ في acc_confirm_settle: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_settle_tx_"))
+@callback_router.prefix("acc_settle_tx_")
 def acc_settle_single_transaction(call):
     """تسديد عملية واحدة"""
     try:
         user_id = call.from_user.id
-        tx_id_partial = call.data.replace("acc_settle_tx_", "")
+        tx_id_partial = call.callback_arg
         
         # البحث عن العملية الكاملة
         tx = get_ledger_transaction_by_id(user_id, tx_id_partial)
@@ -2820,18 +2817,12 @@ def acc_settle_single_transaction(call):
         print(f"❌ خطأ في acc_settle_single_transaction: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_do_settle_"))
+@callback_router.prefix("acc_do_settle_")
 def acc_perform_settle(call):
     """تنفيذ التسديد"""
     try:
         user_id = call.from_user.id
-        partner_id = call.data.split("_settle_")[1]
-        
-        if user_id in acc_drafts and 'partner_map' in acc_drafts[user_id]:
-            partner_name = acc_drafts[user_id]['partner_map'].get(partner_id)
-        else:
-            bot.answer_callback_query(call.id, "انتهت الجلسة!")
-            return
+        partner_name = call.callback_arg
         
         count, total = settle_partner_debt(user_id, partner_name)
         
@@ -2858,14 +2849,14 @@ def acc_perform_settle(call):
 
 # ==================== ملخص سريع ====================
 
-@bot.callback_query_handler(func=lambda call: call.data == "acc_summary")
+@callback_router.exact("acc_summary")
 def acc_quick_summary(call):
     """ملخص سريع لجميع الحسابات"""
     try:
         user_id = call.from_user.id
         stats = get_user_ledger_stats(user_id)
         
-        if not stats['transactions']:
+        if not stats['transactions_count']:
             bot.answer_callback_query(call.id, "📭 لا توجد عمليات")
             return
         
@@ -2894,7 +2885,7 @@ def acc_quick_summary(call):
 
 # ==================== حذف شريك/تاجر ====================
 
-@bot.callback_query_handler(func=lambda call: call.data == "acc_delete_partner_list")
+@callback_router.exact("acc_delete_partner_list")
 def acc_delete_partner_list(call):
     """عرض قائمة الشركاء للحذف"""
     try:
@@ -2911,9 +2902,8 @@ def acc_delete_partner_list(call):
         for partner_name, data in partners.items():
             # عرض اسم الشريك وعدد عملياته
             btn_text = f"🗑️ {partner_name} ({data['count']} عملية)"
-            # ترميز الاسم للـ callback
-            safe_name = partner_name.replace(" ", "_")[:30]
-            markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"acc_del_confirm_{safe_name}"))
+            # ترميز الاسم للـ callback (معرف قصير للأسماء الطويلة)
+            markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_router.pack("acc_del_confirm_", partner_name)))
         
         markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="acc_registry"))
         
@@ -2929,34 +2919,24 @@ def acc_delete_partner_list(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_del_confirm_"))
+@callback_router.prefix("acc_del_confirm_")
 def acc_delete_confirm(call):
     """تأكيد حذف الشريك"""
     try:
         # استخراج اسم الشريك
-        safe_name = call.data.replace("acc_del_confirm_", "")
-        partner_name = safe_name.replace("_", " ")
+        actual_name = call.callback_arg
         
         # جلب بيانات الشريك
         user_id = call.from_user.id
-        stats = get_user_ledger_stats(user_id)
+        partner_data = get_partner_summary(user_id, actual_name)
         
-        # البحث عن الاسم الصحيح
-        actual_name = None
-        partner_data = None
-        for name, data in stats['partners_summary'].items():
-            if name.replace(" ", "_")[:30] == safe_name:
-                actual_name = name
-                partner_data = data
-                break
-        
-        if not actual_name:
+        if not partner_data:
             bot.answer_callback_query(call.id, "❌ الشريك غير موجود")
             return
         
         markup = types.InlineKeyboardMarkup(row_width=2)
         markup.add(
-            types.InlineKeyboardButton("✅ نعم، احذف", callback_data=f"acc_del_do_{safe_name}"),
+            types.InlineKeyboardButton("✅ نعم، احذف", callback_data=callback_router.pack("acc_del_do_", actual_name)),
             types.InlineKeyboardButton("❌ إلغاء", callback_data="acc_delete_partner_list")
         )
         
@@ -2976,25 +2956,17 @@ def acc_delete_confirm(call):
         bot.answer_callback_query(call.id, "حدث خطأ!")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("acc_del_do_"))
+@callback_router.prefix("acc_del_do_")
 def acc_delete_do(call):
     """تنفيذ حذف الشريك"""
     try:
         # استخراج اسم الشريك
-        safe_name = call.data.replace("acc_del_do_", "")
+        actual_name = call.callback_arg
         
         # جلب بيانات الشريك
         user_id = call.from_user.id
-        stats = get_user_ledger_stats(user_id)
-        
-        # البحث عن الاسم الصحيح
-        actual_name = None
-        for name in stats['partners_summary'].keys():
-            if name.replace(" ", "_")[:30] == safe_name:
-                actual_name = name
-                break
         
-        if not actual_name:
+        if not get_partner_summary(user_id, actual_name):
             bot.answer_callback_query(call.id, "❌ الشريك غير موجود")
             return
         
@@ -3030,13 +3002,13 @@ def acc_delete_do(call):
 def accounting_command(message):
     """أمر مباشر لفتح المحاسبة"""
     try:
-        stats = get_user_ledger_stats(message.from_user.id)
+        stats = get_ledger_summary(message.from_user.id)
         
         msg = f"""المحاسبة الخاصة
 
 💰 المبلغ بانتظار التحويل: {stats['total_debt']:.2f} ر.س
 👥 التجار: {stats['partners_count']}
-📊 العمليات: {len(stats['transactions'])}"""
+📊 العمليات: {stats['transactions_count']}"""
         
         markup = types.InlineKeyboardMarkup(row_width=2)
         markup.add(
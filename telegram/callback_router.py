@@ -0,0 +1,152 @@
+"""
+Callback Router - توجيه أزرار البوت
+يقرأ callback_data مرة واحدة ويوجهها للمعالج المناسب عبر قاموس
+بدل تمرير كل زر على عشرات دوال lambda بالترتيب
+"""
+import hashlib
+import logging
+
+from store_backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+# حد تيليجرام لطول callback_data بالبايت
+CALLBACK_DATA_LIMIT = 64
+
+# القيم الطويلة تُستبدل بمعرف قصير: prefix + '~' + token
+PACKED_MARKER = '~'
+PACKED_TTL = 7 * 24 * 3600  # أسبوع
+
+
+class CallbackRouter:
+    """
+    الاستخدام:
+        router = CallbackRouter()
+        router.attach(bot)
+
+        @router.exact("acc_main")
+        def handler(call): ...
+
+        @router.prefix("acc_p_")
+        def handler(call):
+            partner = call.callback_arg  # ما بعد البادئة (بعد فك الترميز)
+    """
+
+    def __init__(self, backend=None):
+        self._exact = {}     # {callback_data: handler}
+        self._prefixes = {}  # {prefix: handler} - كل بادئة تنتهي بـ '_'
+        self._backend = backend
+        self._bot = None
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    # --- التسجيل ---
+
+    def exact(self, *names):
+        """تسجيل معالج لقيمة (أو قيم) محددة"""
+        def decorator(handler):
+            for name in names:
+                self._exact[name] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix):
+        """تسجيل معالج لكل القيم التي تبدأ بالبادئة (يجب أن تنتهي بـ '_')"""
+        if not prefix.endswith('_'):
+            raise ValueError(f"البادئة يجب أن تنتهي بـ '_': {prefix}")
+
+        def decorator(handler):
+            self._prefixes[prefix] = handler
+            return handler
+        return decorator
+
+    def attach(self, bot):
+        """تسجيل الموجه كمعالج واحد في البوت"""
+        self._bot = bot
+        bot.callback_query_handler(func=self.match)(self.dispatch)
+
+    # --- التوجيه ---
+
+    def resolve(self, data):
+        """
+        إيجاد المعالج المناسب
+
+        البادئات المحتملة هي ما قبل كل '_' في القيمة، ويُختار الأطول
+        فالتكلفة تعتمد على طول القيمة وليس على عدد المعالجات
+
+        Returns:
+            tuple: (handler, prefix, arg) أو (None, None, None)
+        """
+        if not data:
+            return None, None, None
+
+        handler = self._exact.get(data)
+        if handler:
+            return handler, data, None
+
+        end = data.rfind('_')
+        while end != -1:
+            prefix = data[:end + 1]
+            handler = self._prefixes.get(prefix)
+            if handler:
+                return handler, prefix, data[end + 1:]
+            end = data.rfind('_', 0, end)
+        return None, None, None
+
+    def match(self, call):
+        """فلتر telebot: يحلل الزر مرة واحدة ويحفظ النتيجة على الـ call"""
+        handler, prefix, arg = self.resolve(call.data)
+        if not handler:
+            return False
+        call.callback_route = (handler, prefix, arg)
+        return True
+
+    def dispatch(self, call):
+        """تنفيذ المعالج الذي تم تحديده في match"""
+        handler, prefix, arg = getattr(call, 'callback_route', None) or self.resolve(call.data)
+        if not handler:
+            return
+
+        if arg and arg.startswith(PACKED_MARKER):
+            arg = self.unpack(arg[len(PACKED_MARKER):])
+            if arg is None:
+                try:
+                    if self._bot:
+                        self._bot.answer_callback_query(call.id, "⏱ انتهت صلاحية الزر، افتح القائمة من جديد")
+                except Exception:
+                    pass
+                return
+            # إعادة القيمة الكاملة لمن يقرأ call.data مباشرة
+            call.data = f"{prefix}{arg}"
+
+        call.callback_arg = arg
+        return handler(call)
+
+    # --- الترميز المختصر ---
+
+    def pack(self, prefix, value):
+        """
+        بناء callback_data لا يتجاوز 64 بايت
+        القيم القصيرة تبقى كما هي، والطويلة تُحفظ في المخزن ويُرسل معرف قصير
+        """
+        value = str(value)
+        data = f"{prefix}{value}"
+        if len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT and not value.startswith(PACKED_MARKER):
+            return data
+
+        token = hashlib.sha1(data.encode('utf-8')).hexdigest()[:12]
+        try:
+            self.backend.set(f"cb:{token}", value, ex=PACKED_TTL)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ قيمة الزر: {e}")
+        return f"{prefix}{PACKED_MARKER}{token}"
+
+    def unpack(self, token):
+        """استرجاع القيمة الأصلية من المعرف القصير"""
+        try:
+            return self.backend.get(f"cb:{token}")
+        except Exception as e:
+            logger.error(f"خطأ في قراءة قيمة الزر: {e}")
+            return None
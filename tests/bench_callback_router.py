@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+قياس زمن توجيه أزرار البوت (CallbackRouter.resolve)
+====================================================
+يسجل 30 / 300 / 3000 معالج بادئة ويقيس زمن resolve لقيمة withdraw_approve_...
+مقارنة بسلسلة startswith خطية (كما كانت دوال lambda في telebot تُفحص بالترتيب)
+
+المتوقع: زمن الموجه ثابت تقريباً مهما زاد عدد المعالجات، والسلسلة الخطية تزيد معه
+
+التشغيل: python tests/bench_callback_router.py
+(ليس اختباراً - pytest لا يجمعه)
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.callback_router import CallbackRouter
+
+HANDLER_COUNTS = (30, 300, 3000)
+PAYLOAD = 'withdraw_approve_8f14e45fceea167a5a36dedd4bea2543'
+NUMBER = 20000
+
+
+def _handler(call):
+    return None
+
+
+def _build(count):
+    """موجه وسلسلة خطية بنفس البادئات (البادئة المطلوبة آخر واحدة)"""
+    prefixes = [f"action{i}_" for i in range(count - 1)] + ['withdraw_approve_']
+    router = CallbackRouter(backend=object())
+    for prefix in prefixes:
+        router.prefix(prefix)(_handler)
+    chain = [(lambda data, p=prefix: data.startswith(p), _handler) for prefix in prefixes]
+    return router, chain
+
+
+def _linear_resolve(chain, data):
+    for check, handler in chain:
+        if check(data):
+            return handler
+    return None
+
+
+def main():
+    print(f"{'handlers':>8} | {'router (us)':>11} | {'linear (us)':>11}")
+    for count in HANDLER_COUNTS:
+        router, chain = _build(count)
+        assert router.resolve(PAYLOAD)[0] is _handler
+        assert _linear_resolve(chain, PAYLOAD) is _handler
+
+        router_us = min(timeit.repeat(lambda: router.resolve(PAYLOAD), number=NUMBER, repeat=5)) / NUMBER * 1e6
+        linear_number = max(NUMBER // count, 10)
+        linear_us = min(timeit.repeat(lambda: _linear_resolve(chain, PAYLOAD), number=linear_number, repeat=5)) / linear_number * 1e6
+        print(f"{count:>8} | {router_us:>11.2f} | {linear_us:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
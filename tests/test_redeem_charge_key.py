@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبار ضغط: استخدام نفس مفتاح الشحن من عدة threads في نفس الوقت
+====================================================================
+redeem_charge_key يعتمد على Transaction في Firestore، فهنا قاعدة بيانات وهمية
+تحاكي الـ Transactions المتفائلة (optimistic): القراءات تُسجل بنسختها، والـ commit
+يفشل إذا تغيرت مستندات قُرئت، و firestore.transactional يعيد المحاولة.
+
+المطلوب: نجاح واحد فقط، وإضافة رصيد واحدة فقط (الرصيد + balance_logs + charge_history)
+
+التشغيل: python -m pytest -q tests
+"""
+
+import os
+import sys
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import firebase_utils
+
+THREADS = 24
+KEY_CODE = 'KEY-STRESS-0001'
+KEY_AMOUNT = 50.0
+
+
+# ==================== Firestore وهمي ====================
+
+class TransactionAborted(Exception):
+    """تعارض عند الـ commit (مستند قُرئ تغير قبل الكتابة)"""
+
+
+class FakeIncrement:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentRef:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+
+    def get(self, transaction=None):
+        with self._db.lock:
+            data = self._db.docs.get(self.path)
+            version = self._db.versions.get(self.path, 0)
+            data = dict(data) if data is not None else None
+        if transaction is not None:
+            transaction.reads.setdefault(self.path, version)
+        # فرصة للـ threads الأخرى بين القراءة والكتابة
+        time.sleep(0.001)
+        return FakeSnapshot(data)
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self._db = db
+        self._name = name
+
+    def document(self, doc_id=None):
+        return FakeDocumentRef(self._db, f"{self._name}/{doc_id or uuid.uuid4().hex}")
+
+
+class FakeTransaction:
+    def __init__(self, db):
+        self._db = db
+        self.reads = {}
+        self.writes = []
+
+    def begin(self):
+        self.reads = {}
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(('set', ref.path, dict(data), merge))
+
+    def update(self, ref, data):
+        self.writes.append(('update', ref.path, dict(data), True))
+
+    def commit(self):
+        db = self._db
+        with db.lock:
+            for path, version in self.reads.items():
+                if db.versions.get(path, 0) != version:
+                    db.aborts += 1
+                    raise TransactionAborted(path)
+            for op, path, data, merge in self.writes:
+                current = db.docs.get(path)
+                if op == 'update' and current is None:
+                    raise KeyError(path)
+                doc = dict(current) if (merge and current is not None) else {}
+                for field, value in data.items():
+                    if isinstance(value, FakeIncrement):
+                        value = (doc.get(field) or 0) + value.value
+                    doc[field] = value
+                db.docs[path] = doc
+                db.versions[path] = db.versions.get(path, 0) + 1
+
+
+class FakeDB:
+    def __init__(self):
+        self.docs = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.aborts = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def collection_docs(self, name):
+        prefix = name + '/'
+        return [doc for path, doc in self.docs.items() if path.startswith(prefix)]
+
+
+class FakeFirestoreModule:
+    """بديل firebase_admin.firestore بما تستخدمه redeem_charge_key فقط"""
+    SERVER_TIMESTAMP = object()
+    Increment = FakeIncrement
+    MAX_ATTEMPTS = THREADS * 4
+
+    @classmethod
+    def transactional(cls, func):
+        def run(transaction, *args, **kwargs):
+            for _ in range(cls.MAX_ATTEMPTS):
+                transaction.begin()
+                result = func(transaction, *args, **kwargs)
+                try:
+                    transaction.commit()
+                    return result
+                except TransactionAborted:
+                    continue
+            raise TransactionAborted('max attempts')
+        return run
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDB()
+    db.docs[f'charge_keys/{KEY_CODE}'] = {'amount': KEY_AMOUNT, 'used': False}
+    monkeypatch.setattr(firebase_utils, 'db', db)
+    monkeypatch.setattr(firebase_utils, 'firestore', FakeFirestoreModule)
+    return db
+
+
+def _redeem_concurrently(user_ids):
+    barrier = threading.Barrier(len(user_ids))
+
+    def redeem(user_id):
+        barrier.wait()
+        return user_id, firebase_utils.redeem_charge_key(KEY_CODE, user_id, user_name=f'user {user_id}')
+
+    with ThreadPoolExecutor(max_workers=len(user_ids)) as pool:
+        return list(pool.map(redeem, user_ids))
+
+
+# ==================== الاختبارات ====================
+
+def test_concurrent_redeem_different_users_credits_once(fake_db):
+    user_ids = [str(1000 + i) for i in range(THREADS)]
+    results = _redeem_concurrently(user_ids)
+
+    winners = [(uid, r) for uid, r in results if r['result'] == 'redeemed']
+    assert len(winners) == 1
+    assert all(r['result'] == 'used' for uid, r in results if (uid, r) not in winners)
+
+    winner_id, winner = winners[0]
+    assert winner['amount'] == KEY_AMOUNT
+    assert winner['new_balance'] == KEY_AMOUNT
+
+    # إضافة رصيد واحدة فقط، للفائز فقط
+    users = {path.split('/', 1)[1]: doc for path, doc in fake_db.docs.items() if path.startswith('users/')}
+    assert list(users) == [winner_id]
+    assert users[winner_id]['balance'] == KEY_AMOUNT
+    assert len(fake_db.collection_docs('balance_logs')) == 1
+    assert len(fake_db.collection_docs('charge_history')) == 1
+
+    key = fake_db.docs[f'charge_keys/{KEY_CODE}']
+    assert key['used'] is True
+    assert key['used_by'] == winner_id
+
+
+def test_concurrent_redeem_same_user_credits_once(fake_db):
+    # نقرات متكررة من نفس المستخدم
+    results = _redeem_concurrently(['777'] * THREADS)
+
+    assert sum(1 for _, r in results if r['result'] == 'redeemed') == 1
+    assert fake_db.docs['users/777']['balance'] == KEY_AMOUNT
+    assert len(fake_db.collection_docs('balance_logs')) == 1
+    assert len(fake_db.collection_docs('charge_history')) == 1
+
+
+def test_fake_transactions_actually_conflicted(fake_db):
+    # التأكد أن الاختبار يولد تعارضات فعلاً (وإلا لا يختبر شيئاً)
+    _redeem_concurrently([str(2000 + i) for i in range(THREADS)])
+    assert fake_db.aborts > 0
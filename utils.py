@@ -11,6 +11,7 @@ import secrets
 import time
 import datetime
 from flask import session
+from rate_limit_store import rate_limit_store, SCOPE_IP_LOGIN
 
 
 # === دوال التواريخ للمحاسبة ===
@@ -180,36 +181,16 @@ def validate_amount(amount, min_amount=10, max_amount=5000):
         return False
 
 # === محاولات الدخول الفاشلة ===
-failed_login_attempts = {}
+# تُحفظ في المخزن الموحد (rate_limit_store) بدل قاموس محلي
 
 def check_rate_limit(ip, max_attempts=5, block_time=300):
     """التحقق من عدد المحاولات الفاشلة"""
-    if ip not in failed_login_attempts:
-        return True
-    
-    data = failed_login_attempts[ip]
-    
-    # التحقق من الحظر
-    if data.get('blocked_until', 0) > time.time():
-        return False
-    
-    # إعادة تعيين إذا انتهى الحظر
-    if data.get('blocked_until', 0) < time.time():
-        failed_login_attempts[ip] = {'count': 0, 'blocked_until': 0}
-    
-    return True
+    return rate_limit_store.lock_remaining(SCOPE_IP_LOGIN, ip) <= 0
 
 def record_failed_attempt(ip, max_attempts=5, block_time=300):
     """تسجيل محاولة فاشلة"""
-    if ip not in failed_login_attempts:
-        failed_login_attempts[ip] = {'count': 0, 'blocked_until': 0}
-    
-    failed_login_attempts[ip]['count'] += 1
-    
-    if failed_login_attempts[ip]['count'] >= max_attempts:
-        failed_login_attempts[ip]['blocked_until'] = time.time() + block_time
+    rate_limit_store.record_failure(SCOPE_IP_LOGIN, ip, max_attempts, block_time, block_time)
 
 def reset_failed_attempts(ip):
     """إعادة تعيين المحاولات الفاشلة"""
-    if ip in failed_login_attempts:
-        del failed_login_attempts[ip]
+    rate_limit_store.reset(SCOPE_IP_LOGIN, ip)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+مخزن أكواد التحقق
+=================
+أكواد تحقق مؤقتة تنتهي تلقائياً (TTL) مع عدّ ذري للمحاولات
+تعمل فوق المخزن المشترك (Redis أو الذاكرة المحلية) فتعمل مع أكثر من عملية
+"""
+
+import time
+import hmac
+import logging
+
+from store_backend import get_backend
+from utils import generate_code
+
+logger = logging.getLogger(__name__)
+
+
+class VerificationCodeStore:
+    """أكواد تحقق مؤقتة لكل مفتاح (مستخدم أو المالك)"""
+
+    def __init__(self, scope, ttl, max_attempts, backend=None, prefix='vc'):
+        self.scope = scope
+        self.ttl = ttl                      # مدة صلاحية الكود بالثواني
+        self.max_attempts = max_attempts    # عدد المحاولات قبل إلغاء الكود
+        self._backend = backend
+        self.prefix = prefix
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, key):
+        return f"{self.prefix}:{self.scope}:{key}"
+
+    def issue(self, key, code=None, ttl=None, **data):
+        """
+        إنشاء كود جديد (يستبدل أي كود سابق لنفس المفتاح)
+
+        Args:
+            key: معرف المستخدم أو المالك
+            code: الكود (اختياري - يُولد تلقائياً)
+            ttl: مدة الصلاحية (اختياري - الافتراضي من المخزن)
+            **data: بيانات إضافية تُحفظ مع الكود (مثل name, ip)
+
+        Returns:
+            str: الكود
+        """
+        code = str(code or generate_code(6))
+        record = {key_: str(value) for key_, value in data.items() if value is not None}
+        record.update({'code': code, 'created_at': time.time(), 'attempts': 0})
+
+        store_key = self._key(key)
+        pipe = self.backend.pipeline()
+        pipe.delete(store_key)
+        pipe.hset(store_key, mapping=record)
+        pipe.expire(store_key, int(ttl or self.ttl))
+        pipe.execute()
+        return code
+
+    def get(self, key):
+        """جلب بيانات الكود الحالي (None إذا لم يوجد أو انتهى)"""
+        record = self.backend.hgetall(self._key(key))
+        return record if record.get('code') else None
+
+    def verify(self, key, code):
+        """
+        التحقق من الكود مع احتساب المحاولة بشكل ذري
+
+        Returns:
+            dict: بيانات الكود إذا كان صحيحاً، None غير ذلك
+        """
+        store_key = self._key(key)
+        pipe = self.backend.pipeline()
+        pipe.hincrby(store_key, 'attempts', 1)
+        pipe.hgetall(store_key)
+        attempts, record = pipe.execute()
+
+        if not record or not record.get('code'):
+            # لا يوجد كود (hincrby ينشئ مفتاحاً فارغاً - نحذفه)
+            self.backend.delete(store_key)
+            return None
+
+        if hmac.compare_digest(record['code'], str(code or '').strip()):
+            return record
+
+        # تجاوز عدد المحاولات = الكود ينتهي
+        if int(attempts) >= self.max_attempts:
+            self.backend.delete(store_key)
+        return None
+
+    def consume(self, key):
+        """
+        حذف الكود بعد استخدامه
+
+        Returns:
+            bool: True إذا كان هذا الاستدعاء هو من حذفه (استخدام لمرة واحدة)
+        """
+        return self.backend.delete(self._key(key)) > 0
+
+    def discard(self, key):
+        """إلغاء الكود بدون نتيجة"""
+        self.backend.delete(self._key(key))